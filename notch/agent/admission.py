@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Admission control for connected device sessions.
+
+Devices accept a limited number of logins (e.g., VTY lines), so the
+number of sessions connected at once may be limited per device, per
+vendor (a device_factory.VENDOR_MAP key) and for the whole agent.
+Sessions connecting over a limit wait in a bounded queue, admitted in
+arrival order as other sessions disconnect, and fail once their deadline
+passes. Idle sessions may be disconnected to make room for them.
+"""
+
+import collections
+
+import eventlet
+from eventlet.green import time
+
+import notch.agent.errors
+
+
+# Default maximum number of requests waiting for admission.
+DEFAULT_MAX_QUEUE_SIZE = 1024
+
+# Default time (in seconds) a request waits for admission.
+DEFAULT_TIMEOUT = 60.0
+
+# The resource limited by the agent-wide limit.
+AGENT = ('agent', None)
+
+
+class Waiter(object):
+    """A request waiting for its session to be admitted.
+
+    Attributes:
+      holder: A hashable, the session waiting.
+      resources: A tuple of resources the session needs a slot of.
+      event: An eventlet.event.Event, sent once admitted.
+      reclaim: A boolean, if True, idle sessions may be disconnected to
+        make room for the session.
+    """
+
+    __slots__ = ('holder', 'resources', 'event', 'reclaim')
+
+    def __init__(self, holder, resources, reclaim=True):
+        self.holder = holder
+        self.resources = resources
+        self.event = eventlet.event.Event()
+        self.reclaim = reclaim
+
+
+class AdmissionController(object):
+    """Limits the sessions connected at once.
+
+    A session holds one slot of each of its device, its vendor and the
+    agent from when it is admitted (before connecting) until released
+    (once disconnected). Limits of None are unlimited.
+
+    Waiting sessions are admitted in arrival order. A session is passed
+    over whilst its own device or vendor is at its limit, but no later
+    session takes a slot an earlier one is waiting for, so none waits
+    forever behind later arrivals.
+
+    Attributes:
+      max_sessions: An int, the limit for the agent, or None.
+      max_sessions_per_device: An int, the limit for each device, or None.
+      max_sessions_per_vendor: A dict of int limits, keyed by vendor.
+      max_queue_size: An int, the maximum number of waiting requests.
+      timeout: A float, the time (in seconds) a request waits.
+      reclaim_callback: A callable, or None. Called with a full resource
+        and a list of the sessions holding it when a session must wait
+        for it (or one goes idle whilst it waits), to disconnect an idle
+        one.
+      active: A dict of the number of slots in use, by resource.
+    """
+
+    def __init__(self, max_sessions=None, max_sessions_per_device=None,
+                 max_sessions_per_vendor=None,
+                 max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+                 timeout=DEFAULT_TIMEOUT, reclaim_callback=None):
+        self.max_sessions = max_sessions
+        self.max_sessions_per_device = max_sessions_per_device
+        self.max_sessions_per_vendor = dict(max_sessions_per_vendor or {})
+        self.max_queue_size = max_queue_size
+        self.timeout = timeout
+        self.reclaim_callback = reclaim_callback
+        self.active = collections.defaultdict(int)
+        # Admitted sessions' [acquire count, resources], by session.
+        self._holders = {}
+        # Waiter objects, in arrival order.
+        self._waiters = collections.deque()
+
+    def __len__(self):
+        """Returns the number of requests waiting for admission."""
+        return len(self._waiters)
+
+    @staticmethod
+    def resources(device_name, vendor):
+        """Returns the resources a session of the device needs a slot of."""
+        return (('device', device_name), ('vendor', vendor), AGENT)
+
+    def limit(self, resource):
+        """Returns the limit for a resource, or None if unlimited."""
+        kind, name = resource
+        if kind == 'device':
+            return self.max_sessions_per_device
+        elif kind == 'vendor':
+            return self.max_sessions_per_vendor.get(name)
+        return self.max_sessions
+
+    def _full(self, resource):
+        limit = self.limit(resource)
+        return limit is not None and self.active.get(resource, 0) >= limit
+
+    def acquire(self, holder, device_name, vendor, timeout=None,
+                reclaim=True):
+        """Admits a session to connect, waiting if need be.
+
+        Each acquire must be followed by a release() for the holder.
+
+        Args:
+          holder: A hashable, the session connecting.
+          device_name: A string, the session's device name.
+          vendor: A string, the device's vendor, or None.
+          timeout: A float, the time (in seconds) to wait, or None for
+            the controller's timeout.
+          reclaim: A boolean, if True, idle sessions holding the slots
+            needed may be disconnected (see reclaim_callback).
+
+        Raises:
+          AdmissionQueueFullError: Too many requests are already waiting.
+          AdmissionTimeoutError: The request was not admitted in time.
+        """
+        held = self._holders.get(holder)
+        if held is not None:
+            held[0] += 1
+            return
+        waiter = Waiter(holder, self.resources(device_name, vendor),
+                        reclaim=reclaim)
+        if not self._waiters and not any(self._full(resource) for resource
+                                         in waiter.resources):
+            self._admit(waiter)
+            return
+        if len(self._waiters) >= self.max_queue_size:
+            raise notch.agent.errors.AdmissionQueueFullError(
+                '%d requests already waiting for admission' %
+                len(self._waiters))
+        if timeout is None:
+            timeout = self.timeout
+        self._waiters.append(waiter)
+        start = time.time()
+        try:
+            self._dispatch()
+            if reclaim and not waiter.event.ready():
+                for resource in waiter.resources:
+                    if self._full(resource):
+                        self._reclaim(resource, self._holders)
+            with eventlet.Timeout(max(0, timeout), False):
+                waiter.event.wait()
+        except BaseException:
+            # E.g., the request's own timeout.
+            self._abandon(waiter)
+            raise
+        if not waiter.event.ready():
+            self._abandon(waiter)
+            raise notch.agent.errors.AdmissionTimeoutError(
+                'Not admitted to %r within %.1fs' %
+                (device_name, time.time() - start))
+
+    def release(self, holder):
+        """Releases an admitted session's slots, admitting waiters."""
+        held = self._holders[holder]
+        held[0] -= 1
+        if held[0]:
+            return
+        del self._holders[holder]
+        for resource in held[1]:
+            self.active[resource] -= 1
+            if not self.active[resource]:
+                del self.active[resource]
+        if self._waiters:
+            self._dispatch()
+
+    def _admit(self, waiter):
+        held = self._holders.get(waiter.holder)
+        if held is not None:
+            held[0] += 1
+        else:
+            self._holders[waiter.holder] = [1, waiter.resources]
+            for resource in waiter.resources:
+                self.active[resource] += 1
+        waiter.event.send()
+
+    def _dispatch(self):
+        """Admits waiters, in arrival order, whose slots are free."""
+        # Full resources an earlier waiter is waiting for.
+        wanted = set()
+        waiting = collections.deque()
+        for waiter in self._waiters:
+            if waiter.holder not in self._holders:
+                full = [resource for resource in waiter.resources
+                        if self._full(resource)]
+                if full or wanted.intersection(waiter.resources):
+                    wanted.update(full)
+                    waiting.append(waiter)
+                    continue
+            self._admit(waiter)
+        self._waiters = waiting
+
+    def idle(self, holder):
+        """Notes an admitted session is idle, reclaiming it if waited for.
+
+        Args:
+          holder: A hashable, the session no longer executing requests.
+        """
+        held = self._holders.get(holder)
+        if held is None:
+            return
+        for waiter in self._waiters:
+            if not waiter.reclaim:
+                continue
+            for resource in waiter.resources:
+                if resource in held[1] and self._full(resource):
+                    self._reclaim(resource, [holder])
+                    return
+
+    def _reclaim(self, resource, holders):
+        """Asks for an idle one of holders of a full resource to go."""
+        if self.reclaim_callback is None:
+            return
+        self.reclaim_callback(resource, [
+            holder for holder in holders
+            if resource in self._holders[holder][1]])
+
+    def _abandon(self, waiter):
+        """Withdraws a waiter, releasing its slots if already admitted."""
+        if waiter.event.ready():
+            self.release(waiter.holder)
+        else:
+            self._waiters.remove(waiter)
+            # Waiters passed over for this one may now be admitted.
+            self._dispatch()
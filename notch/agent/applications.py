@@ -21,6 +21,7 @@ import eventlet
 import tornado.web
 import tornado.wsgi
 
+import compression
 import controller
 import handlers
 
@@ -32,28 +33,105 @@ BASE_URLS = [(r'/', handlers.HomeHandler),
 # The JSON-RPC v2.0 interface.
 JSON_RPC2_URL = r'/JSONRPC2'
 
+# The device inventory export.
+INVENTORY_URL = r'/inventory'
+
+# The framed result stream (Tornado server only).
+STREAM_URL = r'/stream'
+
+# Default maximum number of greenthreads executing device requests (and
+# writing result streams) at once. Greenthreads are cheap, so this need
+# only bound runaway load; slow devices or clients don't starve others.
+DEFAULT_REQUEST_THREADS = 1024
+
+
+def int_option(options, name, default):
+    """Returns an int option, or default if it is missing or invalid."""
+    try:
+        return int(options.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def compression_options(configuration):
+    """Returns the (level, min_length) of response compression configured.
+
+    The 'gzip_level' option (0 disables compression) and 'gzip_min_length'
+    option (in bytes) are read from the configuration's options section.
+    Invalid values fall back to the defaults.
+    """
+    options = (configuration or {}).get('options') or {}
+    level = int_option(options, 'gzip_level', compression.DEFAULT_LEVEL)
+    if not 0 <= level <= 9:
+        level = compression.DEFAULT_LEVEL
+    min_length = int_option(options, 'gzip_min_length',
+                            compression.DEFAULT_MIN_LENGTH)
+    return level, min_length
+
 
 class NotchTornadoApplication(tornado.web.Application):
 
     def __init__(self, configuration):
         urls = BASE_URLS + [
-            (JSON_RPC2_URL, handlers.NotchSyncJsonRpcHandler)]
+            (JSON_RPC2_URL, handlers.NotchAsyncJsonRpcHandler),
+            (INVENTORY_URL, handlers.InventoryHandler),
+            (STREAM_URL, handlers.NotchStreamHandler)]
         # Initialise the controller and start the maintenance task.
         self.controller = controller.Controller(configuration)
         eventlet.spawn_n(self.controller.run_maintenance)
+        # Load the device inventory now, rather than upon the first RPC
+        # (or reconcile the inventory snapshot loaded with its sources).
+        eventlet.spawn_n(self.controller.device_manager.rescan)
+        # Device requests execute in greenthreads of this pool, off the
+        # IOLoop.
+        options = (configuration or {}).get('options') or {}
+        self.request_pool = eventlet.GreenPool(int_option(
+            options, 'request_threads', DEFAULT_REQUEST_THREADS))
 
-        settings = dict(controller=self.controller)
-        tornado.web.Application.__init__(self, urls, **settings)
+        settings = dict(controller=self.controller,
+                        request_pool=self.request_pool,
+                        batch_concurrency=int_option(
+                            options, 'batch_concurrency',
+                            handlers.DEFAULT_BATCH_CONCURRENCY))
+        transforms = []
+        level, min_length = compression_options(configuration)
+        if level:
+            transforms.append(compression.gzip_transform(level, min_length))
+        transforms.append(tornado.web.ChunkedTransferEncoding)
+        tornado.web.Application.__init__(self, urls, transforms=transforms,
+                                         **settings)
 
 
 class NotchWSGIApplication(tornado.wsgi.WSGIApplication):
 
     def __init__(self, configuration):
         urls = BASE_URLS + [
-            (JSON_RPC2_URL, handlers.NotchSyncJsonRpcHandler)]
+            (JSON_RPC2_URL, handlers.NotchSyncJsonRpcHandler),
+            (INVENTORY_URL, handlers.InventoryHandler)]
         # Initialise the controller and start the maintenance task.
         self.controller = controller.Controller(configuration)
         eventlet.spawn_n(self.controller.run_maintenance)
 
+        self.gzip_level, self.gzip_min_length = compression_options(
+            configuration)
+
         settings = dict(controller=self.controller)
         tornado.wsgi.WSGIApplication.__init__(self, urls, **settings)
+
+    def __call__(self, environ, start_response):
+        if not self.gzip_level:
+            return tornado.wsgi.WSGIApplication.__call__(self, environ,
+                                                         start_response)
+        # Tornado's WSGI handlers write the whole body before responding.
+        response = []
+        def capture(status, headers, exc_info=None):
+            response.append((status, headers))
+        body = tornado.wsgi.WSGIApplication.__call__(self, environ, capture)
+        status, headers = response[0]
+        headers, body = compression.gzip_response(
+            headers, body, level=self.gzip_level,
+            min_length=self.gzip_min_length,
+            accepted=compression.accepts_gzip(
+                environ.get('HTTP_ACCEPT_ENCODING')))
+        start_response(status, headers)
+        return body
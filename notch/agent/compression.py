@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Response compression, negotiated with the client's Accept-Encoding.
+
+Responses are gzip compressed when the client accepts it, the content
+type compresses well and the body is at least a minimum length. Bodies
+sent in pieces (e.g., the result stream) are compressed a piece at a
+time, each piece sent as soon as it is written.
+"""
+
+import zlib
+
+import tornado.web
+
+
+# Content types of responses that are compressed.
+COMPRESSED_CONTENT_TYPES = frozenset([
+    'application/json', 'application/json-rpc',
+    'application/x-notch-stream', 'text/html', 'text/plain'])
+
+# Default zlib compression level (1-9) used, or 0 to not compress.
+DEFAULT_LEVEL = 6
+
+# Default least body length (in bytes) compressed. Shorter bodies aren't
+# worth the CPU time or the gzip header.
+DEFAULT_MIN_LENGTH = 1024
+
+# zlib window bits for a gzip header and trailer.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def accepts_gzip(accept_encoding):
+    """Returns True if an Accept-Encoding header value allows gzip.
+
+    Args:
+      accept_encoding: A string, the header value, or None.
+    """
+    for coding in (accept_encoding or '').split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() not in ('gzip', '*'):
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    if float(value) <= 0:
+                        return False
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def vary_accept_encoding(vary):
+    """Returns a Vary header value also naming Accept-Encoding.
+
+    Responses that may be compressed vary by Accept-Encoding, whether or
+    not this one is, so caches don't serve them to other clients.
+
+    Args:
+      vary: A string, the response's Vary header value, or None.
+    """
+    if not vary:
+        return 'Accept-Encoding'
+    fields = [field.strip().lower() for field in vary.split(',')]
+    if 'accept-encoding' in fields or '*' in fields:
+        return vary
+    return vary + ', Accept-Encoding'
+
+
+def compressible(content_type, content_encoding=None):
+    """Returns True if a response of content_type should be compressed."""
+    if content_encoding:
+        return False
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    return content_type in COMPRESSED_CONTENT_TYPES
+
+
+class GzipCompressor(object):
+    """Gzip compresses a body written in one or more pieces."""
+
+    def __init__(self, level=DEFAULT_LEVEL):
+        self._compressobj = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+
+    def compress(self, data, finishing=False):
+        """Returns the compressed data, flushed so the client can read it.
+
+        Args:
+          data: A string, the next piece of the body.
+          finishing: A boolean, True if this is the last piece.
+        """
+        if finishing:
+            mode = zlib.Z_FINISH
+        else:
+            mode = zlib.Z_SYNC_FLUSH
+        return self._compressobj.compress(data) + self._compressobj.flush(mode)
+
+
+def gzip_transform(level=DEFAULT_LEVEL, min_length=DEFAULT_MIN_LENGTH):
+    """Returns a Tornado OutputTransform class compressing responses.
+
+    Unlike tornado.web.GZipContentEncoding, each piece of a streamed
+    response is compressed once (rather than the whole response so far
+    being copied for every piece), and the level and minimum length are
+    configurable.
+
+    Args:
+      level: An int, the zlib compression level.
+      min_length: An int, the least length of a complete body compressed.
+        Bodies sent in pieces are always compressed.
+    """
+
+    class GzipContentEncoding(tornado.web.OutputTransform):
+
+        def __init__(self, request):
+            self._compressor = None
+            self._accepted = accepts_gzip(
+                request.headers.get('Accept-Encoding'))
+
+        def transform_first_chunk(self, headers, chunk, finishing):
+            if not compressible(headers.get('Content-Type'),
+                                headers.get('Content-Encoding')):
+                return headers, chunk
+            headers['Vary'] = vary_accept_encoding(headers.get('Vary'))
+            if (self._accepted and
+                (not finishing or len(chunk) >= min_length)):
+                self._compressor = GzipCompressor(level)
+                headers['Content-Encoding'] = 'gzip'
+                chunk = self._compressor.compress(chunk, finishing)
+                if 'Content-Length' in headers:
+                    headers['Content-Length'] = str(len(chunk))
+            return headers, chunk
+
+        def transform_chunk(self, chunk, finishing):
+            if self._compressor is not None:
+                chunk = self._compressor.compress(chunk, finishing)
+            return chunk
+
+    return GzipContentEncoding
+
+
+def gzip_response(headers, body, level=DEFAULT_LEVEL,
+                  min_length=DEFAULT_MIN_LENGTH, accepted=True):
+    """Compresses a complete WSGI response, if worthwhile.
+
+    Args:
+      headers: A list of (name, value) tuples, the response headers.
+      body: A list of strings, the response body.
+      level: An int, the zlib compression level.
+      min_length: An int, the least body length compressed.
+      accepted: A boolean, True if the client accepts gzip.
+
+    Returns:
+      A tuple of the (possibly new) headers and body.
+    """
+    names = dict((name.lower(), value) for name, value in headers)
+    if not compressible(names.get('content-type'),
+                        names.get('content-encoding')):
+        return headers, body
+    headers = [(name, value) for name, value in headers
+               if name.lower() != 'vary']
+    headers.append(('Vary', vary_accept_encoding(names.get('vary'))))
+    data = ''.join(body)
+    if not accepted or len(data) < min_length:
+        return headers, body
+    data = GzipCompressor(level).compress(data, finishing=True)
+    headers = [(name, value) for name, value in headers
+               if name.lower() != 'content-length']
+    headers.extend([('Content-Encoding', 'gzip'),
+                    ('Content-Length', str(len(data)))])
+    return headers, [data]
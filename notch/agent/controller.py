@@ -21,16 +21,23 @@ the RPC server. Routine maintenance activities are also located here.
 """
 
 import eventlet
+from eventlet import queue
 
+import functools
+import heapq
+import itertools
 import logging
+import operator
 from eventlet.green import time
 
 import notch.agent.errors
 
+import admission
 import credential
 import device_factory
 import device_manager
 import lru
+import result_cache
 import session
 
 
@@ -39,6 +46,29 @@ import session
 MAX_ACTIVE_SESSIONS = 512
 # Default session check window period in seconds.
 DEFAULT_SESSION_CHECK_PERIOD_S = 10.0
+# Default minimum time (in seconds) a connected session is idle before
+# its device is probed for liveness. Zero disables probes.
+DEFAULT_SESSION_PROBE_PERIOD_S = 60.0
+# Maximum number of sessions probed per session check period.
+MAX_PROBES_PER_CHECK = 64
+# Maximum number of sessions probed at once.
+PROBE_CONCURRENCY = 8
+# Maximum number of idle sessions disconnected at once.
+IDLE_DISCONNECT_CONCURRENCY = 16
+# Every this many idle checks, connected sessions not yet tracked for
+# idleness (e.g., connected without a request) are found.
+IDLE_RESEED_CHECKS = 30
+# Default maximum number of devices a fan-out request works on at once.
+DEFAULT_FANOUT_CONCURRENCY = 32
+# Number of devices whose request counts are kept, for the warm pool.
+DEVICE_USAGE_SIZE = 4096
+# Maximum number of sessions the warm pool keeps connected.
+MAX_WARM_SESSIONS = MAX_ACTIVE_SESSIONS // 2
+# Maximum number of warm pool sessions connecting at once.
+WARM_CONNECT_CONCURRENCY = 8
+# Minimum time (in seconds) between warm pool connection attempts to a
+# device whose last attempt failed.
+WARM_RETRY_INTERVAL_S = 60.0
 
 
 class Controller(object):
@@ -49,6 +79,12 @@ class Controller(object):
         session.SessionKey namedtuples.
       config: A dict, holding the configuration.
       device_manager: A device_manager.DeviceManager instance.
+      device_usage: A lru.LruDict of request counts keyed by device name.
+      warm_devices: A set of device names, those whose sessions the warm
+        pool keeps connected.
+      result_cache: A result_cache.ResultCache of read-only request results.
+      admission: An admission.AdmissionController, limiting the sessions
+        connected at once.
     """
 
     def __init__(self, config=None):
@@ -59,16 +95,40 @@ class Controller(object):
         """
         self.config = config or {}
         self._get_timers_from_config(config)
+        self._get_warm_pool_from_config(config)
+        self._get_result_cache_from_config(config)
+        self._get_admission_from_config(config)
         self.sessions = lru.LruDict(populate_callback=self.create_session,
                                     expire_callback=self.expire_session,
                                     maximum_size=MAX_ACTIVE_SESSIONS)
         self.device_manager = device_manager.DeviceManager(self.config)
+        self.device_usage = lru.LruDict(maximum_size=DEVICE_USAGE_SIZE)
+        self.warm_devices = set()
+        self._warm_pool = eventlet.GreenPool(WARM_CONNECT_CONCURRENCY)
+        # Device names with a warm pool connection attempt in progress.
+        self._warming = set()
+        # Time of the last failed warm pool connection, by device name.
+        self._warm_failures = {}
+        self._probe_pool = eventlet.GreenPool(PROBE_CONCURRENCY)
+        # Heap of (deadline, sequence, Session) for the idle check. A
+        # deadline may be earlier than the session's, never later.
+        self._idle_heap = []
+        self._idle_sequence = itertools.count()
+        # The sessions in the idle heap.
+        self._idle_tracked = set()
+        self._idle_checks = 0
+        self._idle_pool = eventlet.GreenPool(IDLE_DISCONNECT_CONCURRENCY)
+        # Executions of read-only requests, shared by identical requests.
+        self._executions = lru.Coalescer()
+        # Sessions being disconnected to make room for others to connect.
+        self._reclaiming = set()
         self.load_credentials()
         self._stopped = eventlet.event.Event()
         self.__current_maint_thread = None
 
     def stop(self):
         self._stopped.send()
+        self.device_manager.stop_rescans()
         logging.debug('Disconnecting all sessions.')
         for session in self.sessions.values():
             session.disconnect()
@@ -76,10 +136,16 @@ class Controller(object):
     def run_maintenance(self):
         """Runs maintenance greenthreads."""
         self._session_idle_check()
+        if self.warm_regexp or self.warm_pool_size:
+            self._warm_check()
+        if self._session_probe_period:
+            self._liveness_check()
+        self.device_manager.start_rescans()
         self._stopped.wait()
 
     def _get_timers_from_config(self, config):
         self._session_maint_period = DEFAULT_SESSION_CHECK_PERIOD_S
+        self._session_probe_period = DEFAULT_SESSION_PROBE_PERIOD_S
         timers = self.config.get('timers')
         if timers:
             try:
@@ -88,27 +154,273 @@ class Controller(object):
                                DEFAULT_SESSION_CHECK_PERIOD_S))
             except ValueError:
                 pass
+            try:
+                self._session_probe_period = float(
+                    timers.get('session_probe_period',
+                               DEFAULT_SESSION_PROBE_PERIOD_S))
+            except ValueError:
+                pass
+
+    def _get_warm_pool_from_config(self, config):
+        options = self.config.get('options') or {}
+        # Devices matching this regexp are kept connected.
+        self.warm_regexp = options.get('warm_devices')
+        # As are this many most recently, and most frequently, used devices.
+        try:
+            self.warm_pool_size = int(options.get('warm_pool_size', 0))
+        except ValueError:
+            self.warm_pool_size = 0
+
+    def _get_result_cache_from_config(self, config):
+        options = self.config.get('options') or {}
+        try:
+            maximum_size = int(options.get('result_cache_size',
+                                           result_cache.DEFAULT_MAXIMUM_SIZE))
+            maximum_bytes = int(options.get(
+                'result_cache_bytes', result_cache.DEFAULT_MAXIMUM_BYTES))
+        except ValueError:
+            maximum_size = result_cache.DEFAULT_MAXIMUM_SIZE
+            maximum_bytes = result_cache.DEFAULT_MAXIMUM_BYTES
+        self.result_cache = result_cache.ResultCache(
+            maximum_size=maximum_size, maximum_bytes=maximum_bytes)
+
+    def _get_admission_from_config(self, config):
+        options = self.config.get('options') or {}
+        limits = {}
+        for name in ('max_sessions', 'max_sessions_per_device'):
+            try:
+                limits[name] = int(options[name])
+            except (KeyError, TypeError, ValueError):
+                limits[name] = None
+        vendor_limits = {}
+        for vendor, limit in (options.get('max_sessions_per_vendor')
+                              or {}).items():
+            if vendor not in device_factory.VENDOR_MAP:
+                logging.error('Unknown vendor %r in max_sessions_per_vendor',
+                              vendor)
+                continue
+            try:
+                vendor_limits[vendor] = int(limit)
+            except (TypeError, ValueError):
+                logging.error('Invalid max_sessions_per_vendor limit %r for '
+                              '%r', limit, vendor)
+        try:
+            max_queue_size = int(options.get(
+                'admission_queue_size', admission.DEFAULT_MAX_QUEUE_SIZE))
+        except ValueError:
+            max_queue_size = admission.DEFAULT_MAX_QUEUE_SIZE
+        try:
+            timeout = float(options.get('admission_timeout',
+                                        admission.DEFAULT_TIMEOUT))
+        except ValueError:
+            timeout = admission.DEFAULT_TIMEOUT
+        self.admission = admission.AdmissionController(
+            max_sessions_per_vendor=vendor_limits,
+            max_queue_size=max_queue_size, timeout=timeout,
+            reclaim_callback=self._reclaim_session, **limits)
+
+    def _reclaim_session(self, unused_resource, sessions):
+        """Disconnects the longest idle of sessions, for admission.
+
+        Called by the admission controller when a session must wait for
+        a slot held by sessions. Sessions executing requests (or being
+        probed) are left alone.
+        """
+        if any(session in self._reclaiming for session in sessions):
+            return
+        idle = [session for session in sessions
+                if session.connected and session.idle and not session.probing]
+        if not idle:
+            return
+        session = min(idle, key=lambda s: s.time_last_active or 0)
+        self._reclaiming.add(session)
+        eventlet.spawn_n(self._disconnect_reclaimed, session)
+
+    def _disconnect_reclaimed(self, session):
+        logging.debug('Session disconnect (making room for another): %s',
+                      session.device.name)
+        try:
+            session.disconnect()
+        except Exception, e:
+            logging.error('Session disconnect from %s failed. %s: %s',
+                          session.device.name, e.__class__.__name__, str(e))
+        finally:
+            self._reclaiming.discard(session)
+
+    def _track_idle(self, session, deadline=None):
+        """Adds the session to the idle check, unless already tracked.
+
+        Args:
+          session: A session.Session object.
+          deadline: A float, the time to check the session at, or None
+            for the next idle check.
+        """
+        if session in self._idle_tracked:
+            return
+        self._idle_tracked.add(session)
+        heapq.heappush(self._idle_heap,
+                       (deadline or time.time(), self._idle_sequence.next(),
+                        session))
 
     def _session_idle_check(self):
-        """Checks the idle timeouts for all sessions."""
+        """Disconnects sessions idle for longer than their device allows.
+
+        Only sessions whose deadline has passed are examined, in deadline
+        order. Sessions used since their deadline was set go back on the
+        heap with their new deadline. Idle sessions are disconnected in
+        parallel, IDLE_DISCONNECT_CONCURRENCY at a time.
+        """
         start = time.time()
-        for session in self.sessions.values():
-            if session is None:
-                continue
-            elif not session.idle or not session.connected:
-                continue
-            elif (time.time() > (session.time_last_request or 0) +
-                  session.device.MAX_IDLE_TIME):
-                logging.debug('Session disconnect (idle for %d sec): %s',
-                              session.device.MAX_IDLE_TIME,
-                              session.device.name)
-                session.disconnect()
+        if not self._idle_checks % IDLE_RESEED_CHECKS:
+            try:
+                for session in self.sessions.values():
+                    if session is not None and session.connected:
+                        self._track_idle(session, start)
+            except Exception:
+                logging.exception('Idle session tracking failed')
+        self._idle_checks += 1
+
+        while self._idle_heap and self._idle_heap[0][0] <= start:
+            _, _, session = heapq.heappop(self._idle_heap)
+            try:
+                self._check_idle_session(session, start)
+            except Exception:
+                logging.exception('Idle check of session %s failed', session)
+        self._idle_pool.waitall()
         # Re-schedule ourself for execution.
         elapsed = max(0, time.time() - start)
         wait_time = max(0, self._session_maint_period - elapsed)
         eventlet.spawn_after(
             wait_time, self._session_idle_check)
 
+    def _check_idle_session(self, session, now):
+        """Disconnects the session if idle past its deadline, else tracks it."""
+        self._idle_tracked.discard(session)
+        if session.device is None or not session.connected:
+            return
+        elif not session.idle:
+            # Tracked again once the request completes.
+            return
+        elif session.device.name in self.warm_devices:
+            return
+        deadline = ((session.time_last_request or 0) +
+                    session.device.MAX_IDLE_TIME)
+        if deadline > now:
+            self._track_idle(session, deadline)
+        else:
+            self._idle_pool.spawn_n(self._disconnect_idle, session)
+
+    def _disconnect_idle(self, session):
+        logging.debug('Session disconnect (idle for %d sec): %s',
+                      session.device.MAX_IDLE_TIME, session.device.name)
+        try:
+            session.disconnect()
+        except Exception, e:
+            logging.error('Idle session disconnect from %s failed. %s: %s',
+                          session.device.name, e.__class__.__name__, str(e))
+
+    def _liveness_check(self):
+        """Probes the devices of sessions idle for the probe period.
+
+        At most MAX_PROBES_PER_CHECK sessions, those idle longest, are
+        probed per check, so many idle sessions don't flood devices (or
+        the agent) with probes. Sessions that fail the probe are
+        disconnected, and warm pool sessions are then reconnected.
+        """
+        if self._stopped.ready():
+            return
+        start = time.time()
+        due = []
+        for session in self.sessions.values():
+            if session is None or session.device is None:
+                continue
+            elif (not session.connected or not session.idle or
+                  session.probing):
+                continue
+            last_active = session.time_last_active or 0
+            if start - last_active >= self._session_probe_period:
+                due.append((last_active, session))
+        due.sort(key=operator.itemgetter(0))
+        for _, session in due[:MAX_PROBES_PER_CHECK]:
+            self._probe_pool.spawn_n(self._probe_session, session)
+        elapsed = max(0, time.time() - start)
+        wait_time = max(0, self._session_maint_period - elapsed)
+        eventlet.spawn_after(wait_time, self._liveness_check)
+
+    def _probe_session(self, session):
+        """Probes the session's device, reconnecting warm sessions."""
+        if session.probe() is not False:
+            return
+        device_name = session.device.name
+        logging.info('Session to %s failed its liveness probe', device_name)
+        if (device_name in self.warm_devices and
+            device_name not in self._warming):
+            self._warming.add(device_name)
+            self._warm_pool.spawn_n(self._warm_session, device_name)
+
+    def _select_warm_devices(self):
+        """Returns the set of device names the warm pool should connect."""
+        selected = set()
+        if self.warm_regexp:
+            selected |= self.device_manager.devices_matching(self.warm_regexp)
+        if self.warm_pool_size > 0:
+            selected.update(
+                self.device_usage.keys_by_recency()[-self.warm_pool_size:])
+            selected.update(device_name for device_name, _ in heapq.nlargest(
+                self.warm_pool_size, self.device_usage.iteritems(),
+                key=operator.itemgetter(1)))
+        if len(selected) > MAX_WARM_SESSIONS:
+            logging.warn('%d devices selected for the warm pool, using the '
+                         'first %d only', len(selected), MAX_WARM_SESSIONS)
+            selected = set(sorted(selected)[:MAX_WARM_SESSIONS])
+        return selected
+
+    def _warm_check(self):
+        """Connects the sessions of warm pool devices not yet connected."""
+        if self._stopped.ready():
+            return
+        start = time.time()
+        try:
+            self.warm_devices = self._select_warm_devices()
+            for device_name in self._warm_failures.keys():
+                if device_name not in self.warm_devices:
+                    del self._warm_failures[device_name]
+            for device_name in self.warm_devices:
+                failed = self._warm_failures.get(device_name)
+                if device_name in self._warming:
+                    continue
+                elif failed is not None and (
+                    start - failed < WARM_RETRY_INTERVAL_S):
+                    continue
+                self._warming.add(device_name)
+                self._warm_pool.spawn_n(self._warm_session, device_name)
+        except Exception, e:
+            logging.error('Warm pool check failed. %s: %s',
+                          e.__class__.__name__, str(e))
+        elapsed = max(0, time.time() - start)
+        wait_time = max(0, self._session_maint_period - elapsed)
+        eventlet.spawn_after(wait_time, self._warm_check)
+
+    def _warm_session(self, device_name):
+        """Connects the device's (default) session, if idle."""
+        try:
+            session = self.get_session(device_name=device_name)
+            if session is None or session.connected or not session.idle:
+                return
+            elif not self.credentials:
+                return
+            session.credential = self.credentials.get_credential(device_name)
+            logging.debug('Warm pool connecting %s', device_name)
+            # Never wait for (or take) another session's admission slot.
+            session.connect(wait=False)
+            self._warm_failures.pop(device_name, None)
+        except Exception, e:
+            logging.debug('Warm pool connection to %s failed. %s: %s',
+                          device_name, e.__class__.__name__, str(e))
+            self._warm_failures[device_name] = time.time()
+        finally:
+            self._warming.discard(device_name)
+
     def load_credentials(self):
         """Loads the credentials store (login passwords/keys)."""
         self.credentials = None
@@ -144,7 +456,7 @@ class Controller(object):
             device = device_factory.new_device(
                 device_info.device_name, device_info.device_type,
                 addresses=device_info.addresses)
-            return session.Session(device=device)
+            return session.Session(device=device, admission=self.admission)
         else:
             raise notch.agent.errors.NoSuchDeviceError('Unknown device %r'
                                                        % key.device_name)
@@ -193,6 +505,14 @@ class Controller(object):
     def request(self, method, **kwargs):
         """Executes a Notch device API request.
 
+        Identical requests for one of result_cache.CACHEABLE_METHODS
+        (which only read from the device) arriving whilst one is queued
+        or executing share its result, or have its exception raised.
+        Such a request may also give a 'max_age' argument (in seconds).
+        A result cached no longer ago than that is then returned without
+        a device request. Requests for result_cache.WRITE_METHODS discard
+        the device's results.
+
         Args:
           method: A string, the device API method name.
           kwargs: A dict, the keyword arguments for the request.
@@ -203,11 +523,40 @@ class Controller(object):
 
         Raises:
           notch.agent.errors.NoSuchDeviceError if there was no device supplied
+          notch.agent.errors.InvalidRequestError if max_age was invalid.
+          notch.agent.errors.AdmissionQueueFullError or AdmissionTimeoutError
+            if the device's session was not admitted (see admission).
         """
+        max_age = kwargs.pop('max_age', None)
+        if method in result_cache.WRITE_METHODS:
+            device_name = kwargs.get('device_name')
+            self.result_cache.invalidate(device_name)
+            try:
+                return self._request(method, **kwargs)
+            finally:
+                self.result_cache.invalidate(device_name)
+        key = result_cache.ResultCache.key(method, kwargs)
+        if key is None:
+            return self._request(method, **kwargs)
+        execute = functools.partial(self._executions.call, key,
+                                    self._request, method, **kwargs)
+        if max_age is not None:
+            try:
+                max_age = float(max_age)
+            except (TypeError, ValueError):
+                raise notch.agent.errors.InvalidRequestError(
+                    'max_age argument must be a number')
+            return self.result_cache.call(method, kwargs, max_age, execute)
+        return execute()
+
+    def _request(self, method, **kwargs):
+        """Executes a Notch device API request on the device's session."""
         session = self.get_session(**kwargs)
         if session is None:
             raise notch.agent.errors.NoSessionCreatedError(
                 'No session available for request arguments %r' % kwargs)
+        self.device_usage[kwargs['device_name']] = (
+            self.device_usage.get(kwargs['device_name'], 0) + 1)
         if 'device_name' not in kwargs:
                 raise notch.agent.errors.NoSuchDeviceError(
                     'No device_name argument in request')
@@ -228,3 +577,67 @@ class Controller(object):
             # give the developer something to go by.
             logging.error('%s: %s', str(e.__class__), str(e), exc_info=True)
             raise
+        finally:
+            self._track_idle(session)
+
+    def request_matching(self, method, regexp, max_concurrency=None,
+                         timeout=None, stream_callback=None, **kwargs):
+        """Executes a Notch device API request on all matching devices.
+
+        Requests for each device named by the device manager as matching
+        regexp execute concurrently, up to max_concurrency at a time.
+
+        Args:
+          method: A string, the device API method name.
+          regexp: A string, the regular expression matching device names.
+          max_concurrency: An int, the maximum number of devices to work
+            on at once, or None for DEFAULT_FANOUT_CONCURRENCY.
+          timeout: A float, seconds allowed for each device's request,
+            or None for no limit.
+          stream_callback: If not None, a callable passed the device name
+            and each piece of output as it arrives, for methods
+            supporting a callback argument (e.g., command).
+          kwargs: A dict, the keyword arguments for each request (other
+            than device_name).
+
+        Yields:
+          (device_name, result, exception) tuples, in the order the
+          requests complete. One of result or exception is None.
+        """
+        device_names = sorted(self.device_manager.devices_matching(regexp))
+        if not device_names:
+            return
+        kwargs.pop('device_name', None)
+        pool = eventlet.GreenPool(
+            max(1, max_concurrency or DEFAULT_FANOUT_CONCURRENCY))
+        completed = queue.LightQueue()
+
+        def run(device_name):
+            request_kwargs = dict(kwargs)
+            if stream_callback is not None:
+                request_kwargs['callback'] = functools.partial(
+                    stream_callback, device_name)
+            timer = eventlet.Timeout(
+                timeout or None, notch.agent.errors.RequestTimeoutError(
+                    'Request to %r did not complete within %s seconds'
+                    % (device_name, timeout)))
+            try:
+                result = self.request(method, device_name=device_name,
+                                      **request_kwargs)
+                completed.put((device_name, result, None))
+            except Exception, e:
+                completed.put((device_name, None, e))
+            finally:
+                timer.cancel()
+
+        def spawn_all():
+            for device_name in device_names:
+                pool.spawn_n(run, device_name)
+
+        spawner = eventlet.spawn(spawn_all)
+        try:
+            for _ in device_names:
+                yield completed.get()
+        finally:
+            # Stop starting new requests if the consumer went away.
+            spawner.kill()
@@ -28,6 +28,15 @@ import re
 import yaml
 
 import errors
+import lru
+import regexps
+
+
+# Maximum number of hostnames whose credential lookup result is cached.
+CREDENTIAL_CACHE_SIZE = 8192
+
+# Python's re module supports at most 100 groups per regular expression.
+MAX_GROUPS_PER_REGEXP = 99
 
 
 class Credential(object):
@@ -143,6 +152,126 @@ class Credential(object):
             return bool(self.regexp.match(hostname) is not None)
 
 
+class CredentialIndex(object):
+    """An index giving the first credential in a list to match a hostname.
+
+    Credentials whose regexp is a literal hostname, or a literal prefix
+    followed by '.*', are held in dictionaries. The rest are matched by
+    as few combined regular expressions (alternations in credential
+    order) as possible. A credential that can't be combined is matched
+    on its own. The lowest numbered credential matched by any of these
+    is the result, so lookups give the same answer as checking every
+    credential in order.
+    """
+
+    def __init__(self, credentials):
+        """Initialiser.
+
+        Args:
+          credentials: A list of Credential objects, in match order.
+        """
+        self.credentials = credentials
+        # Lower case hostname -> index of first exactly matching credential.
+        self._exact = {}
+        # Lower case prefix -> index of first credential with that prefix.
+        self._prefixes = {}
+        self._prefix_lengths = []
+        # List of (first index, compiled regexp, {marker group: index}).
+        self._combined = []
+        # List of (index, Credential) matched individually.
+        self._linear = []
+        self._build()
+
+    def _build(self):
+        combine = []
+        for index, credential in enumerate(self.credentials):
+            literals = regexps.literals(credential.regexp_string)
+            if literals is not None and literals.exact:
+                self._exact.setdefault(literals.prefix, index)
+            elif literals is not None and literals.prefix_only:
+                self._prefixes.setdefault(literals.prefix, index)
+            elif regexps.combinable(credential.regexp_string):
+                combine.append((index, credential))
+            else:
+                self._linear.append((index, credential))
+        self._prefix_lengths = sorted(set(len(p) for p in self._prefixes))
+
+        chunk = []
+        groups = 0
+        for index, credential in combine:
+            needed = credential.regexp.groups + 1
+            if chunk and groups + needed > MAX_GROUPS_PER_REGEXP:
+                self._add_combined(chunk)
+                chunk = []
+                groups = 0
+            chunk.append((index, credential))
+            groups += needed
+        if chunk:
+            self._add_combined(chunk)
+
+    def _add_combined(self, chunk):
+        """Adds a regexp matching any credential in chunk, first one first.
+
+        Each alternative is followed by an empty marker group. As the
+        marker is the last group closed in a successful alternative, the
+        match's lastindex identifies the credential that matched.
+        """
+        if len(chunk) == 1:
+            self._linear.extend(chunk)
+            self._linear.sort()
+            return
+        alternatives = []
+        markers = {}
+        group = 0
+        for index, credential in chunk:
+            group += credential.regexp.groups + 1
+            markers[group] = index
+            alternatives.append('(?:%s)()' % credential.regexp_string)
+        try:
+            combined = re.compile('|'.join(alternatives), re.I)
+        except re.error:
+            self._linear.extend(chunk)
+            self._linear.sort()
+        else:
+            self._combined.append((chunk[0][0], combined, markers))
+
+    def first_match(self, hostname):
+        """Returns the first Credential matching hostname, or None."""
+        if '\n' in hostname:
+            # '$' also matches before a trailing newline; don't second guess.
+            for credential in self.credentials:
+                if credential.matches(hostname):
+                    return credential
+            return None
+
+        lower = hostname.lower()
+        best = self._exact.get(lower)
+        for length in self._prefix_lengths:
+            if length > len(lower):
+                break
+            index = self._prefixes.get(lower[:length])
+            if index is not None and (best is None or index < best):
+                best = index
+        for first, combined, markers in self._combined:
+            if best is not None and first > best:
+                break
+            match = combined.match(hostname)
+            if match is not None:
+                index = markers[match.lastindex]
+                if best is None or index < best:
+                    best = index
+                break
+        for index, credential in self._linear:
+            if best is not None and index > best:
+                break
+            if credential.matches(hostname):
+                best = index
+                break
+        if best is None:
+            return None
+        return self.credentials[best]
+
+
 class Credentials(object):
     """An abstract credentials information store.
 
@@ -151,10 +280,14 @@ class Credentials(object):
 
     Attributes:
       credentials: A list of Credential objects to match for hosts, in order.
+        Call after_load_credentials() after changing the list in place.
     """
 
     def __init__(self, filename):
         self.credentials = []
+        self._index = None
+        self._cache = lru.LruDict(self._lookup_credential,
+                                  maximum_size=CREDENTIAL_CACHE_SIZE)
         self.filename = filename
         try:
             self.credentials_file = open(filename)
@@ -176,7 +309,12 @@ class Credentials(object):
 
     def after_load_credentials(self):
         """Handles anything required after loading the credentials."""
-        # TODO(afort): Build a cache here for use by get_credential...
+        self._index = CredentialIndex(self.credentials)
+        self._cache.clear()
+
+    def _lookup_credential(self, hostname):
+        """Cache population callback; returns a Credential or None."""
+        return self._index.first_match(hostname)
 
     def get_credential(self, hostname):
         """Gets a Credential object for the hostname supplied.
@@ -193,12 +331,14 @@ class Credentials(object):
         if not hostname:
             raise errors.NoMatchingCredentialError(
                 'No credentials for host %r' % hostname)
-        # TODO(afort): Use an O(1) algorithm.
-        for credential in self.credentials:
-            if credential.matches(hostname):
-                return credential
-        raise errors.NoMatchingCredentialError('No credentials for host %r' %
-                                               hostname)
+        if (self._index is None or
+            self._index.credentials is not self.credentials):
+            self.after_load_credentials()
+        credential = self._cache[hostname]
+        if credential is None:
+            raise errors.NoMatchingCredentialError(
+                'No credentials for host %r' % hostname)
+        return credential
 
 
 class YamlCredentials(Credentials):
@@ -77,4 +77,6 @@ def new_device(name, vendor, addresses=None):
     """
     if vendor not in VENDOR_MAP:
         raise KeyError('Device type/vendor %r is not valid.' % vendor)
-    return VENDOR_MAP[vendor](name=name, addresses=addresses)
+    device = VENDOR_MAP[vendor](name=name, addresses=addresses)
+    device.vendor = vendor
+    return device
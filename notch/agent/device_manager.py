@@ -25,15 +25,31 @@ by every client RPC.
 """
 
 import yaml
+import bisect
 import collections
+import hashlib
+import json
 import logging
+import marshal
 import os
 import re
+import time
+
+import eventlet
+from eventlet import hubs
 # Import the greened socket class for async DNS lookups.
 from eventlet.green import socket
 
+# pyinotify (Linux only) is optional. Without it, router.db files are
+# only rescanned periodically.
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
 import device_factory
 import lru
+import regexps
 
 
 # Information about a device, provided by the device_info
@@ -41,6 +57,225 @@ import lru
 DeviceInfo = collections.namedtuple('DeviceInfo',
                                     'device_name addresses device_type')
 
+# Default maximum number of DNS lookups outstanding during a scan.
+DEFAULT_RESOLVER_CONCURRENCY = 64
+# Default time (in seconds) to cache DNS lookup results for.
+DEFAULT_RESOLVER_TTL_S = 3600.0
+# Maximum number of host names whose addresses are cached.
+RESOLVER_CACHE_SIZE = 131072
+# Version of the inventory snapshot format. Snapshots of other versions
+# are ignored.
+SNAPSHOT_VERSION = 1
+# Default period (in seconds) between rescans of the device sources.
+DEFAULT_RESCAN_PERIOD_S = 300.0
+# Seconds to wait after a watched source file changes before rescanning,
+# allowing a burst of changes (e.g., a RANCID run) to settle.
+WATCH_SETTLE_TIME_S = 2.0
+# Length of the substrings of device names indexed, so literal text of
+# a regexp at least this long narrows the names it is checked against.
+NGRAM_LENGTH = 3
+# Above this many changed devices, the name index re-sorts all names
+# rather than inserting and removing them one at a time.
+INDEX_RESORT_THRESHOLD = 64
+
+# A device's devices_info record and its JSON encoding (a "name": {...}
+# object member), valid whilst info is the provider's DeviceInfo.
+DeviceRecord = collections.namedtuple('DeviceRecord', 'info record fragment')
+
+# A device source file read by a provider: its modification time, a
+# digest of its content, the time its devices' addresses were looked up
+# and the (sorted) names of the devices found in it.
+SourceFile = collections.namedtuple('SourceFile',
+                                    'mtime digest resolved devices')
+
+
+class AddressResolver(object):
+    """Resolves host names to all of their addresses, caching the results.
+
+    Lookups use the green socket module, so many may be outstanding at
+    once. Concurrent lookups of one name share a single query. Failed
+    lookups are not cached.
+    """
+
+    def __init__(self, ttl=DEFAULT_RESOLVER_TTL_S,
+                 maximum_size=RESOLVER_CACHE_SIZE):
+        """Initializer.
+
+        Args:
+          ttl: A float, seconds to cache each name's addresses for.
+          maximum_size: An int, the maximum number of names cached.
+        """
+        self._cache = lru.LruDict(populate_callback=self._lookup,
+                                  maximum_size=maximum_size,
+                                  maximum_age=ttl)
+
+    def _lookup(self, name):
+        addresses = []
+        for family, _, _, _, sockaddr in socket.getaddrinfo(
+            name, None, socket.AF_UNSPEC, socket.SOCK_STREAM):
+            if (family in (socket.AF_INET, socket.AF_INET6) and
+                sockaddr[0] not in addresses):
+                addresses.append(sockaddr[0])
+        if not addresses:
+            raise socket.gaierror('No addresses found for %r' % name)
+        return addresses
+
+    def resolve(self, name):
+        """Returns the IPv4 and IPv6 addresses of a host name.
+
+        Args:
+          name: A string, the host name.
+
+        Returns:
+          A list of one or more IPv4 or IPv6 address strings.
+
+        Raises:
+          socket.gaierror: If there was an error during DNS lookup.
+        """
+        return list(self._cache[name])
+
+    @property
+    def ttl(self):
+        """Seconds each name's addresses are cached for."""
+        return self._cache.maximum_age
+
+
+def ngrams(text):
+    """Returns the set of NGRAM_LENGTH character substrings of text."""
+    return set(text[i:i + NGRAM_LENGTH]
+               for i in xrange(len(text) - NGRAM_LENGTH + 1))
+
+
+class DeviceNameIndex(object):
+    """An index of device names answering anchored regexp queries.
+
+    Lower case device names are held in a sorted list, so the names
+    starting with a query's literal prefix are found by bisection. The
+    names containing each trigram (three character substring) are also
+    held, so the names containing all of the trigrams of a query's
+    literal prefix and infixes are found by intersecting those sets.
+    The smaller of these candidates is checked against the query's
+    regexp. Only queries with no literal text scan every name.
+    """
+
+    def __init__(self, names=()):
+        """Initialiser.
+
+        Args:
+          names: An iterable of strings, the device names to index.
+        """
+        # Sorted list of (lower case name, name).
+        self._sorted = []
+        # Lower case trigram -> set of names containing it.
+        self._ngrams = {}
+        self.update(added=names)
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def update(self, added=(), removed=()):
+        """Adds and removes device names from the index.
+
+        Args:
+          added: An iterable of strings, device names to add.
+          removed: An iterable of strings, device names to remove.
+        """
+        added = set(added)
+        removed = set(removed)
+        if len(added) + len(removed) > INDEX_RESORT_THRESHOLD:
+            names = set(name for _, name in self._sorted)
+            removed.intersection_update(names)
+            added.difference_update(names)
+            names.difference_update(removed)
+            names.update(added)
+            self._sorted = sorted((name.lower(), name) for name in names)
+        else:
+            for name in list(removed):
+                entry = (name.lower(), name)
+                i = bisect.bisect_left(self._sorted, entry)
+                if i < len(self._sorted) and self._sorted[i] == entry:
+                    del self._sorted[i]
+                else:
+                    removed.discard(name)
+            for name in list(added):
+                entry = (name.lower(), name)
+                i = bisect.bisect_left(self._sorted, entry)
+                if i == len(self._sorted) or self._sorted[i] != entry:
+                    self._sorted.insert(i, entry)
+                else:
+                    added.discard(name)
+
+        for name in removed:
+            for ngram in ngrams(name.lower()):
+                names = self._ngrams[ngram]
+                names.discard(name)
+                if not names:
+                    del self._ngrams[ngram]
+        for name in added:
+            for ngram in ngrams(name.lower()):
+                names = self._ngrams.get(ngram)
+                if names is None:
+                    self._ngrams[ngram] = set([name])
+                else:
+                    names.add(name)
+
+    def _prefix_range(self, prefix):
+        """Returns the (start, end) slice of sorted names with prefix."""
+        if not prefix:
+            return 0, len(self._sorted)
+        start = bisect.bisect_left(self._sorted, (prefix,))
+        if prefix[-1] != '\xff':
+            following = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            return start, bisect.bisect_left(self._sorted, (following,),
+                                             start)
+        end = start
+        while (end < len(self._sorted) and
+               self._sorted[end][0].startswith(prefix)):
+            end += 1
+        return start, end
+
+    def match(self, reg):
+        """Returns the set of device names matching a regexp.
+
+        Args:
+          reg: A string, a regular expression matched case-insensitively
+            against the start of each name.
+
+        Returns:
+          A set of strings, the matching device names.
+
+        Raises:
+          re.error: The regular expression is invalid.
+        """
+        regexp = re.compile(reg, re.I)
+        literals = regexps.literals(reg)
+        if literals is None:
+            return set(name for _, name in self._sorted
+                       if regexp.match(name))
+
+        start, end = self._prefix_range(literals.prefix)
+        if literals.exact:
+            return set(name for lower, name in self._sorted[start:end]
+                       if lower == literals.prefix)
+        elif literals.prefix_only:
+            return set(name for _, name in self._sorted[start:end])
+
+        wanted = set()
+        for literal in (literals.prefix,) + literals.infixes:
+            wanted.update(ngrams(literal))
+        contained = []
+        for ngram in wanted:
+            names = self._ngrams.get(ngram)
+            if names is None:
+                return set()
+            contained.append(names)
+        contained.sort(key=len)
+        if contained and len(contained[0]) < end - start:
+            candidates = contained[0].intersection(*contained[1:])
+        else:
+            candidates = (name for _, name in self._sorted[start:end])
+        return set(name for name in candidates if regexp.match(name))
+
 
 class DeviceProvider(object):
     """An abstract provider of device information."""
@@ -48,38 +283,101 @@ class DeviceProvider(object):
     # Override this in sub-classes.
     name = '__abstract__'
 
-    def __init__(self, **kwargs):
+    def __init__(self, resolver_concurrency=DEFAULT_RESOLVER_CONCURRENCY,
+                 resolver_ttl=DEFAULT_RESOLVER_TTL_S, **kwargs):
         """Use only keyword arguments in sub-class initialisers."""
         self._match_cache = lru.LruDict(self._populate_match_cache)
         # DeviceInfo instances keyed by device name.
         self.devices = {}
+        self._index = DeviceNameIndex()
+        # Names of devices added (by add_device) but not yet indexed.
+        self._unindexed = []
+        # DeviceRecord namedtuples keyed by device name.
+        self._records = {}
         self.ready = False
+        self.resolver_concurrency = int(resolver_concurrency)
+        self.resolver = AddressResolver(ttl=float(resolver_ttl))
 
     def _populate_match_cache(self, reg):
         try:
-            regexp = re.compile(reg, re.I)
+            return self._index.match(reg)
         except:
             return frozenset()
-        else:
-            result = set()
-            for device in self.devices.keys():
-                if regexp.match(device):
-                    result.add(device)
-            return result
 
     def address_lookup(self, name):
-        """Performs a synchronous DNS lookup for the requested address.
+        """Performs a (cached) DNS lookup for the requested address.
 
         Args:
           name: A string, a hostname to lookup in the DNS.
 
         Returns:
-          A list of one or more IPv4 dotted-quad address strings.
+          A list of one or more IPv4 or IPv6 address strings.
 
         Raises:
           socket.gaierror: If there was an error during DNS lookup.
         """
-        return socket.gethostbyname(name)
+        return self.resolver.resolve(name)
+
+    def add_device(self, device_info):
+        """Adds (or replaces) a device, making it available immediately.
+
+        New devices are indexed together, when next matched against (or
+        once the scan adding them completes).
+        """
+        is_new = device_info.device_name not in self.devices
+        self.devices[device_info.device_name] = device_info
+        if is_new:
+            self._unindexed.append(device_info.device_name)
+
+    def _index_added(self):
+        """Indexes the devices added since last indexed."""
+        if self._unindexed:
+            added, self._unindexed = self._unindexed, []
+            self._index.update(added=added)
+            self._invalidate_matches(added)
+
+    def update_devices(self, devices):
+        """Replaces all of the devices at once.
+
+        Readers see either the previous or the new devices, never a mix.
+
+        Args:
+          devices: A dict of DeviceInfo namedtuples keyed by device name.
+
+        Returns:
+          A tuple of two sets, the names of the devices added and removed.
+        """
+        self._index_added()
+        added = set(devices).difference(self.devices)
+        removed = set(self.devices).difference(devices)
+        self.devices = devices
+        self._index.update(added=added, removed=removed)
+        for device_name in removed:
+            self._records.pop(device_name, None)
+        self._invalidate_matches(added | removed)
+        return added, removed
+
+    def _invalidate_matches(self, device_names):
+        """Forgets the cached matches affected by the named devices."""
+        if not device_names or not len(self._match_cache):
+            return
+        for reg in self._match_cache.keys():
+            try:
+                regexp = re.compile(reg, re.I)
+            except:
+                continue
+            for device_name in device_names:
+                if regexp.match(device_name):
+                    del self._match_cache[reg]
+                    break
+
+    def watch(self, callback):
+        """Calls callback when the provider's source data changes.
+
+        Returns:
+          A boolean, True if the provider is now watching for changes.
+        """
+        return False
 
     def scan(self):
         """Performs a scan over the source information.
@@ -103,9 +401,68 @@ class DeviceProvider(object):
         """
         return self.devices.get(device_name)
 
+    def device_record(self, device_name):
+        """Returns the devices_info record for a single device.
+
+        Records are built once per DeviceInfo and shared between callers,
+        so must not be modified.
+
+        Args:
+          device_name: A string, the device name to return the record for.
+
+        Returns:
+          A DeviceRecord namedtuple or;
+          None if the device was not found.
+        """
+        device_info = self.devices.get(device_name)
+        if device_info is None:
+            return None
+        cached = self._records.get(device_name)
+        if cached is not None and cached.info is device_info:
+            return cached
+        if isinstance(device_info.addresses, list):
+            addresses = device_info.addresses
+        else:
+            addresses = [device_info.addresses]
+        record = {'device_type': device_info.device_type,
+                  'addresses': addresses}
+        cached = DeviceRecord(
+            info=device_info, record=record,
+            fragment='%s: %s' % (json.dumps(device_name), json.dumps(record)))
+        self._records[device_name] = cached
+        return cached
+
     def devices_matching(self, reg):
+        self._index_added()
         return self._match_cache[reg]
 
+    def snapshot(self):
+        """Returns the provider's state, for DeviceManager.save_snapshot.
+
+        Returns:
+          A dict of builtin types (those the marshal module can write).
+        """
+        return {'devices': [tuple(d) for d in self.devices.itervalues()]}
+
+    def restore(self, snapshot):
+        """Restores state returned by snapshot(), making the provider ready.
+
+        Args:
+          snapshot: A dict, as returned by snapshot().
+
+        Returns:
+          A boolean, True if the state was restored.
+        """
+        devices = dict((d[0], DeviceInfo(*d)) for d in snapshot['devices'])
+        index = DeviceNameIndex(devices)
+        self.devices = devices
+        self._index = index
+        self._unindexed = []
+        self._records.clear()
+        self._match_cache.clear()
+        self.ready = True
+        return True
+
 
 class RancidDeviceProvider(DeviceProvider):
     """A provider of devices sourced from RANCID router.db files.
@@ -121,19 +478,37 @@ class RancidDeviceProvider(DeviceProvider):
         super(RancidDeviceProvider, self).__init__(**kwargs)
         self.root = root
         self.ignore_down_devices = ignore_down_devices
+        # SourceFile tuples keyed by router.db path.
+        self.sources = {}
         if root is None:
             raise ValueError('%s requires "root" keyword argument.'
                              % self.__class__.__name__)
 
-    def _read_router_db(self, router_db):
+    def _read_router_db(self, router_db, pool=None, found=None, add=None):
         """Reads the router.db file provided.
 
+        Device addresses are looked up concurrently on the pool, and
+        each device is added as soon as its addresses are known.
+
         Args:
           router_db: A file or other object that can be iterated over in
             a line-by-line context.
+          pool: An eventlet.GreenPool to look up addresses on. If None,
+            lookups complete before this method returns.
+          found: A dict, if not None, the DeviceInfo of each device found
+            is set in it, keyed by device name.
+          add: A boolean, if True, devices are added to the provider as
+            they are found. Defaults to True if found is None.
+
+        Returns:
+          An int, the number of devices read (and looked up).
         """
-        imported = 0
-        devices = {}
+        wait = pool is None
+        if pool is None:
+            pool = eventlet.GreenPool(self.resolver_concurrency)
+        if add is None:
+            add = found is None
+        read = 0
         for line in router_db:
             # Skip comment lines
             if line.strip().startswith('#'):
@@ -150,41 +525,152 @@ class RancidDeviceProvider(DeviceProvider):
                                   '%r', device_type, line.replace('\n', ''))
                     logging.error('Device skipped. Valid device types are: %s',
                                   ', '.join(device_factory.VENDOR_MAP.keys()))
-                    
-                try:
-                    addresses = self.address_lookup(device_name)
-                except socket.gaierror:
-                    # Devices without an address aren't cared about.
-                    continue
-                else:
-                    devices[device_name] = DeviceInfo(
-                        device_name=device_name, addresses=addresses,
-                        device_type=device_type)
-                    imported += 1
-        self.devices.update(devices)
+
+                pool.spawn_n(self._lookup_device, device_name, device_type,
+                             found, add)
+                read += 1
+        if wait:
+            pool.waitall()
+            self._index_added()
         self.ready = True
-        return imported
+        return read
+
+    def _lookup_device(self, device_name, device_type, found=None, add=True):
+        """Looks up the device's addresses, noting it if it has any."""
+        try:
+            addresses = self.address_lookup(device_name)
+        except (socket.error, UnicodeError):
+            # Devices without an address aren't cared about.
+            return
+        device_info = DeviceInfo(device_name=device_name, addresses=addresses,
+                                 device_type=device_type)
+        if found is not None:
+            found[device_name] = device_info
+        if add:
+            self.add_device(device_info)
 
     def scan(self):
-        """Scans the root path for router.db files and loads them."""
-        loaded = imported = 0
+        """Scans the root path for router.db files and loads them.
+
+        Only files changed since they were last read (e.g., before a
+        restored snapshot was taken) are parsed again, and files whose
+        devices' addresses were looked up longer ago than the resolver
+        TTL. Changes are applied to the devices at once, when the scan
+        is complete. On the first scan, devices are instead added as
+        soon as their addresses are known.
+        """
+        first_scan = not self.ready
+        loaded = read = 0
+        pool = eventlet.GreenPool(self.resolver_concurrency)
+        sources = {}
+        found = {}
         for root, dirs, files in os.walk(self.root):
             # Skip CVS directories.
             if 'CVS' in dirs:
                 dirs.remove('CVS')
-            if 'router.db' in files:
-                path = os.path.join(root, 'router.db')
+            if 'router.db' not in files:
+                continue
+            path = os.path.join(root, 'router.db')
+            source = self.sources.get(path)
+            fresh = (source is not None and
+                     time.time() - source.resolved < self.resolver.ttl)
+            try:
+                mtime = os.stat(path).st_mtime
+                if fresh and source.mtime == mtime:
+                    sources[path] = source
+                    continue
+                router_db_file = open(path)
                 try:
-                    router_db_file = open(path)
-                    imported += self._read_router_db(router_db_file)
+                    content = router_db_file.read()
+                finally:
                     router_db_file.close()
-                    loaded += 1
-                except (IOError, OSError), e:
-                    logging.error('Error occured reading %r. %s: %s', path,
-                                  e.__class__.__name__, e[1])
-                    continue
-        logging.debug('%s imported %d router.db files [%d devices].',
-                      self.__class__.__name__, loaded, imported)
+            except (IOError, OSError), e:
+                logging.error('Error occured reading %r. %s: %s', path,
+                              e.__class__.__name__, e[1])
+                continue
+            digest = hashlib.sha1(content).hexdigest()
+            if fresh and source.digest == digest:
+                # Touched, but not changed.
+                sources[path] = source._replace(mtime=mtime)
+                continue
+            found[path] = {}
+            sources[path] = SourceFile(mtime, digest, time.time(), ())
+            # On the first scan, serve devices as soon as they're found.
+            read += self._read_router_db(content.splitlines(True),
+                                         pool=pool, found=found[path],
+                                         add=first_scan)
+            loaded += 1
+        pool.waitall()
+
+        # Compose the devices from the unchanged and the changed files.
+        devices = {}
+        for path, source in sources.iteritems():
+            if path not in found:
+                for device_name in source.devices:
+                    device_info = self.devices.get(device_name)
+                    if device_info is not None:
+                        devices[device_name] = device_info
+        for path, file_devices in found.iteritems():
+            devices.update(file_devices)
+            sources[path] = sources[path]._replace(
+                devices=tuple(sorted(file_devices)))
+        added, removed = self.update_devices(devices)
+        self.sources = sources
+        self.ready = True
+        logging.debug('%s imported %d router.db files [%d devices read, '
+                      '%d devices known, %d added, %d removed]. '
+                      '%d router.db files unchanged.',
+                      self.__class__.__name__, loaded, read,
+                      len(self.devices), len(added), len(removed),
+                      len(sources) - loaded)
+
+    def watch(self, callback):
+        if pyinotify is None:
+            return False
+        watch_manager = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(
+            watch_manager,
+            default_proc_fun=lambda event: self._watch_event(event, callback))
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE |
+                pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+                pyinotify.IN_MOVED_TO)
+        watch_manager.add_watch(self.root, mask, rec=True, auto_add=True)
+        eventlet.spawn_n(self._watch_events, watch_manager, notifier)
+        logging.debug('%s watching %r for changes',
+                      self.__class__.__name__, self.root)
+        return True
+
+    def _watch_events(self, watch_manager, notifier):
+        """Reads inotify events as they arrive; run in a greenthread."""
+        fd = watch_manager.get_fd()
+        while True:
+            hubs.trampoline(fd, read=True)
+            notifier.read_events()
+            notifier.process_events()
+
+    def _watch_event(self, event, callback):
+        if event.dir or event.name == 'router.db':
+            callback()
+
+    def snapshot(self):
+        result = super(RancidDeviceProvider, self).snapshot()
+        result['root'] = self.root
+        result['ignore_down_devices'] = self.ignore_down_devices
+        result['sources'] = dict((path, tuple(source)) for path, source
+                                 in self.sources.iteritems())
+        return result
+
+    def restore(self, snapshot):
+        # Only restore snapshots of the same configuration.
+        if (snapshot.get('root') != self.root or
+            snapshot.get('ignore_down_devices') != self.ignore_down_devices):
+            return False
+        sources = dict((path, SourceFile(*source)) for path, source
+                       in snapshot['sources'].iteritems())
+        restored = super(RancidDeviceProvider, self).restore(snapshot)
+        if restored:
+            self.sources = sources
+        return restored
 
 
 class DeviceManager(object):
@@ -195,13 +681,21 @@ class DeviceManager(object):
       config: A dict, the system configuration (e.g., via YAML import).
     """
 
-    # TODO(afort): Set self.serve_ready to false every X minutes to update data.
     provider_classes = (RancidDeviceProvider, )
     config_section = 'device_sources'
 
     def __init__(self, config=None):
         self.providers = {}
+        # The providers in priority order, or None to sort them again.
+        self._provider_order = None
         self.serve_ready = False
+        self.snapshot_path = None
+        self.rescan_period = DEFAULT_RESCAN_PERIOD_S
+        # An eventlet.event.Event sent once the scan in progress (if any)
+        # completes.
+        self._scanning = None
+        self._rescan_timer = None
+        self._watch_timer = None
         if config:
             self.config = config
             logging.debug('Reading configuration for device manager')
@@ -210,6 +704,7 @@ class DeviceManager(object):
     def add_providers(self, device_sources):
         """Adds providers from the configuration."""
         self.serve_ready = False
+        self._provider_order = None
         if not device_sources:
             logging.error('No device source provider configuration.')
             return None
@@ -254,23 +749,196 @@ class DeviceManager(object):
         config = config or self.config
         if config:
             self.add_providers(config.get(self.__class__.config_section))
+            options = config.get('options') or {}
+            self.snapshot_path = options.get('inventory_snapshot')
+            try:
+                self.rescan_period = float(options.get(
+                    'inventory_rescan_period', DEFAULT_RESCAN_PERIOD_S))
+            except (TypeError, ValueError):
+                self.rescan_period = DEFAULT_RESCAN_PERIOD_S
+            if self.snapshot_path:
+                self.load_snapshot()
         else:
             logging.error('No configuration found to load.')
 
+    def load_snapshot(self, path=None):
+        """Restores the providers from an inventory snapshot file.
+
+        If every provider is restored, the manager is ready to serve
+        immediately. Call rescan() to reconcile the providers with their
+        sources afterwards.
+
+        Args:
+          path: A string, the snapshot file path, or None to use the
+            snapshot_path attribute.
+
+        Returns:
+          A boolean, True if all providers were restored.
+        """
+        path = path or self.snapshot_path
+        try:
+            snapshot_file = open(path, 'rb')
+            try:
+                # Unlike pickle, marshal only reads builtin types.
+                snapshot = marshal.load(snapshot_file)
+            finally:
+                snapshot_file.close()
+        except (IOError, OSError, EOFError, TypeError, ValueError), e:
+            logging.debug('No inventory snapshot loaded from %r. %s: %s',
+                          path, e.__class__.__name__, str(e))
+            return False
+        if (not isinstance(snapshot, dict) or
+            snapshot.get('version') != SNAPSHOT_VERSION):
+            logging.error('Ignoring inventory snapshot %r of unknown version',
+                          path)
+            return False
+        restored = 0
+        for (_, source_name), provider in self.providers.iteritems():
+            # Treat any malformed snapshot as no snapshot, rather than
+            # stopping the agent from starting.
+            try:
+                provider_snapshot = snapshot['providers'].get(source_name)
+                if (provider_snapshot is not None and
+                    provider_snapshot.get('provider') == provider.name and
+                    provider.restore(provider_snapshot)):
+                    restored += 1
+            except Exception, e:
+                logging.error('Ignoring malformed inventory snapshot %r of '
+                              '%s. %s: %s', path, source_name,
+                              e.__class__.__name__, str(e))
+        logging.debug('Restored %d of %d device sources from inventory '
+                      'snapshot %r', restored, len(self.providers), path)
+        if self.providers and restored == len(self.providers):
+            self.serve_ready = True
+        return self.serve_ready
+
+    def save_snapshot(self, path=None):
+        """Writes an inventory snapshot file, if a path is configured.
+
+        The file is replaced atomically, so readers never see a partial
+        snapshot.
+
+        Args:
+          path: A string, the snapshot file path, or None to use the
+            snapshot_path attribute.
+        """
+        path = path or self.snapshot_path
+        if not path:
+            return
+        providers = {}
+        for (_, source_name), provider in self.providers.iteritems():
+            providers[source_name] = provider.snapshot()
+            providers[source_name]['provider'] = provider.name
+        snapshot = {'version': SNAPSHOT_VERSION, 'providers': providers}
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            snapshot_file = open(temp_path, 'wb')
+            try:
+                marshal.dump(snapshot, snapshot_file)
+            finally:
+                snapshot_file.close()
+            os.rename(temp_path, path)
+        except (IOError, OSError, ValueError), e:
+            logging.error('Error writing inventory snapshot %r. %s: %s',
+                          path, e.__class__.__name__, str(e))
+
     def scan_providers(self):
-        """Scans all the providers to populate their indices."""
+        """Scans all the providers to populate their indices.
+
+        If another greenthread is already scanning, waits for it to finish.
+        """
         if self.serve_ready:
             return
-        for provider in self.providers.values():
-            if not provider.ready:
+        self.rescan()
+
+    def rescan(self):
+        """Rescans all the providers, then saves an inventory snapshot.
+
+        Devices remain available whilst the providers are rescanned. If
+        another greenthread is already scanning, waits for it to finish.
+        """
+        if self._scanning is not None:
+            self._scanning.wait()
+            return
+        self._scanning = eventlet.event.Event()
+        try:
+            for provider in self.providers.values():
                 provider.scan()
-        self.serve_ready = True
+            self.serve_ready = True
+        finally:
+            scanning, self._scanning = self._scanning, None
+            scanning.send()
+        self.save_snapshot()
+
+    def start_rescans(self):
+        """Starts rescanning providers periodically, and when they change.
+
+        Providers able to watch their sources (e.g., using inotify) are
+        rescanned shortly after a change. All providers are rescanned
+        every rescan_period seconds (unless it is zero).
+        """
+        for provider in self.providers.values():
+            provider.watch(self._source_changed)
+        self._schedule_rescan()
+
+    def stop_rescans(self):
+        """Stops periodic rescans."""
+        for timer in (self._rescan_timer, self._watch_timer):
+            if timer is not None:
+                timer.cancel()
+        self._rescan_timer = self._watch_timer = None
+
+    def _schedule_rescan(self):
+        if self.rescan_period:
+            self._rescan_timer = eventlet.spawn_after(self.rescan_period,
+                                                      self._periodic_rescan)
+
+    def _periodic_rescan(self):
+        try:
+            self.rescan()
+        finally:
+            self._schedule_rescan()
+
+    def _source_changed(self):
+        """Schedules a rescan, once changes to a source have settled."""
+        if self._watch_timer is None:
+            self._watch_timer = eventlet.spawn_after(WATCH_SETTLE_TIME_S,
+                                                     self._watched_rescan)
+
+    def _watched_rescan(self):
+        self._watch_timer = None
+        self.rescan()
+
+    def _providers_by_priority(self):
+        """Returns the providers, lower priority numbers first."""
+        if (self._provider_order is None or
+            len(self._provider_order) != len(self.providers)):
+            self._provider_order = [provider for _, provider in
+                                    sorted(self.providers.iteritems())]
+        return self._provider_order
+
+    def _device_info(self, device_name):
+        for provider in self._providers_by_priority():
+            result = provider.device_info(device_name)
+            if result is not None:
+                return result
+
+    def _device_records(self, device_names):
+        """Yields the DeviceRecord of each named device that is known."""
+        providers = self._providers_by_priority()
+        for device_name in device_names:
+            for provider in providers:
+                record = provider.device_record(device_name)
+                if record is not None:
+                    yield record
+                    break
 
     def device_info(self, device_name):
         """Returns any known information about a single requested device.
 
         All device providers are consulted for the device information,
-        lower priority number sources are preferred.
+        lower priority number sources are preferred. Whilst providers are
+        being scanned, devices already found are returned immediately.
 
         Args:
           device_name: A string, the device name to return info for.
@@ -279,11 +947,12 @@ class DeviceManager(object):
           A DeviceInfo namedtuple or;
           None if the device was not found.
         """
-        self.scan_providers()
-        for _, provider in sorted(self.providers.iteritems()):
-            result = provider.device_info(device_name)
+        if self._scanning is not None:
+            result = self._device_info(device_name)
             if result is not None:
                 return result
+        self.scan_providers()
+        return self._device_info(device_name)
 
     def devices_matching(self, regexp):
         """Returns a set of device names matching the regexp.
@@ -300,6 +969,40 @@ class DeviceManager(object):
         if not regexp.endswith('$'):
             regexp += '$'
         result = set()
-        for _, provider in sorted(self.providers.iteritems()):
+        for provider in self._providers_by_priority():
             result |= provider.devices_matching(regexp)
         return result
+
+    def devices_info_many(self, device_names):
+        """Returns the information about many devices at once.
+
+        As for device_info, higher priority providers are preferred.
+
+        Args:
+          device_names: An iterable of strings, the device names.
+
+        Returns:
+          A dict of device name strings to dicts with 'device_type' and
+          'addresses' (a list of strings) keys. The dicts are shared with
+          other callers, so must not be modified. Unknown devices are
+          omitted.
+        """
+        self.scan_providers()
+        return dict((record.info.device_name, record.record)
+                    for record in self._device_records(device_names))
+
+    def devices_info_json(self, device_names):
+        """Returns the result of devices_info_many as a JSON object string.
+
+        The object is assembled from each device's cached encoding, so
+        large inventories are encoded without per-device overhead.
+
+        Args:
+          device_names: An iterable of strings, the device names.
+
+        Returns:
+          A string, a JSON object keyed by the device names, in order.
+        """
+        self.scan_providers()
+        return '{%s}' % ', '.join(record.fragment for record in
+                                  self._device_records(device_names))
@@ -106,13 +106,14 @@ class ArborDevice(device.Device):
         except (OSError, EOFError, notch.agent.errors.CommandError):
             return
 
-    def _command(self, command, mode=None):
+    def _command(self, command, mode=None, callback=None):
         # mode argument is as yet unused. Quieten pylint.
         _ = mode
         try:
             return self._transport.command(command, self._prompt,
                                            expect_command=True,
-                                           expect_trailer='(\r\n|\n|\r)+')
+                                           expect_trailer='(\r\n|\n|\r)+',
+                                           callback=callback)
         except (OSError, EOFError, pexpect.EOF,
                 notch.agent.errors.CommandError), e:
             if command != 'exit':
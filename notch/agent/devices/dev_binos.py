@@ -28,13 +28,14 @@ class BinosDevice(dev_ios.IosDevice):
     Similar to an IOS device.
     """
 
-    def _command(self, command, mode=None):
+    def _command(self, command, mode=None, callback=None):
         # mode argument is as yet unused. Quieten pylint.
         _ = mode
         try:
             return self._transport.command(command, self._prompt,
                                            expect_trailer='\n',
-                                           expect_command=False)
+                                           expect_command=False,
+                                           callback=callback)
         except (OSError, EOFError, pexpect.EOF, pexpect.TIMEOUT), e:
             if command in ('logout', 'exit'):
                 pass
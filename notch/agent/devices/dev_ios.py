@@ -199,11 +199,12 @@ class IosDevice(device.Device):
         self._transport.command(self.CMD_DISABLE_PAGING, self._prompt)
         logging.debug('Disabled pager on %r', self.name)
 
-    def _command(self, command, mode=None):
+    def _command(self, command, mode=None, callback=None):
         # mode argument is as yet unused. Quieten pylint.
         _ = mode
         try:
-            return self._transport.command(command, self._prompt)
+            return self._transport.command(command, self._prompt,
+                                           callback=callback)
         except (OSError, EOFError, pexpect.EOF), e:
             if command in ('logout', 'exit'):
                 pass
@@ -66,11 +66,12 @@ class ScreenosDevice(dev_ios.IosDevice):
         else:
             self._transport.disconnect()
 
-    def _command(self, command, mode=None):
+    def _command(self, command, mode=None, callback=None):
         # mode argument is as yet unused. Quieten pylint.
         _ = mode
         try:
-            return self._transport.command(command, self._prompt)
+            return self._transport.command(command, self._prompt,
+                                           callback=callback)
         except (OSError, EOFError, pexpect.EOF), e:
             if command in ('logout', 'exit'):
                 pass
@@ -66,14 +66,15 @@ class BayDevice(dev_ios.IosDevice):
         else:
             self._transport.disconnect()
 
-    def _command(self, command, mode=None):
+    def _command(self, command, mode=None, callback=None):
         # mode argument is as yet unused. Quieten pylint.
         _ = mode
         try:
             return self._transport.command(command, self._prompt,
                                            expect_trailer='\r',
                                            pager=self.PAGER,
-                                           strip_chars=['\b ','\b'])
+                                           strip_chars=['\b ','\b'],
+                                           callback=callback)
         except (OSError, EOFError, pexpect.EOF, pexpect.TIMEOUT), e:
             if command in ('logout', 'exit'):
                 pass
@@ -21,6 +21,8 @@ import os
 import socket
 import tempfile
 
+from eventlet import semaphore
+from eventlet.green import select
 import paramiko
 
 import notch.agent.errors
@@ -29,17 +31,29 @@ import device
 import scp
 
 
+# Size (in bytes) of the reads made when streaming command output or
+# configuration files to a callback.
+STREAM_READ_SIZE = 65536
+
+
 class ParamikoDevice(device.Device):
     """Generic paramiko SSHv2 device model."""
 
     DEFAULT_CONNECT_METHOD = 'sshv2'
     DEFAULT_PORT = 22
 
+    # Each request opens its own channel on the one authenticated
+    # transport, so requests may be multiplexed over the connection.
+    # Override in vendor classes with lower (or higher) channel limits.
+    MAX_CONCURRENT_REQUESTS = 4
+
     def __init__(self, name=None, addresses=None):
         super(ParamikoDevice, self).__init__(name=name, addresses=addresses)
         self.connect_methods = ('sshv2', )
         self._ssh_client = None
         self._port = None
+        # Held whilst checking (and maybe re-establishing) the transport.
+        self._transport_lock = semaphore.Semaphore()
 
     def _reconnect(self):
         self._connect(address=self.__address,
@@ -80,18 +94,42 @@ class ParamikoDevice(device.Device):
             raise notch.agent.errors.ConnectError(str(e))
 
     def _disconnect(self):
-        self._ssh_client.close()
-        self._ssh_client = None
+        if self._ssh_client is not None:
+            self._ssh_client.close()
+            self._ssh_client = None
 
-    def __check_transport(self):
+    def _alive(self):
+        # Send an SSH keepalive (ignored by the server), without opening
+        # a channel.
+        if self._ssh_client is None:
+            return False
         transport = self._ssh_client.get_transport()
-        if transport is None:
-            self._reconnect()
-            transport = self._ssh_client.get_transport()
-        elif transport is not None and not transport.is_active():
-            self._reconnect()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (paramiko.ssh_exception.SSHException, EOFError, socket.error):
+            return False
+        return transport.is_active()
+
+    def __check_transport(self):
+        self._transport_lock.acquire()
+        try:
+            if self._ssh_client is None:
+                # Disconnected underneath us (e.g., by the session after
+                # another request's error); the session may retry.
+                raise notch.agent.errors.EOFError(
+                    'Disconnected from %s during request' % self.name)
             transport = self._ssh_client.get_transport()
-        return transport
+            if transport is None:
+                self._reconnect()
+                transport = self._ssh_client.get_transport()
+            elif transport is not None and not transport.is_active():
+                self._reconnect()
+                transport = self._ssh_client.get_transport()
+            return transport
+        finally:
+            self._transport_lock.release()
 
     def _exec_command(self, command, bufsize=-1, combine_stderr=False,
                       timeout=None):
@@ -107,7 +145,7 @@ class ParamikoDevice(device.Device):
         stderr = channel.makefile_stderr('rb', bufsize)
         return stdin, stdout, stderr
 
-    def _command(self, command, mode=None):
+    def _command(self, command, mode=None, callback=None):
         # mode argument is as yet unused. Quieten pylint.
         _ = mode
         try:
@@ -121,11 +159,37 @@ class ParamikoDevice(device.Device):
         else:
             stdin.close()
         try:
-            return ''.join(stdout.readlines())
+            output = []
+            while True:
+                data = self._recv(stdout.channel)
+                if not data:
+                    return ''.join(output)
+                elif callback is None:
+                    output.append(data)
+                else:
+                    # Pass on output as the channel receives it.
+                    callback(data)
         finally:
             stdout.close()
             stderr.close()
 
+    def _recv(self, channel):
+        """Returns the next output received on channel, or '' at its end.
+
+        Channel reads wait on a (real) threading.Condition, which would
+        block every greenthread, so wait for output using green select
+        on the channel first.
+
+        Raises:
+          socket.timeout: No output arrived within the channel's timeout.
+        """
+        timeout = channel.gettimeout()
+        while not (channel.recv_ready() or channel.eof_received or
+                   channel.closed):
+            if not select.select([channel], [], [], timeout)[0]:
+                raise socket.timeout()
+        return channel.recv(STREAM_READ_SIZE)
+
     def download_file(self, source, destination, mode=None, overwrite=False):
         if not overwrite:
             if not os.path.exists(destination):
@@ -148,8 +212,14 @@ class ParamikoDevice(device.Device):
         except scp.ScpError, e:
             raise notch.agent.errors.DownloadError(str(e))
 
-    def get_config(self, source, mode=None):
+    def get_config(self, source, mode=None, callback=None):
         tf = tempfile.NamedTemporaryFile()
         self.download_file(source, tf.name, mode=mode)
         tf.seek(0)
-        return tf.read()
+        if callback is None:
+            return tf.read()
+        while True:
+            data = tf.read(STREAM_READ_SIZE)
+            if not data:
+                return ''
+            callback(data)
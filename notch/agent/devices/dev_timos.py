@@ -123,14 +123,15 @@ class TimosDevice(device.Device):
                                 command_trailer='\r', expect_trailer='')
         logging.debug('Disabled pager on %r', self.name)
 
-    def _command(self, command, mode=None):
+    def _command(self, command, mode=None, callback=None):
         # mode argument is as yet unused. Quieten pylint.
         _ = mode
         try:
             return self._transport.command(command, self._prompt,
                                            expect_command=False,
                                            command_trailer='\r',
-                                           expect_trailer='[^\r]*\r\n')
+                                           expect_trailer='[^\r]*\r\n',
+                                           callback=callback)
         except (OSError, EOFError, pexpect.EOF), e:
             if command != 'logout':
                 exc = notch.agent.errors.CommandError(str(e))
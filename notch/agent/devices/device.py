@@ -51,6 +51,11 @@ class Device(object):
     # Default connect method for this device, e.g., 'sshv2' or 'telnet'
     DEFAULT_CONNECT_METHOD = None
 
+    # Number of requests a session may execute on the device at once.
+    # Only raise this for device models whose requests each use their own
+    # channel over a shared connection (e.g., SSHv2 exec sessions).
+    MAX_CONCURRENT_REQUESTS = 1
+
     # Timeout values used by session to determine liveness/etc.
     # Override as required in concrete device classes.
     MAX_IDLE_TIME = 900.0
@@ -179,16 +184,56 @@ class Device(object):
         """Sub-classes implement concrete disconnection method here."""
         raise NotImplementedError
 
-    def _command(self, command, mode=None):
+    def alive(self):
+        """Returns True if the connected device responds to a cheap probe.
+
+        Used to find dead connections before a request is made on them.
+        """
+        if not self._connected:
+            return False
+        return self._alive()
+
+    def _alive(self):
+        """Implements the liveness probe.
+
+        Device models holding an expect transport (as _transport) and the
+        CLI prompt (as _prompt) send an empty line and expect the prompt.
+        Other models override this, or are assumed to be alive.
+        """
+        transport = getattr(self, '_transport', None)
+        prompt = getattr(self, '_prompt', None)
+        if transport is None or prompt is None:
+            return True
+        return transport.probe(prompt)
+
+    def _command(self, command, mode=None, callback=None):
         """Implements the execution of a command on the device."""
         raise NotImplementedError
 
-    def command(self, command, mode=None):
-        """Executes a command on the device."""
-        return self._command(command, mode=mode)
+    def command(self, command, mode=None, callback=None):
+        """Executes a command on the device.
 
-    def get_config(self, source, mode=None):
-        """Gets the configuration of the source in the desired mode."""
+        Args:
+          command: A string, the command to execute.
+          mode: A string, the command mode, or None for the default.
+          callback: If not None, a callable passed the command output (a
+            string argument) in pieces as it arrives, in which case the
+            returned output is empty.
+
+        Returns:
+          A string, the command output.
+        """
+        if callback is None:
+            return self._command(command, mode=mode)
+        else:
+            return self._command(command, mode=mode, callback=callback)
+
+    def get_config(self, source, mode=None, callback=None):
+        """Gets the configuration of the source in the desired mode.
+
+        If callback is not None, the configuration is passed to it in
+        pieces (as for command) and the returned configuration is empty.
+        """
         raise NotImplementedError
 
     def set_config(self, destination, config_data, mode=None):
@@ -15,10 +15,18 @@
 # under the License.
 
 import select
+import time
 
 import pexpect
 
 
+# The smallest and largest sizes of a single channel read, in bytes.
+# Reads grow towards the channel's receive window while output keeps
+# arriving, and shrink back once it trickles.
+MIN_RECV_SIZE = 4096
+MAX_RECV_SIZE = 1024 * 1024
+
+
 class ParamikoSpawn(pexpect.spawn):
     """A pexpect.spawn that works with Paramiko Channel objects.
 
@@ -27,10 +35,16 @@ class ParamikoSpawn(pexpect.spawn):
 
     Attributes:
       child_fd: A paramiko.Channel object, the SSH channel (like a socket).
+      recv_size: An int, the size of the next read made by expect().
     """
 
+    def __init__(self, *args, **kwargs):
+        super(ParamikoSpawn, self).__init__(*args, **kwargs)
+        self.recv_size = MIN_RECV_SIZE
+
     def _set_channel(self, channel):
         self.child_fd = channel
+        self.recv_size = MIN_RECV_SIZE
 
     channel = property(lambda x: x.child_fd, _set_channel)
 
@@ -44,44 +58,160 @@ class ParamikoSpawn(pexpect.spawn):
         except AttributeError:
             return False
 
+    def _max_recv_size(self):
+        window = getattr(self.child_fd, 'in_window_size', 0)
+        if window > 0:
+            return max(MIN_RECV_SIZE, min(window, MAX_RECV_SIZE))
+        return MAX_RECV_SIZE
+
+    def _adapt_recv_size(self, received):
+        """Grows the read size while reads fill it, shrinks it when they don't.
+
+        Args:
+          received: An int, the number of bytes the last read returned.
+        """
+        if received >= self.recv_size:
+            self.recv_size = min(self.recv_size * 2, self._max_recv_size())
+        elif received < self.recv_size // 4:
+            self.recv_size = max(self.recv_size // 2, MIN_RECV_SIZE)
+
+    def _recv(self, size):
+        try:
+            s = self.child_fd.recv(size)
+        except OSError, e:
+            self.flag_eof = True
+            raise pexpect.EOF('End Of File (EOF) in read(). '
+                              'Exception style platform.')
+        if s == '':
+            self.flag_eof = True
+            raise pexpect.EOF('End Of File (EOF) in read(). '
+                              'Empty string style platform.')
+        return s
+
     def read_nonblocking(self, size=-1, timeout=-1):
+        """Reads up to size bytes, draining all data the channel has ready.
+
+        The channel is only selected on when it has no data buffered, so
+        a busy channel is read without a select call per read.
+        """
         if self.child_fd == -1:
             raise ValueError('I/O operation on closed file')
 
-        if not self.isalive():
-            r, w, e = select.select([self.child_fd], [], [], 0)
+        if size < 0:
+            size = self.recv_size
+
+        channel = self.child_fd
+        if not channel.recv_ready():
+            if not self.isalive():
+                r, w, e = select.select([channel], [], [], 0)
+                if not r:
+                    self.flag_eof = True
+                    raise pexpect.EOF('End Of File (EOF) in read(). '
+                                      'Braindead platform.')
+
+            if timeout == -1:
+                timeout = self.timeout
+
+            r, w, e = select.select([channel], [], [], timeout)
             if not r:
-                self.flag_eof = True
-                raise pexpect.EOF('End Of File (EOF) in read(). '
-                                  'Braindead platform.')
+                raise pexpect.TIMEOUT('Timeout (%s) exceeded in read().' %
+                                      str(timeout))
+            if channel not in r:
+                raise pexpect.ExceptionPexpect(
+                    'Reached an unexpected state in read().')
+
+        s = self._recv(size)
+        if len(s) < size and channel.recv_ready():
+            chunks = [s]
+            received = len(s)
+            while received < size and channel.recv_ready():
+                chunk = channel.recv(size - received)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                received += len(chunk)
+            s = ''.join(chunks)
+
+        if self.logfile is not None:
+            self.logfile.write(s)
+            self.logfile.flush()
+
+        return s
+
+    def expect_loop(self, searcher, timeout=-1, searchwindowsize=-1):
+        """The loop used by expect(), accumulating output in a bytearray.
+
+        pexpect.spawn.expect_loop concatenates strings for every read,
+        copying the whole buffer each time. Here reads are appended in
+        place, with read sizes adapted to the rate output arrives at.
+        Matches are returned as strings, as pexpect.spawn returns them.
+        """
+        self.searcher = searcher
 
         if timeout == -1:
             timeout = self.timeout
+        if timeout is not None:
+            end_time = time.time() + timeout
+        if searchwindowsize == -1:
+            searchwindowsize = self.searchwindowsize
 
-        r, w, e = select.select([self.child_fd], [], [], timeout)
-        if not r:
-            raise pexpect.TIMEOUT('Timeout (%s) exceeded in read().' %
-                                  str(timeout))
-
-        if self.child_fd in r:
-            try:
-                s = self.child_fd.recv(size)
-            except OSError, e:
-                self.flag_eof = True
-                raise pexpect.EOF('End Of File (EOF) in read(). '
-                                  'Exception style platform.')
-            if s == '':
-                self.flag_eof = True
-                raise pexpect.EOF('End Of File (EOF) in read(). '
-                                  'Empty string style platform.')
-
-            if self.logfile is not None:
-                self.logfile.write(s)
-                self.logfile.flush()
-
-            return s
-
-        raise pexpect.ExceptionPexpect('Reached an unexpected state in read().')
+        incoming = bytearray(self.buffer)
+        try:
+            freshlen = len(incoming)
+            while True:
+                index = searcher.search(incoming, freshlen, searchwindowsize)
+                if index >= 0:
+                    text = str(incoming)
+                    match = searcher.match
+                    if hasattr(match, 're'):
+                        # Re-match on the string so groups are strings.
+                        match = match.re.match(text, searcher.start)
+                    self.buffer = text[searcher.end:]
+                    self.before = text[:searcher.start]
+                    self.after = text[searcher.start:searcher.end]
+                    self.match = match
+                    self.match_index = index
+                    return self.match_index
+                if timeout is not None and timeout < 0:
+                    raise pexpect.TIMEOUT('Timeout exceeded in expect_any().')
+                c = self.read_nonblocking(self.recv_size, timeout)
+                self._adapt_recv_size(len(c))
+                freshlen = len(c)
+                incoming.extend(c)
+                if timeout is not None:
+                    timeout = end_time - time.time()
+        except pexpect.EOF, e:
+            self.buffer = ''
+            self.before = str(incoming)
+            self.after = pexpect.EOF
+            index = searcher.eof_index
+            if index >= 0:
+                self.match = pexpect.EOF
+                self.match_index = index
+                return self.match_index
+            else:
+                self.match = None
+                self.match_index = None
+                raise pexpect.EOF(str(e) + '\n' + str(self))
+        except pexpect.TIMEOUT, e:
+            self.buffer = str(incoming)
+            self.before = self.buffer
+            self.after = pexpect.TIMEOUT
+            index = searcher.timeout_index
+            if index >= 0:
+                self.match = pexpect.TIMEOUT
+                self.match_index = index
+                return self.match_index
+            else:
+                self.match = None
+                self.match_index = None
+                raise pexpect.TIMEOUT(str(e) + '\n' + str(self))
+        except:
+            self.before = str(incoming)
+            self.after = None
+            self.match = None
+            self.match_index = None
+            raise
 
     def send(self, s):
         return self.child_fd.send(s)
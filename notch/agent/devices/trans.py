@@ -24,17 +24,208 @@ import pexpect
 import notch.agent.errors
 
 
-STRIP_ANSI = [
-    re.compile(r'\x1b(?:\[|\(?:|\))[;?0-9]*[0-9A-Za-z]'),
-    re.compile(r'\x1b(?:\[|\(?:|\))[;?0-9]*[0-9A-Za-z]'),
-    re.compile(r'[\x03|\x1a]'),
-    ]
+# ANSI escape sequences, and the control characters stripped with them.
+# The expression starts with a literal so that searching for it is fast.
+STRIP_ANSI = re.compile(r'\x1b(?:\[|\(?:|\))[;?0-9]*[0-9A-Za-z]')
+STRIP_ANSI_CHARS = '\x03\x1a'
+# The start of an ANSI escape sequence, at the end of streamed output.
+PARTIAL_ANSI = r'\x1b[\[(:)]?[;?0-9]*'
+# Bytes at the end of streamed output searched for the start of text to
+# remove, held back until the following output arrives.
+MAX_PARTIAL = 64
+
+# When streaming command output, the least data (in bytes) passed on at
+# once. Output is passed on in whole lines, so the prompt (which follows
+# the final newline) is never passed on as output. The pattern is
+# anchored to the buffer start so that searching it stays linear.
+STREAM_CHUNK_SIZE = 16384
+STREAM_CHUNK = re.compile(r'\A.{%d}[^\n]*\n' % STREAM_CHUNK_SIZE, re.S)
+
+# Bytes of already searched data that PromptSearcher searches again (back
+# to the start of the line) along with newly arrived data.
+SEARCH_OVERLAP = 512
 
 
 class Error(Exception):
     pass
 
 
+class PromptSearcher(object):
+    """A pexpect searcher finding prompts in newly arrived data.
+
+    pexpect's own regular expression searcher searches the whole buffer
+    each time data arrives, so reading large outputs is quadratic. This
+    searcher looks only at the fresh data and the (partial) line it
+    continues, at most SEARCH_OVERLAP bytes of older data. So regular
+    expressions must not match across lines. Literal string patterns
+    (e.g., a known prompt) are found without a regular expression.
+    Regular expressions anchored with '\\A' are matched at the buffer
+    start only.
+
+    As with pexpect, the pattern matching earliest in the buffer wins,
+    and the earlier pattern in the list wins ties.
+    """
+
+    def __init__(self, patterns):
+        """Initialiser.
+
+        Args:
+          patterns: A list of literal strings, compiled regular
+            expressions, pexpect.EOF or pexpect.TIMEOUT.
+        """
+        self.eof_index = -1
+        self.timeout_index = -1
+        self._literals = []
+        self._regexps = []
+        self._anchored = []
+        for index, pattern in enumerate(patterns):
+            if pattern is pexpect.EOF:
+                self.eof_index = index
+            elif pattern is pexpect.TIMEOUT:
+                self.timeout_index = index
+            elif isinstance(pattern, basestring):
+                self._literals.append((index, pattern))
+            elif pattern.pattern.startswith('\\A'):
+                self._anchored.append((index, pattern))
+            else:
+                self._regexps.append((index, pattern))
+        self.match = None
+        self.start = None
+        self.end = None
+
+    def search(self, buffer, freshlen, searchwindowsize=None):
+        """Searches the buffer, as pexpect's searchers do.
+
+        Args:
+          buffer: A string or bytearray, the data read (and not yet
+            matched).
+          freshlen: An int, the number of bytes at the end of the buffer
+            not yet searched.
+          searchwindowsize: Ignored.
+
+        Returns:
+          The index of the pattern matched, or -1 if none matched. If a
+          pattern matched, the start, end and match attributes are set.
+        """
+        _ = searchwindowsize
+        fresh = len(buffer) - freshlen
+        best = None
+        for index, literal in self._literals:
+            start = buffer.find(literal, max(0, fresh - len(literal) + 1))
+            if start >= 0 and (best is None or (start, index) < best[:2]):
+                best = (start, index, start + len(literal), literal)
+        if self._regexps:
+            window = max(0, fresh - SEARCH_OVERLAP)
+            newline = buffer.rfind('\n', window, fresh)
+            if newline >= 0:
+                window = newline + 1
+            for index, regexp in self._regexps:
+                match = regexp.search(buffer, window)
+                if match is not None and (
+                    best is None or (match.start(), index) < best[:2]):
+                    best = (match.start(), index, match.end(), match)
+        for index, regexp in self._anchored:
+            match = regexp.match(buffer)
+            if match is not None and (best is None or (0, index) < best[:2]):
+                best = (0, index, match.end(), match)
+        if best is None:
+            return -1
+        self.start, index, self.end, self.match = best
+        return index
+
+
+class OutputCleaner(object):
+    """Cleans up command output.
+
+    Everything to remove is found by one regular expression, so output
+    is cleaned up in a single pass. Each of its alternatives starts with
+    a literal character, letting the expression skip quickly over text
+    with nothing to remove. Cleaning up the complete output once is much
+    cheaper than cleaning up every pager page.
+    """
+
+    def __init__(self, strip_ansi=False, dos2unix=False, strip_chars=None):
+        """Initializer.
+
+        Args:
+          strip_ansi: A boolean, if True, strip ANSI escape sequences.
+          dos2unix: A boolean, if True, convert DOS line endings to UNIX.
+          strip_chars: A list of strings to remove, earlier strings first.
+        """
+        literals = [s for s in strip_chars or () if s]
+        patterns = [re.escape(s) for s in literals]
+        # Text that may be continued into something to remove.
+        partials = [re.escape(p) for p in sorted(
+            set(s[:i] for s in literals for i in xrange(1, len(s))),
+            key=len, reverse=True)]
+        if dos2unix:
+            # Some platforms are retarded, and send '\r\r\n'.
+            patterns.append(r'\r\r?(?=\n)')
+            partials.append(r'\r\r?')
+        if strip_ansi:
+            patterns.append(STRIP_ANSI.pattern)
+            patterns.extend(re.escape(c) for c in STRIP_ANSI_CHARS)
+            partials.append(PARTIAL_ANSI)
+        self._remove = None
+        self._partial = None
+        if patterns:
+            self._remove = re.compile('|'.join(patterns))
+        if partials:
+            self._partial = re.compile(r'(?:%s)\Z' % '|'.join(partials))
+
+    def clean(self, data):
+        """Returns the cleaned up data."""
+        if not data or self._remove is None:
+            return data
+        return self._remove.sub('', data)
+
+    def split_partial(self, data):
+        """Splits off text ending data that may continue into text to remove.
+
+        Returns:
+          A tuple of strings, the data before any such text and the text.
+        """
+        if not data or self._partial is None:
+            return data, ''
+        match = self._partial.search(data, max(0, len(data) - MAX_PARTIAL))
+        if match is None:
+            return data, ''
+        return data[:match.start()], data[match.start():]
+
+
+class StreamCleaner(object):
+    """Cleans up output passed on in pieces, as if cleaned up whole.
+
+    Text ending a piece which may continue (in the next piece) into text
+    to remove, e.g. the '\\b' of '\\b ', is held back until the next
+    piece arrives or the output ends.
+    """
+
+    def __init__(self, cleaner, callback):
+        """Initializer.
+
+        Args:
+          cleaner: An OutputCleaner.
+          callback: A callable, passed each piece of cleaned up output.
+        """
+        self._cleaner = cleaner
+        self._callback = callback
+        self._pending = ''
+
+    def write(self, data):
+        """Cleans up and passes on a piece of output."""
+        data, self._pending = self._cleaner.split_partial(self._pending + data)
+        data = self._cleaner.clean(data)
+        if data:
+            self._callback(data)
+
+    def close(self):
+        """Passes on any output held back, as the output has ended."""
+        data, self._pending = self._cleaner.clean(self._pending), ''
+        if data:
+            self._callback(data)
+
+
 class DeviceTransport(object):
     """Abstract device transport.
 
@@ -72,12 +263,18 @@ class DeviceTransport(object):
         self.command_trailer = command_trailer or '\n'
         self.expect_trailer = expect_trailer or '\r\n'
         self.pager_response = pager_response or ' '
+        self._cleaners = {}
+
+    def _cleaner(self, strip_chars=None):
+        """Returns the OutputCleaner for the current settings."""
+        key = (bool(self.strip_ansi), bool(self.dos2unix),
+               tuple(strip_chars or ()))
+        cleaner = self._cleaners.get(key)
+        if cleaner is None:
+            cleaner = OutputCleaner(*key)
+            self._cleaners[key] = cleaner
+        return cleaner
 
-    def _strip_ansi(self, data):
-        for reg in STRIP_ANSI:
-            data = reg.sub('', data)
-        return data
-        
     @property
     def match(self):
         """Returns the most recent expect match."""
@@ -113,13 +310,49 @@ class DeviceTransport(object):
         """Expects one of a list of regular expressions from the device."""
         raise NotImplementedError
 
+    def expect_searcher(self, searcher, timeout=None):
+        """Expects a match by a pexpect searcher (e.g., a PromptSearcher).
+
+        Returns:
+          An int, the index of the pattern matched.
+        """
+        raise NotImplementedError
+
+    def probe(self, prompt, timeout=None):
+        """Checks the device still responds, by sending an empty line.
+
+        Args:
+          prompt: A string or regular expression, the device CLI prompt.
+          timeout: A float, seconds to wait for the prompt, or None for
+            the short response timeout.
+
+        Returns:
+          A boolean, True if the prompt was seen in response.
+        """
+        if isinstance(prompt, str):
+            prompt = re.escape(prompt)
+        try:
+            self.write(self.command_trailer)
+            i = self.expect([prompt, pexpect.EOF, pexpect.TIMEOUT],
+                            timeout or self.timeouts.resp_short)
+        except (notch.agent.errors.CommandError, EnvironmentError, EOFError,
+                pexpect.ExceptionPexpect):
+            return False
+        return i == 0
+
     def command(self, command, prompt, timeout=None, expect_trailer=None,
                 command_trailer=None, expect_command=True,
-                pager=None, pager_response=None, strip_chars=None):
+                pager=None, pager_response=None, strip_chars=None,
+                callback=None):
         """Executes a command.
 
         This returns any data after the CLI command sent, prior to the
-        CLI prompt after the output ceases.
+        CLI prompt after the output ceases. If callback is supplied, the
+        data is instead passed to it (a string argument) in pieces as it
+        arrives, and an empty string is returned.
+
+        Output is cleaned up (see OutputCleaner) once it is complete, or
+        a piece at a time when streamed (see StreamCleaner).
         """
         expect_trailer = expect_trailer or self.expect_trailer
         command_trailer = command_trailer or self.command_trailer
@@ -127,14 +360,14 @@ class DeviceTransport(object):
         timeout_short = timeout or self.timeouts.resp_short
         pager_response = pager_response or self.pager_response
 
+        if isinstance(pager, basestring):
+            pager = re.compile(pager, re.S)
+
         # Find the prompt and flush the expect buffer.
         self.write(command_trailer)
-        if isinstance(prompt, str):
-            esc_prompt = re.escape(prompt)
-        else:
-            esc_prompt = prompt
-        i = self.expect([esc_prompt, pexpect.EOF, pexpect.TIMEOUT],
-                        timeout_short)
+        i = self.expect_searcher(
+            PromptSearcher([prompt, pexpect.EOF, pexpect.TIMEOUT]),
+            timeout_short)
         if i == 1:
             exc = notch.agent.errors.CommandError(
                 'EOF received during command %r' % command)
@@ -166,36 +399,35 @@ class DeviceTransport(object):
 
         # Wait for the remaining data, possibly handling pager responses
 
+        cleaner = self._cleaner(strip_chars)
         response_buf = []
+        if callback is None:
+            output = response_buf.append
+        else:
+            stream = StreamCleaner(cleaner, callback)
+            output = stream.write
+        if pager:
+            patterns = [pager, prompt, pexpect.EOF, pexpect.TIMEOUT]
+        else:
+            patterns = [prompt, pexpect.EOF, pexpect.TIMEOUT]
+        if callback is not None:
+            patterns.append(STREAM_CHUNK)
         while True:
-            if pager:
-                i = self.expect([pager,
-                                 esc_prompt, pexpect.EOF, pexpect.TIMEOUT],
-                                timeout_long)
-            else:
-                i = self.expect([esc_prompt, pexpect.EOF, pexpect.TIMEOUT],
-                                timeout_long)
+            i = self.expect_searcher(PromptSearcher(patterns), timeout_long)
+            if not pager:
                 i += 1
 
-            data = self.before
-            # Strip characters
-            if strip_chars and data is not None:
-                for strip_char in strip_chars:
-                    data = data.replace(strip_char, '')
-            if self.dos2unix:
-                # Some platforms are retarded, and thus we need to do
-                # this twice (which is safe, if slow).
-                if data is not None:
-                    data = data.replace('\r\n', '\n')
-                    data = data.replace('\r\n', '\n')
-            if not i:
-                # Saw the pager prompt.
-                if data is not None:
-                    if self.strip_ansi:
-                        response_buf.append(self._strip_ansi(data))
-                    else:
-                        response_buf.append(data)
-                self.write(pager_response)
+            if i == 4:
+                # Saw enough whole lines of output to pass on.
+                data = (self.before or '') + self.after
+            else:
+                data = self.before
+            if not i or i == 4:
+                # Saw the pager prompt (or a chunk of streamed output).
+                if data:
+                    output(data)
+                if not i:
+                    self.write(pager_response)
             elif i == 1:
                 # Saw the command prompt, indicating we're done.
                 # Clean up the output to include only the part between the first
@@ -204,10 +436,12 @@ class DeviceTransport(object):
                 if data is not None:
                     prompt_index = data.rfind(prompt)
                     if prompt_index == -1:
-                        response_buf.append(data)
+                        output(data)
                     else:
-                        response_buf.append(data[:prompt_index])
-                return ''.join(response_buf)
+                        output(data[:prompt_index])
+                if callback is not None:
+                    stream.close()
+                return cleaner.clean(''.join(response_buf))
             elif i == 2:
                 exc = notch.agent.errors.CommandError(
                     'EOF received during command %r' % command)
@@ -155,6 +155,18 @@ class ParamikoExpectTransport(trans.DeviceTransport):
             timeout = self.timeouts.resp_long
         return self._c.expect(re_list, timeout=timeout)
 
+    def expect_searcher(self, searcher, timeout=None):
+        if timeout is None and self.timeouts:
+            timeout = self.timeouts.resp_long
+        return self._c.expect_loop(searcher, timeout=timeout)
+
+    def probe(self, prompt, timeout=None):
+        """Checks the SSH transport is active, then that the CLI responds."""
+        if self._c is None or not self._c.isalive():
+            return False
+        return super(ParamikoExpectTransport, self).probe(prompt,
+                                                          timeout=timeout)
+
     def download_and_return_file(self, source):
         try:
             scp_client = scp.ScpClient(self._c.transport)
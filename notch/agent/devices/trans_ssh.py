@@ -118,3 +118,7 @@ class SshDeviceTransport(trans.DeviceTransport):
     def expect(self, re_list, timeout=None):
         timeout = timeout or self.timeouts.resp_long
         return self._expect.expect(re_list, timeout=timeout)
+
+    def expect_searcher(self, searcher, timeout=None):
+        timeout = timeout or self.timeouts.resp_long
+        return self._expect.expect_loop(searcher, timeout=timeout)
@@ -61,6 +61,14 @@ class ApiError(Error):
         self.msg = self.__class__.__doc__
 
 
+class AdmissionQueueFullError(ApiError):
+    """Too many requests were already waiting for a device session."""
+
+
+class AdmissionTimeoutError(ApiError):
+    """The request waited too long for a device session."""
+
+
 class AuthenticationError(ApiError):
     """Device authentication (either login or enable) failed."""
 
@@ -128,6 +136,12 @@ class NoSessionCreatedError(ApiError):
     """No session could be created for the requested arguments."""
 
 
+class RequestTimeoutError(ApiError):
+    """The request did not complete within the time allowed."""
+    # The request may be interrupted mid-command, leaving its output unread.
+    disconnect_on_error = True
+
+
 class UploadError(ApiError):
     """There was an error whilst uploading a file from the device."""
 
@@ -149,6 +163,22 @@ def rpc_error_handler(exc, rpc):
         return rpc.faults.internal_error(str(exc))
 
 
+def error_dict(exc):
+    """Returns a dict describing an error, for use in RPC results.
+
+    Args:
+      exc: An Exception instance, the error.
+
+    Returns:
+      A dict with 'code' (an int, from error_dictionary), 'name' and
+      'message' keys.
+    """
+    name = exc.__class__.__name__
+    return {'code': error_dictionary.get(name, INTERNAL_ERROR_CODE),
+            'name': name,
+            'message': str(exc)}
+
+
 # Errors used in tornadorpc library for responses. Added to existing JSON/XML
 # RPC error codes. Key integers correspond to the 'code' attribute on ApiError
 # sub-classes.
@@ -170,6 +200,12 @@ error_dictionary = {
     'UploadError': 14,
     'NoSuchDeviceError': 15,
     'EnableError': 16,
+    'RequestTimeoutError': 17,
+    'AdmissionQueueFullError': 18,
+    'AdmissionTimeoutError': 19,
 }
 
+# The JSON-RPC error code for errors not in error_dictionary.
+INTERNAL_ERROR_CODE = -32603
+
 reverse_error_dictionary = dict((v, k) for (k, v) in error_dictionary.items())
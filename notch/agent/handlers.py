@@ -20,13 +20,19 @@ These handlers implement the server-side API using session and device
 objects, using the Tornado request handler framework.
 """
 
+import collections
+import functools
 import logging
+import time
 import traceback
 
+import eventlet.semaphore
+
 import jsonrpclib
 # Disable automatic class translation.
 jsonrpclib.config.use_jsonclass = False
 
+import tornado.escape
 import tornado.ioloop
 import tornado.options
 import tornado.web
@@ -34,6 +40,61 @@ import tornadorpc.json
 import tornadorpc.base
 
 import notch.agent.errors
+import notch.agent.session
+
+
+# Default maximum number of requests from one JSON-RPC batch that may
+# execute at once (the request pool also limits overall concurrency).
+DEFAULT_BATCH_CONCURRENCY = 32
+
+# Content type of the framed stream sent by NotchStreamHandler.
+STREAM_CONTENT_TYPE = 'application/x-notch-stream'
+
+# Device API methods whose output NotchStreamHandler passes on as it
+# arrives from the device, rather than once the request completes.
+STREAMED_METHODS = ('command', 'get_config')
+
+# Maximum number of output frames a stream may have queued for the
+# client. Device reads pause whilst the client catches up.
+STREAM_WINDOW_FRAMES = 16
+
+# Period (in seconds) between checks for a slow client's output draining.
+STREAM_DRAIN_POLL_S = 0.01
+
+
+def fanout_arguments(kwargs):
+    """Validates the arguments to a request fanned out by regexp.
+
+    Args:
+      kwargs: A dict, the request keyword arguments, including 'regexp'
+        and optionally 'max_concurrency' and 'timeout'.
+
+    Returns:
+      A new dict of keyword arguments for Controller.request_matching.
+
+    Raises:
+      notch.agent.errors.InvalidRequestError: The arguments were invalid.
+    """
+    kwargs = dict(kwargs)
+    if not kwargs.get('regexp'):
+        raise notch.agent.errors.InvalidRequestError(
+            'No regexp argument in request')
+    try:
+        if kwargs.get('max_concurrency') is not None:
+            kwargs['max_concurrency'] = int(kwargs['max_concurrency'])
+        if kwargs.get('timeout') is not None:
+            kwargs['timeout'] = float(kwargs['timeout'])
+    except (TypeError, ValueError):
+        raise notch.agent.errors.InvalidRequestError(
+            'max_concurrency and timeout arguments must be numbers')
+    return kwargs
+
+
+def _check_json_encoding(kwargs):
+    """Raises InvalidRequestError if a result can't be encoded as JSON."""
+    if kwargs.get('encoding') == notch.agent.session.ENCODING_BINARY:
+        raise notch.agent.errors.InvalidRequestError(
+            'Binary results are only available from the stream API.')
 
 
 class BaseHandler(tornado.web.RequestHandler):
@@ -53,6 +114,86 @@ class SynchronousJSONRPCHandler(tornadorpc.json.JSONRPCHandler):
         super(SynchronousJSONRPCHandler, self).post()
 
 
+class OrderedJSONRPCParser(tornadorpc.json.JSONRPCParser):
+    """A JSON-RPC parser keeping batch results in request order.
+
+    Each call in a batch is numbered as it is dispatched, and the handler
+    stores the call's result at that position, whatever order the
+    results arrive in.
+    """
+
+    def parse_request(self, request_body):
+        try:
+            request = jsonrpclib.jsonrpc.loads(request_body)
+        except Exception:
+            self.traceback()
+            return self.faults.parse_error()
+        self._batch = isinstance(request, list)
+        if self._batch:
+            self._requests = request
+        else:
+            self._requests = [request]
+        if not self._requests:
+            return self.faults.invalid_request('Empty batch request')
+        for req in self._requests:
+            if not isinstance(req, dict) or 'method' not in req:
+                return self.faults.invalid_request()
+        return tuple((req['method'], req.get('params', []))
+                     for req in self._requests)
+
+    def run(self, handler, request_body):
+        self.handler = handler
+        requests = self.parse_request(request_body)
+        if not isinstance(requests, tuple):
+            # A fault, since the request could not be parsed.
+            handler._RPC_finished = True
+            return handler.on_result(requests.response())
+        handler._requests = len(requests)
+        handler._results = [None] * len(requests)
+        for index, (method_name, params) in enumerate(requests):
+            handler._dispatch_index = index
+            self.dispatch(method_name, params)
+
+
+class AsynchronousJSONRPCHandler(tornadorpc.json.JSONRPCHandler):
+    """JSON-RPC handler that may complete responses from a greenthread.
+
+    Requires the 'controller' and 'request_pool' (an eventlet.GreenPool)
+    application settings. The 'batch_concurrency' setting limits how
+    many requests of one batch execute at once.
+    """
+    _RPC = tornadorpc.json.JSONRPCParser(jsonrpclib)
+
+    def post(self):
+        self._RPC.faults.codes.update(notch.agent.errors.error_dictionary)
+        self.controller = self.settings['controller']
+        self.request_pool = self.settings['request_pool']
+        self.batch_concurrency = self.settings.get(
+            'batch_concurrency', DEFAULT_BATCH_CONCURRENCY)
+        self._dispatch_index = 0
+        self._in_flight = 0
+        self._pending = collections.deque()
+        # The parser holds per-request state, and requests now overlap.
+        self._RPC_ = OrderedJSONRPCParser(
+            tornadorpc.json.JSONRPCLibraryWrapper)
+        super(AsynchronousJSONRPCHandler, self).post()
+
+    def add_callback(self, callback):
+        """Schedules callback to run on the IOLoop; safe from any thread."""
+        tornado.ioloop.IOLoop.instance().add_callback(callback)
+
+    def result(self, result, *results):
+        """Sets the result of the call being dispatched."""
+        if results:
+            result = [result] + list(results)
+        self.result_at(self._dispatch_index, result)
+
+    def result_at(self, index, result):
+        """Sets the result of the index'th call in the request."""
+        self._results[index] = result
+        self._RPC_.response(self)
+
+
 #pylint: disable-msg=E1101
 class NotchAPI(object):
     """The Notch API.  Used as a mix-in."""
@@ -81,80 +222,344 @@ class NotchAPI(object):
                 return
             else:
                 arg = kwargs.get('regexp', '^$')
-                result = {}
-                devices = self.controller.device_manager.devices_matching(arg)
-                for d in devices:
-                    dev_info = self.controller.device_manager.device_info(d)
-                    if dev_info is None:
-                        continue
-                    if isinstance(dev_info.addresses, list):
-                        add = dev_info.addresses
-                    else:
-                        add = [dev_info.addresses]
-                    result[d] = {'device_type': dev_info.device_type,
-                                 'addresses': add}
-                return result
+                device_manager = self.controller.device_manager
+                return device_manager.devices_info_many(
+                    device_manager.devices_matching(arg))
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
     def command(self, **kwargs):
         try:
-            return self.controller.request('command', **kwargs)
+            return self._device_request('command', **kwargs)
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
     def get_config(self, **kwargs):
         try:
-            return self.controller.request('get_config', **kwargs)
+            return self._device_request('get_config', **kwargs)
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
     def set_config(self, **kwargs):
         try:
-            return self.controller.request('set_config', **kwargs)
+            return self._device_request('set_config', **kwargs)
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
     def copy_file(self, **kwargs):
         try:
-            return self.controller.request('copy_file', **kwargs)
+            return self._device_request('copy_file', **kwargs)
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
     def upload_file(self, **kwargs):
         try:
-            return self.controller.request('upload_file', **kwargs)
+            return self._device_request('upload_file', **kwargs)
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
     def download_file(self, **kwargs):
         try:
-            return self.controller.request('download_file', **kwargs)
+            return self._device_request('download_file', **kwargs)
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
     def delete_file(self, **kwargs):
         try:
-            return self.controller.request('delete_file', **kwargs)
+            return self._device_request('delete_file', **kwargs)
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
     def lock(self, **kwargs):
         try:
-            return self.controller.request('lock', **kwargs)
+            return self._device_request('lock', **kwargs)
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
 
     def unlock(self, **kwargs):
         try:
-            return self.controller.request('unlock', **kwargs)
+            return self._device_request('unlock', **kwargs)
         except notch.agent.errors.ApiError, e:
             return self.handle_exception(e)
+
+    def command_matching(self, **kwargs):
+        try:
+            return self._request_matching('command', **kwargs)
+        except notch.agent.errors.ApiError, e:
+            return self.handle_exception(e)
+
+    def _device_request(self, method, **kwargs):
+        """Executes a device API request, checking its result encoding."""
+        _check_json_encoding(kwargs)
+        return self.controller.request(method, **kwargs)
+
+    def _request_matching(self, method, **kwargs):
+        """Executes a request on all devices matching kwargs['regexp'].
+
+        Returns:
+          A dict keyed by device name. Each value is a dict with the
+          'result' of the device's request and its 'error' (None, or a
+          dict from errors.error_dict).
+        """
+        _check_json_encoding(kwargs)
+        results = {}
+        for device_name, result, exc in self.controller.request_matching(
+            method, **fanout_arguments(kwargs)):
+            if exc is None:
+                results[device_name] = {'result': result, 'error': None}
+            else:
+                results[device_name] = {
+                    'result': None,
+                    'error': notch.agent.errors.error_dict(exc)}
+        return results
+
+
+class NotchAsyncAPI(NotchAPI):
+    """The Notch API, with device requests executed in greenthreads.
+
+    Device API methods return immediately, leaving the IOLoop free to
+    serve other requests. The RPC result is sent from an IOLoop callback
+    once the device request completes. The calls in a JSON-RPC batch
+    (which may each name a different device) execute concurrently, up
+    to batch_concurrency at a time. Used as a mix-in.
+    """
+
+    def _request_async(self, method, kwargs):
+        """Queues a device API request, sending its result when complete."""
+        self._call_async(self._device_request, (method, ), kwargs)
+
+    def _call_async(self, func, args, kwargs):
+        """Queues a call of func, sending its result when complete."""
+        call = (self._dispatch_index, func, args, kwargs)
+        if self._in_flight < self.batch_concurrency:
+            self._start_request(call)
+        else:
+            self._pending.append(call)
+
+    def _start_request(self, call):
+        self._in_flight += 1
+        self.request_pool.spawn_n(self._execute_request, *call)
+
+    def _execute_request(self, index, func, args, kwargs):
+        """Executes a device API request; run in a request pool greenthread."""
+        try:
+            result = func(*args, **kwargs)
+        except notch.agent.errors.ApiError, e:
+            result = self.handle_exception(e)
+        except Exception, e:
+            logging.error('%s: %s', str(e.__class__), str(e), exc_info=True)
+            result = self._RPC.faults.internal_error(str(e))
+        self.add_callback(functools.partial(self._send_result, index, result))
+
+    def _send_result(self, index, result):
+        """Sends the request result; run on the IOLoop."""
+        self._in_flight -= 1
+        if self.request.connection.stream.closed():
+            logging.debug('Client went away; discarding %s result.',
+                          self.__class__.__name__)
+            self._pending.clear()
+            return
+        if self._pending:
+            self._start_request(self._pending.popleft())
+        self.result_at(index, result)
+
+    @tornadorpc.base.async
+    def command(self, **kwargs):
+        self._request_async('command', kwargs)
+
+    @tornadorpc.base.async
+    def get_config(self, **kwargs):
+        self._request_async('get_config', kwargs)
+
+    @tornadorpc.base.async
+    def set_config(self, **kwargs):
+        self._request_async('set_config', kwargs)
+
+    @tornadorpc.base.async
+    def copy_file(self, **kwargs):
+        self._request_async('copy_file', kwargs)
+
+    @tornadorpc.base.async
+    def upload_file(self, **kwargs):
+        self._request_async('upload_file', kwargs)
+
+    @tornadorpc.base.async
+    def download_file(self, **kwargs):
+        self._request_async('download_file', kwargs)
+
+    @tornadorpc.base.async
+    def delete_file(self, **kwargs):
+        self._request_async('delete_file', kwargs)
+
+    @tornadorpc.base.async
+    def lock(self, **kwargs):
+        self._request_async('lock', kwargs)
+
+    @tornadorpc.base.async
+    def unlock(self, **kwargs):
+        self._request_async('unlock', kwargs)
+
+    @tornadorpc.base.async
+    def command_matching(self, **kwargs):
+        self._call_async(self._request_matching, ('command', ), kwargs)
 #pylint: enable-msg=E1101
 
 
 class NotchSyncJsonRpcHandler(NotchAPI, SynchronousJSONRPCHandler):
-    """The Notch API as presented to JSON-RPC asynchronously, for WSGI."""
+    """The Notch API as presented to JSON-RPC synchronously, for WSGI."""
+
+
+class NotchAsyncJsonRpcHandler(NotchAsyncAPI, AsynchronousJSONRPCHandler):
+    """The Notch API as presented to JSON-RPC asynchronously, for Tornado."""
+
+
+class NotchStreamHandler(BaseHandler):
+    """Streams device API results to the client as they arrive.
+
+    The request body is a JSON object with 'method' and 'params' keys, as
+    for a JSON-RPC call. Params including a 'regexp' (and optionally
+    'max_concurrency' and 'timeout') fan the request out to all matching
+    devices, otherwise 'device_name' names the one device.
+
+    The response is a sequence of frames. Each frame is a line holding a
+    JSON object header, followed by 'length' bytes of payload. The header
+    also holds the 'device_name', the payload 'encoding', the 'error'
+    (null, or an object from errors.error_dict) and 'last', true for the
+    final frame of each device's result. Output of STREAMED_METHODS is
+    sent in 'binary' (unencoded) frames as it arrives from the device,
+    followed by an empty final frame. Other results are sent in one
+    frame: 'binary' for string results, otherwise as 'json'. The request
+    may ask for string results 'base64' encoded (or as 'text', sent as a
+    'json' frame) with the 'encoding' param (see session.ENCODINGS).
+
+    Requires the 'controller' and 'request_pool' application settings.
+    """
+
+    @tornado.web.asynchronous
+    def post(self):
+        try:
+            body = tornado.escape.json_decode(self.request.body)
+            method = str(body['method'])
+            params = dict((str(k), v) for k, v in
+                          (body.get('params') or {}).iteritems())
+        except (AttributeError, KeyError, TypeError, ValueError):
+            raise tornado.web.HTTPError(400)
+        self.controller = self.settings['controller']
+        self._window = eventlet.semaphore.Semaphore(STREAM_WINDOW_FRAMES)
+        self.set_header('Content-Type', STREAM_CONTENT_TYPE)
+        self.settings['request_pool'].spawn_n(self._execute, method, params)
+
+    def add_callback(self, callback):
+        """Schedules callback to run on the IOLoop; safe from any thread."""
+        tornado.ioloop.IOLoop.instance().add_callback(callback)
+
+    def _results(self, method, params):
+        """Yields (device_name, result, exception) for the request."""
+        streamed = method in STREAMED_METHODS
+        if 'regexp' in params:
+            kwargs = fanout_arguments(params)
+            if streamed:
+                kwargs['stream_callback'] = self._stream_output
+            for item in self.controller.request_matching(method, **kwargs):
+                yield item
+        else:
+            device_name = params.get('device_name')
+            if streamed:
+                params['callback'] = functools.partial(self._stream_output,
+                                                       device_name)
+            try:
+                yield (device_name,
+                       self.controller.request(method, **params), None)
+            except Exception, e:
+                yield (device_name, None, e)
+
+    def _execute(self, method, params):
+        """Executes the request; run in a request pool greenthread."""
+        if method in STREAMED_METHODS:
+            params['encoding'] = notch.agent.session.ENCODING_BINARY
+        else:
+            params.setdefault('encoding', notch.agent.session.ENCODING_BINARY)
+        encoding = params['encoding']
+        try:
+            for device_name, result, exc in self._results(method, params):
+                if self.request.connection.stream.closed():
+                    logging.debug('Client went away; ending stream.')
+                    return
+                self.add_callback(functools.partial(
+                    self.write_frame, device_name, result, exc,
+                    encoding=encoding))
+        except Exception, e:
+            if not isinstance(e, notch.agent.errors.ApiError):
+                logging.error('%s: %s', str(e.__class__), str(e),
+                              exc_info=True)
+            self.add_callback(functools.partial(
+                self.write_frame, None, None, e))
+        self.add_callback(self._finish_stream)
+
+    def _stream_output(self, device_name, data):
+        """Passes on a piece of output; run in a request pool greenthread."""
+        # Output is read (and discarded) even if the client went away,
+        # leaving the device ready for its next request.
+        if self.request.connection.stream.closed():
+            return
+        self._window.acquire()
+        self.add_callback(functools.partial(self._write_output,
+                                            device_name, data))
+
+    def _write_output(self, device_name, data):
+        self.write_frame(device_name, data, last=False, encoding='binary')
+        self._release_when_written()
+
+    def _release_when_written(self):
+        """Frees a window slot once the client has taken queued output."""
+        stream = self.request.connection.stream
+        if stream.closed() or not stream.writing():
+            self._window.release()
+        else:
+            tornado.ioloop.IOLoop.instance().add_timeout(
+                time.time() + STREAM_DRAIN_POLL_S, self._release_when_written)
+
+    def write_frame(self, device_name, result, exc=None, last=True,
+                    encoding=None):
+        """Writes and flushes one frame; run on the IOLoop."""
+        if self.request.connection.stream.closed():
+            return
+        if exc is not None:
+            payload = ''
+            error = notch.agent.errors.error_dict(exc)
+        elif isinstance(result, str):
+            payload = result
+            error = None
+            encoding = encoding or 'base64'
+        else:
+            payload = tornado.escape.json_encode(result)
+            error = None
+            encoding = 'json'
+        header = {'device_name': device_name, 'length': len(payload),
+                  'encoding': encoding, 'error': error, 'last': last}
+        self.write(tornado.escape.json_encode(header) + '\n')
+        if payload:
+            self.write(payload)
+        self.flush()
+
+    def _finish_stream(self):
+        if not self.request.connection.stream.closed():
+            self.finish()
+
+
+class InventoryHandler(BaseHandler):
+    """Exports device information for the whole (or part of) the inventory.
+
+    The optional 'regexp' query argument selects the devices, as for the
+    devices_info API method, whose result this JSON object matches.
+    """
+
+    def get(self):
+        device_manager = self.settings['controller'].device_manager
+        regexp = self.get_argument('regexp', '.*')
+        device_names = sorted(device_manager.devices_matching(regexp))
+        self.set_header('Content-Type', 'application/json')
+        self.write(device_manager.devices_info_json(device_names))
 
 
 class StopHandler(tornado.web.RequestHandler):
@@ -18,10 +18,13 @@
 
 import copy
 import heapq
+import itertools
 import time
 import UserDict
+import weakref
 
 import eventlet
+from eventlet import event
 
 
 class Error(Exception):
@@ -36,36 +39,156 @@ class DontExpireError(Error):
     """Indicate to the LRU that this key should not be expired."""
 
 
-# pylint:disable-msg=R0903
-class HeapItem(object):
-    """A cached key kept on the heap queue from the data dictionary."""
-    def __init__(self, key):
-        self.time = time.time()
-        self.key = key
+class Coalescer(object):
+    """Shares one execution of a call between concurrent callers.
 
-    def __lt__(self, other):
-        if self.time < other.time:
-            return True
-        else:
-            return False
+    The first caller for a key starts the call. Callers arriving while
+    it runs receive the same result, or have the same exception raised
+    in them. The call runs in a greenthread of its own, which every
+    caller (the first included) waits for, so a caller interrupted
+    whilst waiting (e.g., by an eventlet.Timeout) neither cancels the
+    call nor passes its interruption on to the other callers.
+    """
+
+    def __init__(self):
+        self._executions = {}
+
+    def __contains__(self, key):
+        return key in self._executions
+
+    def __len__(self):
+        return len(self._executions)
+
+    def call(self, key, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) unless a call for key is running.
+
+        Args:
+          key: A hashable, identifies calls that may share a result.
+          func: A callable, executed only if no call for key is running.
+
+        Returns:
+          The result of the (possibly shared) call to func.
+        """
+        execution = self._executions.get(key)
+        if execution is None:
+            execution = eventlet.spawn(func, *args, **kwargs)
+            self._executions[key] = execution
+            execution.link(self._finished, key)
+        return execution.wait()
+
+    def _finished(self, execution, key):
+        if self._executions.get(key) is execution:
+            del self._executions[key]
+
+
+class AgeSweeper(object):
+    """Expires aged items for every LruDict using a single timer.
+
+    Item deadlines are kept on one min-heap shared by all caches, and a
+    single eventlet timer is scheduled for the earliest deadline. Each
+    cache records the current deadline for its keys; heap entries whose
+    deadline no longer matches (because the key was re-set or removed)
+    are stale and skipped. The heap is compacted when stale entries
+    outnumber live ones, so memory stays proportional to the live items.
+    """
+
+    # Don't bother compacting heaps with fewer stale entries than this.
+    COMPACT_MINIMUM = 64
+
+    def __init__(self):
+        self._heap = []
+        self._stale = 0
+        self._sequence = itertools.count()
+        self._timer = None
+        self._timer_deadline = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, lru, key, deadline):
+        """Schedules key in lru to be expired at deadline (a time.time())."""
+        heapq.heappush(self._heap, (deadline, self._sequence.next(),
+                                    weakref.ref(lru), key))
+        if self._timer_deadline is None or deadline < self._timer_deadline:
+            self._reschedule()
+
+    def discard(self, count=1):
+        """Notes that count scheduled entries are no longer wanted."""
+        self._stale += count
+        if (self._stale > self.COMPACT_MINIMUM and
+            self._stale * 2 > len(self._heap)):
+            self._compact()
+
+    def _is_live(self, entry):
+        deadline, _, lru_ref, key = entry
+        lru = lru_ref()
+        return lru is not None and lru._deadlines.get(key) == deadline
+
+    def _compact(self):
+        self._heap[:] = [entry for entry in self._heap if self._is_live(entry)]
+        heapq.heapify(self._heap)
+        self._stale = 0
+        self._reschedule()
+
+    def _reschedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self._timer_deadline = None
+        if self._heap:
+            self._timer_deadline = self._heap[0][0]
+            self._timer = eventlet.spawn_after(
+                max(0, self._timer_deadline - time.time()), self._sweep)
+
+    def _sweep(self):
+        self._timer = None
+        self._timer_deadline = None
+        now = time.time()
+        try:
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                if not self._is_live(entry):
+                    self._stale = max(0, self._stale - 1)
+                    continue
+                _, _, lru_ref, key = entry
+                lru = lru_ref()
+                del lru._deadlines[key]
+                lru._expire_item(key)
+        finally:
+            self._reschedule()
+
+
+# The sweeper used by all LruDict instances.
+SWEEPER = AgeSweeper()
+
+
+# Indices into the recency list links, [previous, next, key].
+_PREV, _NEXT, _KEY = 0, 1, 2
 
 
 class LruDict(UserDict.IterableUserDict):
     """A least-recently used cache style dictionary.
 
+    Keys are kept on a doubly linked recency list (least recently used
+    first) alongside the data dictionary, so getting, setting, touching
+    and evicting an item are all constant time operations.
+
+    Concurrent misses for the same key (e.g., from several greenthreads)
+    share a single call to the populate callback.
+
     This dictionary is not thread-safe, though it should not explode.
-    Particularly, boundaries (such as maximum_size) may not be respected.
 
     Attributes:
       populate_callback: A callable, the method to call (with the item key)
         to populate the dictionary value for that key.
       expire_callback: Optional callable, the method to call (with key
-        and value arguments) when
-      maximum_size: An int, the maximum cache size. Not reliable in a multi-
-        threaded environment (the respected maximum size may be up to
-        num_threads higher).
+        and value arguments) when an item is expired from the cache.
+      maximum_size: An int, the maximum cache size. Only items whose expire
+        callback raises DontExpireError may hold the cache above this size.
       maximum_age: A float, the cache entry lifetime. Setting this to 0 or None
         disables automatic aging for all new items entering the cache.
+        Setting an existing key again restarts its lifetime. Aged items
+        whose expire callback raises DontExpireError are no longer aged.
     """
 
     def __init__(self, populate_callback=None, expire_callback=None,
@@ -75,17 +198,69 @@ class LruDict(UserDict.IterableUserDict):
         self.maximum_size = maximum_size
         self.maximum_age = maximum_age
         self._populate_callback = populate_callback
-        self._heap = []
+        self._root = []
+        self._links = {}
+        self._populating = Coalescer()
+        # Expiry deadlines (for maximum_age) keyed by item key.
+        self._deadlines = {}
         self.data = {}
-        self._cleanup_gts = set()
         self._initialise()
 
     def _initialise(self):
-        self._heap[:] = []
+        self._root[:] = [self._root, self._root, None]
+        self._links.clear()
+        if self._deadlines:
+            SWEEPER.discard(len(self._deadlines))
+            self._deadlines.clear()
         self.data.clear()
-            
+
+    def _link(self, key):
+        """Places key at the most recently used end of the recency list."""
+        root = self._root
+        last = root[_PREV]
+        link = [last, root, key]
+        last[_NEXT] = root[_PREV] = self._links[key] = link
+
+    def _unlink(self, key):
+        """Removes key from the recency list, if present."""
+        link = self._links.pop(key, None)
+        if link is not None:
+            link[_PREV][_NEXT] = link[_NEXT]
+            link[_NEXT][_PREV] = link[_PREV]
+        if self._deadlines.pop(key, None) is not None:
+            SWEEPER.discard()
+
+    def touch(self, key):
+        """Marks key as the most recently used item, if it is cached.
+
+        Returns:
+          A boolean, True if the key was in the cache.
+        """
+        link = self._links.get(key)
+        if link is None:
+            return False
+        root = self._root
+        if root[_PREV] is not link:
+            link[_PREV][_NEXT] = link[_NEXT]
+            link[_NEXT][_PREV] = link[_PREV]
+            last = root[_PREV]
+            link[_PREV] = last
+            link[_NEXT] = root
+            last[_NEXT] = root[_PREV] = link
+        return True
+
+    def keys_by_recency(self):
+        """Returns a list of the cached keys, least recently used first."""
+        result = []
+        root = self._root
+        link = root[_NEXT]
+        while link is not root:
+            result.append(link[_KEY])
+            link = link[_NEXT]
+        return result
+
     def expire_item(self, return_copy=True):
-        """Expires an item and optionally returns a shallow copy of it.
+        """Expires the least recently used item, optionally returning a copy.
 
         Args:
           return_copy: A boolean, if True, returns a copy of the expired item.
@@ -93,18 +268,22 @@ class LruDict(UserDict.IterableUserDict):
         Raises:
           IndexError: if the LRU is empty.
         """
-        item = heapq.heappop(self._heap)
-        value = self.data.get(item.key)
+        link = self._root[_NEXT]
+        if link is self._root:
+            raise IndexError('expire_item(): LRU is empty')
+        key = link[_KEY]
+        value = self.data.get(key)
         if return_copy:
             result = copy.copy(value)
         else:
             result = None
-        self._expire_item(item.key)
+        self._expire_item(key)
         return result
 
     def get(self, key, default=None):
         """Returns the named key's value from the cache."""
         if key in self.data:
+            self.touch(key)
             return self.data[key]
         else:
             return default
@@ -120,45 +299,79 @@ class LruDict(UserDict.IterableUserDict):
 
     def __getitem__(self, key):
         """Gets the value for key from the cache, maybe populating it first."""
-        if key not in self.data:
-            try:
-                value = self._populate_callback(key)
-            except DontPopulateItemError:
-                return None
-            except Exception, e:
-                raise e
-            self._push_and_set(key, value)
-        return self.data[key]
+        if key in self.data:
+            self.touch(key)
+            return self.data[key]
+        try:
+            return self._populating.call(key, self._populate, key)
+        except DontPopulateItemError:
+            return None
+
+    def _populate(self, key):
+        """Populates and sets the value for key using the populate callback."""
+        value = self._populate_callback(key)
+        self._push_and_set(key, value)
+        return value
 
     def __setitem__(self, key, value):
         """Sets the value for key to the cache."""
         self._push_and_set(key, value)
 
+    def __delitem__(self, key):
+        """Removes key from the cache without calling the expire callback."""
+        del self.data[key]
+        self._unlink(key)
+
+    def pop(self, key, *args):
+        """Removes and returns key from the cache, like dict.pop()."""
+        self._unlink(key)
+        return self.data.pop(key, *args)
+
+    def clear(self):
+        """Removes all items without calling the expire callback."""
+        self._initialise()
+
     def _push_and_set(self, key, value):
-        """Pushes an item onto the heap and sets it in the cache."""
-        item = HeapItem(key)
-        if len(self._heap) < self.maximum_size:
-            heapq.heappush(self._heap, item)
+        """Sets an item in the cache as most recently used, evicting others."""
+        if key in self.data:
+            self.touch(key)
         else:
-            old_item = heapq.heapreplace(self._heap, item)
-            self._expire_item(old_item.key)
+            self._evict(self.maximum_size - 1)
+            self._link(key)
         self.data[key] = value
         if self.maximum_age:
-            self._cleanup_gts.add(
-                eventlet.spawn_after(self.maximum_age, self._expire_item, key))
+            if key in self._deadlines:
+                SWEEPER.discard()
+            deadline = time.time() + self.maximum_age
+            self._deadlines[key] = deadline
+            SWEEPER.schedule(self, key, deadline)
+
+    def _evict(self, size):
+        """Expires least recently used items until at most size remain.
+
+        Items whose expire callback raises DontExpireError are moved to
+        the most recently used end of the list and skipped over, so at
+        most one pass over the cache is made.
+        """
+        for _ in xrange(len(self._links)):
+            if len(self._links) <= size:
+                return
+            key = self._root[_NEXT][_KEY]
+            if not self._expire_item(key):
+                self.touch(key)
 
     def _expire_item(self, key):
-        """Expires an item from the cache."""
+        """Expires an item from the cache.
+
+        Returns:
+          A boolean, False if the expire callback refused the expiry.
+        """
         if self._expire_callback and key in self.data:
             try:
                 self._expire_callback(key, self.data[key])
             except DontExpireError:
                 # If this exception is raised, we won't expire the item.
-                return
-            except Exception, e:
-                raise e
-        try:
-            del self.data[key]
-        except KeyError:
-            # Indicates a race condition, multi-threaded use.
-            pass
+                return False
+        self._unlink(key)
+        self.data.pop(key, None)
+        return True
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Regular expression analysis helpers.
+
+Used to build indices over hostname regular expressions (e.g., for
+credential and device name lookups), by finding the literal text that
+any matching string must contain.
+"""
+
+import collections
+import re
+import sre_constants
+import sre_parse
+
+
+# The literal parts of an anchored regular expression.
+#   prefix: A string, the literal text every match starts with.
+#   exact: A boolean, True if the pattern matches only the prefix.
+#   prefix_only: A boolean, True if the pattern is the prefix then '.*'.
+#   infixes: A tuple of strings, other literal text every match contains.
+# pylint:disable-msg=C0103
+Literals = collections.namedtuple('Literals',
+                                  'prefix exact prefix_only infixes')
+
+_ANY_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+# Inline flags change the meaning of the whole pattern.
+_RE_INLINE_FLAGS = re.compile(r'\(\?[iLmsux]+\)')
+
+
+def _is_dot_star(item):
+    op, av = item
+    if op not in _ANY_REPEATS:
+        return False
+    minimum, maximum, sub = av
+    return (minimum == 0 and maximum == sre_constants.MAXREPEAT and
+            list(sub) == [(sre_constants.ANY, None)])
+
+
+def literals(pattern):
+    """Returns the literal parts of a case-insensitive anchored pattern.
+
+    Literal text is returned in lower case, so it should be compared
+    against lower case strings.
+
+    Args:
+      pattern: A string, a regular expression beginning with '^'.
+
+    Returns:
+      A Literals namedtuple, or None if the pattern is not anchored at its
+      start, uses inline flags or is not a valid regular expression.
+    """
+    if _RE_INLINE_FLAGS.search(pattern):
+        return None
+    try:
+        items = list(sre_parse.parse(pattern, re.I))
+    except (sre_constants.error, OverflowError, RuntimeError):
+        return None
+    if not items or items[0] != (sre_constants.AT,
+                                 sre_constants.AT_BEGINNING):
+        return None
+    items = items[1:]
+
+    prefix = []
+    while items and items[0][0] == sre_constants.LITERAL:
+        prefix.append(chr(items.pop(0)[1]))
+    prefix = ''.join(prefix).lower()
+
+    end = (sre_constants.AT, sre_constants.AT_END)
+    exact = items == [end]
+    prefix_only = (len(items) == 2 and _is_dot_star(items[0]) and
+                   items[1] == end)
+
+    infixes = []
+    run = []
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            run.append(chr(av))
+        elif run:
+            infixes.append(''.join(run).lower())
+            run = []
+    if run:
+        infixes.append(''.join(run).lower())
+    return Literals(prefix=prefix, exact=exact, prefix_only=prefix_only,
+                    infixes=tuple(infixes))
+
+
+def combinable(pattern):
+    """Returns True if pattern can be joined with others in an alternation.
+
+    Patterns using inline flags, named groups or back-references change
+    meaning when combined with other patterns.
+    """
+    if _RE_INLINE_FLAGS.search(pattern) or '(?P' in pattern:
+        return False
+    return re.search(r'\\[1-9]', pattern) is None
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A cache of device request results, for read-only requests.
+
+Requests opt in to the cache by giving a maximum age of result they will
+accept. A result that old or newer is returned without a device request,
+and concurrent identical requests share one device request. Requests
+that change a device (see WRITE_METHODS) discard its cached results.
+"""
+
+import collections
+import time
+
+import lru
+
+
+# Device API methods whose results may be cached.
+CACHEABLE_METHODS = frozenset(['command', 'get_config'])
+
+# Device API methods that change the device, invalidating its results.
+WRITE_METHODS = frozenset(['set_config', 'upload_file', 'copy_file',
+                           'delete_file'])
+
+# The request arguments identifying a result. Requests with any other
+# argument (e.g., a streaming callback) are not cached.
+KEY_ARGUMENTS = ('device_name', 'command', 'source', 'mode', 'encoding',
+                 'connect_method', 'user', 'privilege_level')
+
+# Default maximum number of results cached.
+DEFAULT_MAXIMUM_SIZE = 1024
+
+# Default maximum total size (in bytes) of the results cached.
+DEFAULT_MAXIMUM_BYTES = 64 * 1024 * 1024
+
+
+# A cached result, the time it was received and its size in bytes.
+CachedResult = collections.namedtuple('CachedResult', 'result time size')
+
+
+def result_size(result):
+    """Returns the approximate size (in bytes) of a request result."""
+    if isinstance(result, basestring):
+        return len(result)
+    elif isinstance(result, dict):
+        return sum(result_size(v) for v in result.itervalues())
+    return 0
+
+
+class ResultCache(object):
+    """A least recently used cache of request results.
+
+    Attributes:
+      maximum_bytes: An int, the maximum total size of the results cached.
+      bytes: An int, the total size of the results cached.
+      hits: An int, the number of requests answered from the cache.
+      misses: An int, the number of cacheable requests executed.
+    """
+
+    def __init__(self, maximum_size=DEFAULT_MAXIMUM_SIZE,
+                 maximum_bytes=DEFAULT_MAXIMUM_BYTES):
+        self._results = lru.LruDict(expire_callback=self._expired,
+                                    maximum_size=maximum_size)
+        self._in_flight = lru.Coalescer()
+        # Cached keys, by device name.
+        self._device_keys = {}
+        # Counts writes to each device, so results of requests running
+        # across a write are not cached.
+        self._generations = collections.defaultdict(int)
+        self.maximum_bytes = maximum_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    @staticmethod
+    def key(method, kwargs):
+        """Returns the cache key for a request, or None if not cacheable."""
+        if method not in CACHEABLE_METHODS:
+            return None
+        for name in kwargs:
+            if name not in KEY_ARGUMENTS:
+                return None
+        return (method, ) + tuple(kwargs.get(name) for name in KEY_ARGUMENTS)
+
+    def call(self, method, kwargs, max_age, func):
+        """Returns a result for the request, calling func if none is cached.
+
+        Args:
+          method: A string, the device API method name.
+          kwargs: A dict, the request's keyword arguments.
+          max_age: A float, the greatest age (in seconds) of a cached
+            result returned.
+          func: A callable, executes the request, returning its result.
+
+        Returns:
+          The cached result, or func's (possibly shared) result.
+        """
+        key = self.key(method, kwargs)
+        if key is None or not max_age or max_age < 0:
+            return func()
+        cached = self._results.get(key)
+        if cached is not None and time.time() - cached.time <= max_age:
+            self.hits += 1
+            return cached.result
+        return self._in_flight.call(key, self._execute, key, func)
+
+    def _execute(self, key, func):
+        self.misses += 1
+        device_name = key[1]
+        generation = self._generations.get(device_name, 0)
+        result = func()
+        if self._generations.get(device_name, 0) == generation:
+            self._store(key, result)
+        return result
+
+    def _store(self, key, result):
+        size = result_size(result)
+        if size > self.maximum_bytes:
+            return
+        self._discard(key)
+        self._results[key] = CachedResult(result, time.time(), size)
+        self._device_keys.setdefault(key[1], set()).add(key)
+        self.bytes += size
+        while self.bytes > self.maximum_bytes and self._results:
+            self._results.expire_item(return_copy=False)
+
+    def _expired(self, key, cached):
+        """Called by the LRU as results are evicted."""
+        self.bytes -= cached.size
+        keys = self._device_keys.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._device_keys[key[1]]
+
+    def _discard(self, key):
+        cached = self._results.get(key)
+        if cached is not None:
+            self._expired(key, cached)
+            del self._results[key]
+
+    def invalidate(self, device_name):
+        """Discards all results for a device (e.g., after a write)."""
+        self._generations[device_name] += 1
+        for key in list(self._device_keys.get(device_name, ())):
+            self._discard(key)
@@ -27,9 +27,11 @@ keeping devices connected until idle timers expire.
 import base64
 import collections
 import logging
-import threading
 import time
 
+import eventlet
+from eventlet import semaphore
+
 import errors
 
 
@@ -37,6 +39,38 @@ import errors
 SessionKey = collections.namedtuple(
     'SessionKey', 'device_name connect_method user privilege_level')
 
+# Encodings of string results a request may ask for (the 'encoding'
+# argument). 'base64' (the default) encodes the result. 'text' returns a
+# dict with the 'encoding' used and the 'data': the result itself when it
+# is valid UTF-8, else base64 encoded. 'binary' returns the result as is,
+# for transports able to carry it (e.g., the stream API).
+ENCODING_BASE64 = 'base64'
+ENCODING_TEXT = 'text'
+ENCODING_BINARY = 'binary'
+ENCODINGS = (ENCODING_BASE64, ENCODING_TEXT, ENCODING_BINARY)
+
+
+def encode_result(result, encoding=None):
+    """Encodes a request result as the client asked.
+
+    Args:
+      result: The device method's result. Only strings are encoded.
+      encoding: A string, one of ENCODINGS, or None for ENCODING_BASE64.
+
+    Returns:
+      The encoded result.
+    """
+    if not isinstance(result, str) or encoding == ENCODING_BINARY:
+        return result
+    if encoding == ENCODING_TEXT:
+        try:
+            result.decode('utf-8')
+            return {'encoding': ENCODING_TEXT, 'data': result}
+        except UnicodeDecodeError:
+            return {'encoding': ENCODING_BASE64,
+                    'data': base64.b64encode(result)}
+    return base64.b64encode(result)
+
 
 class Session(object):
     """A session manages a connections and requests to a device."""
@@ -46,13 +80,35 @@ class Session(object):
                       'copy_file', 'upload_file', 'download_file',
                       'delete_file', 'lock', 'unlock')
 
-    def __init__(self, device=None):
+    # The device's vendor (a device_factory.VENDOR_MAP key), if known.
+    vendor = None
+
+    def __init__(self, device=None, admission=None):
         # TODO(afort): Allow devices to have multiple authentication
         # credentials available (e.g., during password changes).
-        self._exclusive = threading.Lock()
+
+        # Devices executing each request on its own channel (e.g., SSHv2
+        # exec sessions) may run several requests at once.
+        self.max_concurrent_requests = max(
+            1, getattr(device, 'MAX_CONCURRENT_REQUESTS', 1) or 1)
+        self._exclusive = semaphore.BoundedSemaphore(
+            self.max_concurrent_requests)
+        # Serialises connection state changes between concurrent requests.
+        # Requests run in greenthreads, so these are eventlet primitives.
+        self._connection_lock = semaphore.Semaphore()
+        self._active_requests = 0
+        # True whilst a liveness probe is using the connection.
+        self._probing = False
+        # Sent when the probe completes, for requests waiting on it.
+        self._probe_done = None
 
         self.device = device
+        self.vendor = getattr(device, 'vendor', None)
         self._credential = None
+        # An admission.AdmissionController the session holds a slot of
+        # whilst connected, or None.
+        self.admission = admission
+        self._admitted = False
 
         self._connected = False
         self.idle = True
@@ -61,6 +117,7 @@ class Session(object):
         self.time_last_disconnect = None
         self.time_last_response = None
         self.time_last_request = None
+        self.time_last_probe = None
 
         self._bytes_sent = 0
         self._bytes_recv = 0
@@ -112,8 +169,34 @@ class Session(object):
 
     credential = property(_credential, _set_credential)
 
-    def connect(self):
-        """Connects the session using the current Credential."""
+    @property
+    def active_requests(self):
+        """The number of requests presently executing on this session."""
+        return self._active_requests
+
+    def _count_request(self, delta):
+        """Updates the active request count (and idle flag) by delta.
+
+        Doesn't yield to other greenthreads, so a request is counted
+        before a probe can start.
+        """
+        self._active_requests += delta
+        self.idle = not self._active_requests
+        if self.idle and self._admitted:
+            # Sessions waiting for our admission slot may now take it.
+            self.admission.idle(self)
+
+    def connect(self, wait=True):
+        """Connects the session using the current Credential.
+
+        Args:
+          wait: A boolean, if False, fail at once (rather than waiting,
+            or disconnecting idle sessions) if the session isn't admitted.
+
+        Raises:
+          AdmissionQueueFullError, AdmissionTimeoutError: The session was
+            not admitted (see admission).
+        """
         if self.device is None:
             return
         elif self._connected:
@@ -121,11 +204,32 @@ class Session(object):
         if self._credential is None:
             raise errors.NoMatchingCredentialError()
 
-        self.device.connect(credential=self._credential,
-                            connect_method=self._credential.connect_method)
-        self.time_last_connect = time.time()
-        self._connected = True
-        self.idle = True
+        self._connection_lock.acquire()
+        try:
+            # Another request may have connected whilst we waited.
+            if self._connected:
+                return
+            if self.admission is not None and not self._admitted:
+                if wait:
+                    self.admission.acquire(self, self.device.name,
+                                           self.vendor)
+                else:
+                    self.admission.acquire(self, self.device.name,
+                                           self.vendor, timeout=0,
+                                           reclaim=False)
+                self._admitted = True
+            try:
+                self.device.connect(
+                    credential=self._credential,
+                    connect_method=self._credential.connect_method)
+            except:
+                self._release_admission()
+                raise
+            self.time_last_connect = time.time()
+            self._connected = True
+            self.idle = not self._active_requests
+        finally:
+            self._connection_lock.release()
 
     def disconnect(self):
         """Disconnects the session."""
@@ -133,51 +237,147 @@ class Session(object):
             return
         elif not self._connected:
             return
-        self.device.disconnect()
-        self.time_last_disconnect = time.time()
-        self._connected = False
-        self.idle = True
+        self._connection_lock.acquire()
+        try:
+            if not self._connected:
+                return
+            self.device.disconnect()
+            self.time_last_disconnect = time.time()
+            self._connected = False
+            self._release_admission()
+            self.idle = not self._active_requests
+        finally:
+            self._connection_lock.release()
+
+    def _release_admission(self):
+        """Gives up the session's admission slot, if it holds one."""
+        if self._admitted:
+            self._admitted = False
+            self.admission.release(self)
+
+    @property
+    def probing(self):
+        """True whilst a liveness probe is using the connection."""
+        return self._probing
+
+    @property
+    def time_last_active(self):
+        """The time the connection was last known to be in use, or None."""
+        times = [t for t in (self.time_last_connect, self.time_last_request,
+                             self.time_last_response, self.time_last_probe)
+                 if t is not None]
+        return max(times or [None])
+
+    def probe(self):
+        """Checks that the device of an idle, connected session responds.
+
+        Devices not responding are disconnected, so that the next request
+        connects again rather than failing (and retrying) first. Requests
+        made during the probe wait for it to complete.
+
+        Returns:
+          True if the device responded, False if it did not (and was
+          disconnected) or None if the session was busy or not connected.
+        """
+        if self.device is None or not self._exclusive.acquire(False):
+            return None
+        try:
+            if (self._probing or not self._connected or
+                self._active_requests):
+                return None
+            # Set before releasing the lock, so requests wait for us.
+            # Requests holding a slot are already counted as active.
+            self._probing = True
+            self._probe_done = eventlet.event.Event()
+        finally:
+            self._exclusive.release()
+        try:
+            try:
+                alive = self.device.alive()
+            except Exception, e:
+                logging.debug('Probe of %s failed. %s: %s', self,
+                              e.__class__.__name__, str(e))
+                alive = False
+            self.time_last_probe = time.time()
+            if not alive:
+                logging.debug('Disconnecting session %s (probe failed).', self)
+                try:
+                    self.disconnect()
+                except Exception, e:
+                    logging.debug('Disconnect of %s failed. %s: %s', self,
+                                  e.__class__.__name__, str(e))
+                    self._connected = False
+                    self._release_admission()
+            return alive
+        finally:
+            self._probing = False
+            self._probe_done.send()
+            if self.idle and self._admitted:
+                self.admission.idle(self)
 
     def request(self, method, *args, **kwargs):
-        """Executes a request on this session."""
+        """Executes a request on this session.
+
+        Up to max_concurrent_requests requests execute at once; further
+        requests wait for one of them to complete. String results are
+        encoded as the optional 'encoding' argument asks (see ENCODINGS).
+        """
+        encoding = kwargs.pop('encoding', None)
+        if encoding is not None and encoding not in ENCODINGS:
+            raise errors.InvalidRequestError(
+                'Encoding %r not one of %s.' % (encoding, ', '.join(ENCODINGS)))
         result = None
         logging.debug('Acquiring lock for %s', self)
         self._exclusive.acquire()
         try:
             logging.debug('Acquired lock for %s', self)
-            # Check the method name is valid.
-            if not method in self.valid_requests:
-                raise errors.InvalidRequestError(
-                    'Method %r not part of the device API.' % method)
-            if self.device is None:
-                raise errors.InvalidDeviceError('Device not yet initialised.')
-            if not self._connected:
-                self.connect()
-            # Execute the method.
-            self.time_last_request = time.time()
-            device_method = getattr(self.device, method)
-
-            self.idle = False
+            while self._probing:
+                self._probe_done.wait()
+            # Counted (without yielding) as soon as the probe is done, so
+            # no probe starts whilst this request connects or executes.
+            self._count_request(1)
             try:
+                # Check the method name is valid.
+                if not method in self.valid_requests:
+                    raise errors.InvalidRequestError(
+                        'Method %r not part of the device API.' % method)
+                if self.device is None:
+                    raise errors.InvalidDeviceError(
+                        'Device not yet initialised.')
+                if not self._connected:
+                    self.connect()
+                # Execute the method.
+                self.time_last_request = time.time()
+                device_method = getattr(self.device, method)
+
                 # Remove the device_name argument not used in device.py.
                 # TODO(afort): device.py/subclasses to take **kwargs instead?
                 if 'device_name' in kwargs:
                     del kwargs['device_name']
+                # Note when streamed output has been passed on, as the
+                # request cannot then be retried without repeating it.
+                streamed = []
+                callback = kwargs.get('callback')
+                if callback is not None:
+                    def stream(data):
+                        if not streamed:
+                            streamed.append(True)
+                        callback(data)
+                    kwargs['callback'] = stream
                 try:
                     # May raise any exception, we'll trigger a retry
                     # upon API errors with the retry attribute set.
                     result = device_method(*args, **kwargs)
-                    # We must now base64 encode the string result,
-                    # incase it contains binary data.
-
                 except errors.ApiError, e:
-                    # Normally, we'll disconnect upon error just incase.
-                    if e.disconnect_on_error:
+                    # Normally, we'll disconnect upon error just incase,
+                    # unless other requests are still using the connection
+                    # (only this request's channel failed).
+                    if e.disconnect_on_error and self._active_requests == 1:
                         logging.debug(
                             'Disconnecting session %s (error occured).', self)
                         self.disconnect()
                     # Single optional retry.
-                    if e.retry:
+                    if e.retry and not streamed:
                         logging.debug('Retrying request on session %s.', self)
                         self.connect()
                         result = device_method(*args, **kwargs)
@@ -185,16 +385,16 @@ class Session(object):
                         raise e
                 self.time_last_response = time.time()
             finally:
-                self.idle = True
+                self._count_request(-1)
 
         finally:
             logging.debug('Releasing lock for %s', self)
             self._exclusive.release()
 
         try:
-            return base64.b64encode(result)
+            return encode_result(result, encoding)
         except Exception, e:
-            logging.error('Error base64 encoding result. '
+            logging.error('Error encoding result. '
                           '%s: %s. Original result: %r',
                           e.__class__.__name__, str(e), result)
             return result
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmarks command output clean up.
+
+Compares the transport's OutputCleaner, run once over the assembled
+output, with the previous clean up: each strip character, dos2unix and
+each ANSI expression replaced in turn, for every page.
+
+Usage: cleanup_benchmark.py [lines] [page_lines]
+"""
+
+import re
+import sys
+import timeit
+
+from notch.agent.devices import trans
+
+
+LINES = 200000
+PAGE_LINES = 24
+REPEAT = 3
+
+# As used by the Nortel BayStack device.
+STRIP_CHARS = ['\b ', '\b']
+
+# The ANSI clean up used before OutputCleaner.
+OLD_STRIP_ANSI = [
+    re.compile(r'\x1b(?:\[|\(?:|\))[;?0-9]*[0-9A-Za-z]'),
+    re.compile(r'\x1b(?:\[|\(?:|\))[;?0-9]*[0-9A-Za-z]'),
+    re.compile(r'[\x03\x1a]'),
+    ]
+
+
+def make_pages(lines, page_lines):
+    pages = []
+    page = []
+    for i in xrange(lines):
+        if not page:
+            # Erase the pager prompt.
+            page.append('\b \b' * 8 + '\x1b[2K')
+        page.append('interface Ethernet%d\r\n no shutdown\r\n' % i)
+        if len(page) == page_lines:
+            pages.append(''.join(page))
+            page = []
+    if page:
+        pages.append(''.join(page))
+    return pages
+
+
+def old_cleanup(pages):
+    result = []
+    for data in pages:
+        for strip_char in STRIP_CHARS:
+            data = data.replace(strip_char, '')
+        data = data.replace('\r\n', '\n')
+        data = data.replace('\r\n', '\n')
+        for reg in OLD_STRIP_ANSI:
+            data = reg.sub('', data)
+        result.append(data)
+    return ''.join(result)
+
+
+def new_cleanup(pages):
+    cleaner = trans.OutputCleaner(strip_ansi=True, dos2unix=True,
+                                  strip_chars=STRIP_CHARS)
+    return cleaner.clean(''.join(pages))
+
+
+def main(argv):
+    try:
+        lines = int(argv[1])
+    except (IndexError, ValueError):
+        lines = LINES
+    try:
+        page_lines = int(argv[2])
+    except (IndexError, ValueError):
+        page_lines = PAGE_LINES
+
+    pages = make_pages(lines, page_lines)
+    if old_cleanup(pages) != new_cleanup(pages):
+        print 'Clean up results differ.'
+        return 1
+
+    size = sum(len(page) for page in pages)
+    print '%d bytes in %d pages' % (size, len(pages))
+    for name, func in (('old', old_cleanup), ('new', new_cleanup)):
+        elapsed = min(timeit.repeat(lambda: func(pages), number=1,
+                                    repeat=REPEAT))
+        print '%s: %.3fs (%.1f MB/s)' % (name, elapsed,
+                                         size / elapsed / 1e6)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -55,7 +55,8 @@ setuptools.setup(
                       'tornadorpc',
                       ],
     tests_require=tests_require,
-    extras_require={'test': tests_require},
+    extras_require={'test': tests_require,
+                    'inotify': ['pyinotify']},
     test_suite='tests',
     url='http://code.google.com/p/notch/',
     author='Andrew Fort',
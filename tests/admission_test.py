@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the admission module."""
+
+import unittest
+
+import eventlet
+
+from notch.agent import admission
+from notch.agent import errors
+
+
+class TestAdmissionController(unittest.TestCase):
+
+    def setUp(self):
+        self.admitted = []
+
+    def _spawn(self, controller, holder, device_name, vendor='cisco',
+               timeout=None):
+        """Acquires for holder in a greenthread, noting when admitted."""
+        def acquire():
+            controller.acquire(holder, device_name, vendor, timeout=timeout)
+            self.admitted.append(holder)
+        thread = eventlet.spawn(acquire)
+        eventlet.sleep(0)
+        return thread
+
+    def testUnlimited(self):
+        controller = admission.AdmissionController()
+        for i in xrange(10):
+            controller.acquire(i, 'xr1', 'cisco')
+        self.assertEqual(controller.active[admission.AGENT], 10)
+        for i in xrange(10):
+            controller.release(i)
+        self.assertEqual(dict(controller.active), {})
+
+    def testSessionHoldsOneSlot(self):
+        controller = admission.AdmissionController(max_sessions_per_device=1)
+        controller.acquire('s1', 'xr1', 'cisco')
+        controller.acquire('s1', 'xr1', 'cisco')
+        self.assertEqual(controller.active[('device', 'xr1')], 1)
+        controller.release('s1')
+        self.assertRaises(errors.AdmissionTimeoutError, controller.acquire,
+                          's2', 'xr1', 'cisco', timeout=0)
+        controller.release('s1')
+        controller.acquire('s2', 'xr1', 'cisco')
+
+    def testDeviceLimit(self):
+        controller = admission.AdmissionController(max_sessions_per_device=2)
+        controller.acquire('s1', 'xr1', 'cisco')
+        controller.acquire('s2', 'xr1', 'cisco')
+        controller.acquire('s3', 'xr2', 'cisco')
+        waiting = self._spawn(controller, 's4', 'xr1')
+        self.assertEqual(len(controller), 1)
+        self.assertEqual(self.admitted, [])
+        controller.release('s3')
+        eventlet.sleep(0)
+        self.assertEqual(self.admitted, [])
+        controller.release('s1')
+        waiting.wait()
+        self.assertEqual(self.admitted, ['s4'])
+        self.assertEqual(len(controller), 0)
+
+    def testVendorAndAgentLimits(self):
+        controller = admission.AdmissionController(
+            max_sessions=3, max_sessions_per_vendor={'juniper': 1})
+        controller.acquire('s1', 'cr1', 'juniper')
+        self.assertRaises(errors.AdmissionTimeoutError, controller.acquire,
+                          's2', 'cr2', 'juniper', timeout=0)
+        controller.acquire('s3', 'xr1', 'cisco')
+        controller.acquire('s4', 'xr2', 'cisco')
+        self.assertRaises(errors.AdmissionTimeoutError, controller.acquire,
+                          's5', 'xr3', 'cisco', timeout=0)
+        self.assertEqual(len(controller), 0)
+
+    def testAdmittedInArrivalOrder(self):
+        controller = admission.AdmissionController(max_sessions=1)
+        controller.acquire('s0', 'xr0', 'cisco')
+        threads = [self._spawn(controller, 's%d' % i, 'xr%d' % i)
+                   for i in xrange(1, 4)]
+        for i in xrange(3):
+            controller.release('s%d' % i)
+            threads[i].wait()
+        self.assertEqual(self.admitted, ['s1', 's2', 's3'])
+
+    def testPassedOverWhilstDeviceFull(self):
+        controller = admission.AdmissionController(max_sessions=2,
+                                                   max_sessions_per_device=1)
+        controller.acquire('s1', 'xr1', 'cisco')
+        controller.acquire('s2', 'xr2', 'cisco')
+        first = self._spawn(controller, 's3', 'xr1')
+        second = self._spawn(controller, 's4', 'xr3')
+        # The agent slot freed goes to s4, as s3's device is still full.
+        controller.release('s2')
+        second.wait()
+        self.assertEqual(self.admitted, ['s4'])
+        # s3 then takes the next agent slot, ahead of a later arrival.
+        later = self._spawn(controller, 's5', 'xr5')
+        controller.release('s1')
+        first.wait()
+        eventlet.sleep(0)
+        self.assertEqual(self.admitted, ['s4', 's3'])
+        controller.release('s3')
+        later.wait()
+        self.assertEqual(self.admitted, ['s4', 's3', 's5'])
+
+    def testQueueFull(self):
+        controller = admission.AdmissionController(max_sessions=1,
+                                                   max_queue_size=1)
+        controller.acquire('s1', 'xr1', 'cisco')
+        waiting = self._spawn(controller, 's2', 'xr2')
+        self.assertRaises(errors.AdmissionQueueFullError, controller.acquire,
+                          's3', 'xr3', 'cisco')
+        controller.release('s1')
+        waiting.wait()
+
+    def testTimeout(self):
+        controller = admission.AdmissionController(max_sessions=1,
+                                                   timeout=0.02)
+        controller.acquire('s1', 'xr1', 'cisco')
+        self.assertRaises(errors.AdmissionTimeoutError, controller.acquire,
+                          's2', 'xr2', 'cisco')
+        self.assertEqual(len(controller), 0)
+        controller.release('s1')
+        self.assertEqual(dict(controller.active), {})
+
+    def testInterruptedWhilstWaiting(self):
+        controller = admission.AdmissionController(max_sessions=1)
+        controller.acquire('s1', 'xr1', 'cisco')
+        timeout = eventlet.Timeout(0.01, errors.RequestTimeoutError())
+        try:
+            self.assertRaises(errors.RequestTimeoutError, controller.acquire,
+                              's2', 'xr2', 'cisco')
+        finally:
+            timeout.cancel()
+        self.assertEqual(len(controller), 0)
+        controller.release('s1')
+        controller.acquire('s3', 'xr3', 'cisco')
+
+    def testReclaim(self):
+        reclaimed = []
+        controller = admission.AdmissionController(
+            max_sessions=2, reclaim_callback=lambda r, h: reclaimed.append(
+                (r, sorted(h))))
+        controller.acquire('s1', 'xr1', 'cisco')
+        controller.acquire('s2', 'xr2', 'cisco')
+        self.assertRaises(errors.AdmissionTimeoutError, controller.acquire,
+                          's3', 'xr3', 'cisco', timeout=0, reclaim=False)
+        self.assertEqual(reclaimed, [])
+        waiting = self._spawn(controller, 's4', 'xr4')
+        self.assertEqual(reclaimed, [(admission.AGENT, ['s1', 's2'])])
+        # A session going idle whilst s4 waits is offered up alone.
+        controller.idle('s2')
+        self.assertEqual(reclaimed[1:], [(admission.AGENT, ['s2'])])
+        controller.release('s2')
+        waiting.wait()
+        controller.idle('s1')
+        self.assertEqual(len(reclaimed), 2)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the compression module."""
+
+import unittest
+import zlib
+
+import tornado.httputil
+
+from notch.agent import applications
+from notch.agent import compression
+
+
+BODY = '{"result": "%s"}' % ('interface Ethernet0\\n no shutdown\\n' * 500)
+
+
+def gunzip(data):
+    return zlib.decompress(data, compression.GZIP_WBITS)
+
+
+class FakeRequest(object):
+
+    def __init__(self, accept_encoding=None):
+        self.headers = tornado.httputil.HTTPHeaders()
+        if accept_encoding is not None:
+            self.headers['Accept-Encoding'] = accept_encoding
+
+
+class TestAcceptEncoding(unittest.TestCase):
+
+    def testAcceptsGzip(self):
+        for value in ('gzip', 'deflate, gzip', 'GZIP;q=0.5', '*',
+                      'br, gzip ; q=1.0'):
+            self.assertTrue(compression.accepts_gzip(value), value)
+
+    def testRefusesGzip(self):
+        for value in (None, '', 'identity', 'deflate', 'gzip;q=0',
+                      'gzip;q=0.0, deflate', 'gzip;q=x', 'x-gzip2'):
+            self.assertFalse(compression.accepts_gzip(value), value)
+
+    def testCompressible(self):
+        self.assertTrue(compression.compressible('application/json-rpc'))
+        self.assertTrue(compression.compressible('text/html; charset=UTF-8'))
+        self.assertFalse(compression.compressible('image/png'))
+        self.assertFalse(compression.compressible(None))
+        self.assertFalse(compression.compressible('text/plain', 'gzip'))
+
+
+class TestGzipTransform(unittest.TestCase):
+
+    def setUp(self):
+        self.transform_class = compression.gzip_transform(level=6,
+                                                          min_length=100)
+
+    def _headers(self, **kwargs):
+        headers = {'Content-Type': 'application/json-rpc'}
+        headers.update(kwargs)
+        return headers
+
+    def testCompleteBodyCompressed(self):
+        transform = self.transform_class(FakeRequest('gzip'))
+        headers, chunk = transform.transform_first_chunk(
+            self._headers(**{'Content-Length': str(len(BODY))}), BODY, True)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(headers['Content-Length'], str(len(chunk)))
+        self.assertTrue(len(chunk) * 10 < len(BODY))
+        self.assertEqual(gunzip(chunk), BODY)
+
+    def testShortBodyNotCompressed(self):
+        transform = self.transform_class(FakeRequest('gzip'))
+        headers, chunk = transform.transform_first_chunk(
+            self._headers(), '{}', True)
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(chunk, '{}')
+
+    def testNotAccepted(self):
+        transform = self.transform_class(FakeRequest())
+        headers, chunk = transform.transform_first_chunk(
+            self._headers(Vary='Cookie'), BODY, True)
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertEqual(headers['Vary'], 'Cookie, Accept-Encoding')
+        self.assertEqual(chunk, BODY)
+        self.assertEqual(transform.transform_chunk('more', True), 'more')
+
+    def testStreamedPiecesReadableAsSent(self):
+        transform = self.transform_class(FakeRequest('gzip'))
+        decompressor = zlib.decompressobj(compression.GZIP_WBITS)
+        headers, chunk = transform.transform_first_chunk(
+            self._headers(), 'frame 0\n', False)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(decompressor.decompress(chunk), 'frame 0\n')
+        for i in xrange(1, 4):
+            chunk = transform.transform_chunk('frame %d\n' % i, False)
+            self.assertEqual(decompressor.decompress(chunk), 'frame %d\n' % i)
+        chunk = transform.transform_chunk('', True)
+        self.assertEqual(decompressor.decompress(chunk), '')
+        self.assertTrue(decompressor.unused_data == '')
+
+
+class TestGzipResponse(unittest.TestCase):
+
+    def testCompressed(self):
+        headers = [('Content-Type', 'application/json'),
+                   ('Content-Length', str(len(BODY)))]
+        headers, body = compression.gzip_response(headers, [BODY[:10],
+                                                            BODY[10:]])
+        headers = dict(headers)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Content-Length'], str(len(body[0])))
+        self.assertEqual(gunzip(''.join(body)), BODY)
+
+    def testNotCompressed(self):
+        headers = [('Content-Type', 'image/png')]
+        self.assertEqual(compression.gzip_response(headers, [BODY]),
+                         (headers, [BODY]))
+        for kwargs in ({'body': ['{}']},
+                       {'body': [BODY], 'accepted': False}):
+            headers, body = compression.gzip_response(
+                [('Content-Type', 'application/json')], **kwargs)
+            self.assertEqual(body, kwargs['body'])
+            self.assertEqual(headers, [('Content-Type', 'application/json'),
+                                       ('Vary', 'Accept-Encoding')])
+
+    def testVary(self):
+        for vary, expected in ((None, 'Accept-Encoding'),
+                               ('Cookie', 'Cookie, Accept-Encoding'),
+                               ('accept-encoding', 'accept-encoding'),
+                               ('*', '*')):
+            self.assertEqual(compression.vary_accept_encoding(vary), expected)
+
+    def testCompressionOptions(self):
+        self.assertEqual(applications.compression_options(None),
+                         (compression.DEFAULT_LEVEL,
+                          compression.DEFAULT_MIN_LENGTH))
+        self.assertEqual(applications.compression_options(
+            {'options': {'gzip_level': '0', 'gzip_min_length': 10}}), (0, 10))
+        self.assertEqual(applications.compression_options(
+            {'options': {'gzip_level': 'fast', 'gzip_min_length': None}}),
+                         (compression.DEFAULT_LEVEL,
+                          compression.DEFAULT_MIN_LENGTH))
+        self.assertEqual(applications.compression_options(
+            {'options': {'gzip_level': 12}}),
+                         (compression.DEFAULT_LEVEL,
+                          compression.DEFAULT_MIN_LENGTH))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,8 +16,12 @@
 
 """Tests for the controller module."""
 
+import base64
+import eventlet
+import functools
 import ipaddr
 import mox
+import time
 import unittest
 
 from notch.agent import device_manager
@@ -182,5 +186,577 @@ class TestController(unittest.TestCase):
         self.mock.VerifyAll()
 
 
+class TestControllerRequestMatching(unittest.TestCase):
+
+    DEVICES = ['ar1.mel', 'ar1.syd', 'ar2.syd', 'xr1.syd']
+
+    def setUp(self):
+        self.mock = mox.Mox()
+        self.controller = controller.Controller()
+        self.controller.device_manager = self.mock.CreateMock(
+            device_manager.DeviceManager)
+        self.running = 0
+        self.max_running = 0
+        self.controller.request = self.request
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+
+    def request(self, method, device_name=None, delay=0, **unused_kwargs):
+        self.running += 1
+        self.max_running = max(self.running, self.max_running)
+        try:
+            if device_name == 'ar2.syd':
+                raise errors.CommandError('Bad command')
+            elif device_name == 'xr1.syd':
+                eventlet.sleep(1.0)
+            eventlet.sleep(delay)
+            return '%s %s' % (method, device_name)
+        finally:
+            self.running -= 1
+
+    def _expect_devices(self, regexp):
+        self.controller.device_manager.devices_matching(regexp).AndReturn(
+            set(d for d in self.DEVICES if d.startswith(regexp.strip('.*'))))
+        self.mock.ReplayAll()
+
+    def testResultsAndErrorsPerDevice(self):
+        self._expect_devices('ar.*')
+        results = dict((d, (r, e)) for d, r, e in
+                       self.controller.request_matching('command', 'ar.*',
+                                                        command='show ver'))
+        self.assertEqual(sorted(results), ['ar1.mel', 'ar1.syd', 'ar2.syd'])
+        self.assertEqual(results['ar1.mel'], ('command ar1.mel', None))
+        self.assertTrue(isinstance(results['ar2.syd'][1], errors.CommandError))
+        self.mock.VerifyAll()
+
+    def testResultsInCompletionOrder(self):
+        self._expect_devices('.*')
+        order = [d for d, _, _ in self.controller.request_matching(
+            'command', '.*', timeout=0.2)]
+        self.assertEqual(order[0], 'ar2.syd')
+        self.assertEqual(order[-1], 'xr1.syd')
+        self.mock.VerifyAll()
+
+    def testTimeout(self):
+        self._expect_devices('xr.*')
+        results = list(self.controller.request_matching('command', 'xr.*',
+                                                        timeout=0.05))
+        self.assertEqual(len(results), 1)
+        self.assertTrue(isinstance(results[0][2], errors.RequestTimeoutError))
+        self.mock.VerifyAll()
+
+    def testConcurrencyLimited(self):
+        self._expect_devices('ar1.*')
+        results = list(self.controller.request_matching(
+            'command', 'ar1.*', max_concurrency=1, delay=0.02))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(self.max_running, 1)
+        self.mock.VerifyAll()
+
+    def testNoMatchingDevices(self):
+        self._expect_devices('zr.*')
+        self.assertEqual(
+            list(self.controller.request_matching('command', 'zr.*')), [])
+        self.mock.VerifyAll()
+
+
+class TestControllerResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = controller.Controller()
+        self.requests = []
+        self.controller._request = self._request
+
+    def _request(self, method, **kwargs):
+        self.requests.append((method, kwargs))
+        return 'result %d' % len(self.requests)
+
+    def testMaxAgeCaches(self):
+        for _ in xrange(3):
+            self.assertEqual(self.controller.request(
+                'command', device_name='xr1', command='show ver',
+                max_age=30), 'result 1')
+        self.assertEqual(self.requests, [
+            ('command', {'device_name': 'xr1', 'command': 'show ver'})])
+
+    def testNotCachedByDefault(self):
+        for _ in xrange(2):
+            self.controller.request('command', device_name='xr1',
+                                    command='show ver')
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(len(self.controller.result_cache), 0)
+
+    def testWriteInvalidates(self):
+        self.controller.request('command', device_name='xr1',
+                                command='show run', max_age='30')
+        self.controller.request('set_config', device_name='xr1',
+                                destination='running-config', max_age=30)
+        self.assertEqual(self.controller.request(
+            'command', device_name='xr1', command='show run', max_age=30),
+                         'result 3')
+
+    def testInvalidMaxAge(self):
+        self.assertRaises(errors.InvalidRequestError, self.controller.request,
+                          'command', device_name='xr1', command='show ver',
+                          max_age='soon')
+
+    def testCacheBoundsFromConfig(self):
+        c = controller.Controller({'options': {'result_cache_size': 5,
+                                               'result_cache_bytes': 100}})
+        self.assertEqual(c.result_cache._results.maximum_size, 5)
+        self.assertEqual(c.result_cache.maximum_bytes, 100)
+
+
+class TestControllerCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = controller.Controller()
+        self.requests = []
+        self.controller._request = self._request
+
+    def _request(self, method, **kwargs):
+        self.requests.append((method, kwargs))
+        eventlet.sleep(0.02)
+        if kwargs.get('command') == 'bad':
+            raise errors.CommandError('Invalid input')
+        return '%s %s' % (method, kwargs.get('command'))
+
+    def _concurrently(self, *requests):
+        pool = eventlet.GreenPool()
+        threads = [pool.spawn(functools.partial(self.controller.request,
+                                                method, **kwargs))
+                   for method, kwargs in requests]
+        return threads
+
+    def testIdenticalRequestsShareExecution(self):
+        threads = self._concurrently(
+            *[('command', {'device_name': 'xr1', 'command': 'show ver'})] * 5)
+        self.assertEqual([t.wait() for t in threads],
+                         ['command show ver'] * 5)
+        self.assertEqual(len(self.requests), 1)
+        self.controller.request('command', device_name='xr1',
+                                command='show ver')
+        self.assertEqual(len(self.requests), 2)
+
+    def testDifferentRequestsNotShared(self):
+        threads = self._concurrently(
+            ('command', {'device_name': 'xr1', 'command': 'show ver'}),
+            ('command', {'device_name': 'xr2', 'command': 'show ver'}),
+            ('command', {'device_name': 'xr1', 'command': 'show ver',
+                         'mode': 'shell'}),
+            ('lock', {'device_name': 'xr1'}),
+            ('lock', {'device_name': 'xr1'}),
+            ('set_config', {'device_name': 'xr1'}),
+            ('set_config', {'device_name': 'xr1'}))
+        for thread in threads:
+            thread.wait()
+        self.assertEqual(len(self.requests), 7)
+
+    def testErrorRaisedInEachRequest(self):
+        threads = self._concurrently(
+            *[('command', {'device_name': 'xr1', 'command': 'bad'})] * 3)
+        for thread in threads:
+            self.assertRaises(errors.CommandError, thread.wait)
+        self.assertEqual(len(self.requests), 1)
+
+    def testCachedAndUncachedRequestsShared(self):
+        threads = self._concurrently(
+            ('command', {'device_name': 'xr1', 'command': 'show ver',
+                         'max_age': 30}),
+            ('command', {'device_name': 'xr1', 'command': 'show ver'}))
+        self.assertEqual([t.wait() for t in threads],
+                         ['command show ver'] * 2)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(len(self.controller.result_cache), 1)
+
+
+class WarmDevice(device.Device):
+    """A device counting connections, failing to connect if asked."""
+
+    MAX_IDLE_TIME = 300.0
+
+    def __init__(self, *args, **kwargs):
+        super(WarmDevice, self).__init__(*args, **kwargs)
+        self.connects = 0
+        self.fail = False
+
+    def _connect(self, **kwargs):
+        self.connects += 1
+        if self.fail:
+            raise errors.ConnectError('Connection refused')
+
+    def _disconnect(self):
+        pass
+
+
+class TestControllerWarmPool(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mox.Mox()
+        self.controller = controller.Controller(
+            {'options': {'warm_devices': '^core.*', 'warm_pool_size': 1}})
+        self.controller.device_manager = self.mock.CreateMock(
+            device_manager.DeviceManager)
+        self.controller.credentials = credential.Credentials('')
+        self.controller.credentials.credentials = [
+            credential.Credential(regexp='.*', username='cisco',
+                                  password='router')]
+        self.devices = {}
+        self.controller.sessions = {}
+        for name in ('core1.syd', 'ar1.syd', 'ar2.syd', 'ar3.syd'):
+            self.devices[name] = WarmDevice(name=name, addresses='10.0.0.1')
+            key = session.SessionKey(device_name=name, connect_method=None,
+                                     user=None, privilege_level=None)
+            self.controller.sessions[key] = session.Session(
+                device=self.devices[name])
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+        self.controller._stopped.send()
+
+    def _use(self, device_name, count):
+        for _ in xrange(count):
+            self.controller.device_usage[device_name] = (
+                self.controller.device_usage.get(device_name, 0) + 1)
+
+    def testWarmDevicesSelected(self):
+        self.controller.device_manager.devices_matching('^core.*').AndReturn(
+            set(['core1.syd']))
+        self.mock.ReplayAll()
+        self._use('ar1.syd', 5)
+        self._use('ar2.syd', 1)
+        self._use('ar3.syd', 2)
+        # Most frequently used, then most recently used.
+        self.assertEqual(self.controller._select_warm_devices(),
+                         set(['core1.syd', 'ar1.syd', 'ar3.syd']))
+        self.mock.VerifyAll()
+
+    def testWarmSessionsConnected(self):
+        self.controller.device_manager.devices_matching('^core.*').AndReturn(
+            set(['core1.syd']))
+        self.mock.ReplayAll()
+        self._use('ar2.syd', 1)
+        self.controller._warm_check()
+        eventlet.sleep(0)
+        self.controller._warm_pool.waitall()
+        self.assertEqual(self.controller.warm_devices,
+                         set(['core1.syd', 'ar2.syd']))
+        self.assertEqual(self.devices['core1.syd'].connects, 1)
+        self.assertEqual(self.devices['ar2.syd'].connects, 1)
+        self.assertEqual(self.devices['ar1.syd'].connects, 0)
+        self.mock.VerifyAll()
+
+    def testFailedConnectionsRetriedLater(self):
+        self.controller.device_manager.devices_matching('^core.*').MultipleTimes(
+            ).AndReturn(set(['core1.syd']))
+        self.mock.ReplayAll()
+        self.devices['core1.syd'].fail = True
+        self.controller._warm_check()
+        self.controller._warm_pool.waitall()
+        self.assertTrue('core1.syd' in self.controller._warm_failures)
+        self.controller._warm_check()
+        self.controller._warm_pool.waitall()
+        self.assertEqual(self.devices['core1.syd'].connects, 1)
+        self.controller._warm_failures['core1.syd'] -= (
+            controller.WARM_RETRY_INTERVAL_S)
+        self.devices['core1.syd'].fail = False
+        self.controller._warm_check()
+        self.controller._warm_pool.waitall()
+        self.assertEqual(self.devices['core1.syd'].connects, 2)
+        self.assertFalse('core1.syd' in self.controller._warm_failures)
+        self.mock.VerifyAll()
+
+    def testWarmSessionsNotIdleDisconnected(self):
+        self.controller.warm_devices = set(['core1.syd'])
+        for name in ('core1.syd', 'ar1.syd'):
+            sess = self.controller.get_session(device_name=name)
+            sess._connected = True
+            sess.time_last_request = 1.0
+        self.controller._session_idle_check()
+        self.assertTrue(self.controller.get_session(
+            device_name='core1.syd').connected)
+        self.assertFalse(self.controller.get_session(
+            device_name='ar1.syd').connected)
+
+
+class AdmissionDevice(WarmDevice):
+    """A device whose commands take delay seconds, counting disconnects."""
+
+    def __init__(self, *args, **kwargs):
+        super(AdmissionDevice, self).__init__(*args, **kwargs)
+        self.delay = 0
+        self.disconnects = 0
+
+    def _disconnect(self):
+        self.disconnects += 1
+
+    def _command(self, command, mode=None):
+        eventlet.sleep(self.delay)
+        return command
+
+
+class TestControllerAdmission(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = controller.Controller(
+            {'options': {'max_sessions': 2, 'max_sessions_per_device': 1,
+                         'max_sessions_per_vendor': {'juniper': 1,
+                                                     'bogus': 1},
+                         'admission_timeout': 0.1}})
+        self.controller.sessions = {}
+        self.devices = {}
+        for name, vendor in (('xr1', 'cisco'), ('xr2', 'cisco'),
+                             ('cr1', 'juniper'), ('cr2', 'juniper')):
+            for user in (None, 'admin'):
+                dev = AdmissionDevice(name=name, addresses='10.0.0.1')
+                dev.vendor = vendor
+                self.devices[(name, user)] = dev
+                key = session.SessionKey(device_name=name, connect_method=None,
+                                         user=user, privilege_level=None)
+                sess = session.Session(device=dev,
+                                       admission=self.controller.admission)
+                sess.credential = credential.Credential(
+                    regexp='.*', username='cisco', password='router')
+                self.controller.sessions[key] = sess
+
+    def tearDown(self):
+        self.controller._stopped.send()
+
+    def _session(self, device_name, user=None):
+        return self.controller.get_session(device_name=device_name, user=user)
+
+    def _command(self, device_name, user=None):
+        return base64.b64decode(self._session(device_name, user=user).request(
+            'command', command='show ver'))
+
+    def testLimitsFromConfig(self):
+        admission = self.controller.admission
+        self.assertEqual(admission.max_sessions, 2)
+        self.assertEqual(admission.max_sessions_per_device, 1)
+        self.assertEqual(admission.max_sessions_per_vendor, {'juniper': 1})
+        self.assertEqual(admission.timeout, 0.1)
+        admission = controller.Controller().admission
+        self.assertEqual(admission.max_sessions, None)
+        self.assertEqual(admission.max_sessions_per_vendor, {})
+
+    def testConnectedSessionsHoldSlots(self):
+        self.assertEqual(self._command('xr1'), 'show ver')
+        self.assertTrue(self._session('xr1').connected)
+        self.assertEqual(self.controller.admission.active[('device', 'xr1')],
+                         1)
+        self._session('xr1').disconnect()
+        self.assertEqual(dict(self.controller.admission.active), {})
+
+    def testIdleSessionReclaimed(self):
+        self._command('xr1')
+        # Another session key (user) for the device, over its limit.
+        self.assertEqual(self._command('xr1', user='admin'), 'show ver')
+        self.assertFalse(self._session('xr1').connected)
+        self.assertTrue(self._session('xr1', user='admin').connected)
+        self.assertEqual(self.devices[('xr1', None)].disconnects, 1)
+        self.assertEqual(self.controller.admission.active[('device', 'xr1')],
+                         1)
+
+    def testBusySessionNotReclaimed(self):
+        self.devices[('xr1', None)].delay = 0.3
+        busy = eventlet.spawn(self._command, 'xr1')
+        eventlet.sleep(0.01)
+        self.assertRaises(errors.AdmissionTimeoutError, self._command, 'xr1',
+                          user='admin')
+        self.assertEqual(busy.wait(), 'show ver')
+        self.assertTrue(self._session('xr1').connected)
+
+    def testVendorAndAgentLimits(self):
+        for dev in self.devices.itervalues():
+            dev.delay = 0.02
+        connected = []
+        def command(device_name):
+            result = self._command(device_name)
+            connected.append(
+                dict(self.controller.admission.active))
+            return result
+        pool = eventlet.GreenPool()
+        threads = [pool.spawn(command, name)
+                   for name in ('cr1', 'cr2', 'xr1', 'xr2')]
+        self.assertEqual([t.wait() for t in threads], ['show ver'] * 4)
+        for active in connected:
+            self.assertTrue(active[('agent', None)] <= 2)
+            self.assertTrue(active.get(('vendor', 'juniper'), 0) <= 1)
+        self.assertEqual(
+            len([s for s in self.controller.sessions.values()
+                 if s.connected]), 2)
+
+    def testWarmConnectDoesNotWait(self):
+        self.controller.credentials = credential.Credentials('')
+        self.controller.credentials.credentials = [
+            credential.Credential(regexp='.*', username='cisco',
+                                  password='router')]
+        for name in ('xr1', 'xr2'):
+            self._command(name)
+        start = time.time()
+        self.controller._warm_session('cr1')
+        self.assertTrue(time.time() - start < 0.05)
+        self.assertFalse(self._session('cr1').connected)
+        self.assertTrue('cr1' in self.controller._warm_failures)
+        # Nor does it make room by disconnecting idle sessions.
+        self.assertTrue(self._session('xr1').connected)
+        self.assertTrue(self._session('xr2').connected)
+
+
+class TestControllerLivenessCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = controller.Controller(
+            {'timers': {'session_probe_period': 30}})
+        self.controller.sessions = {}
+        self.devices = {}
+        for i in xrange(4):
+            name = 'xr%d.syd' % i
+            self.devices[name] = WarmDevice(name=name, addresses='10.0.0.1')
+            self.devices[name].probes = 0
+            self.devices[name]._alive = functools.partial(self._alive, name)
+            key = session.SessionKey(device_name=name, connect_method=None,
+                                     user=None, privilege_level=None)
+            sess = session.Session(device=self.devices[name])
+            sess.credential = credential.Credential(regexp='.*')
+            sess.connect()
+            sess.time_last_connect = sess.time_last_request = (
+                time.time() - 60 + i)
+            self.controller.sessions[key] = sess
+        self.dead = set()
+
+    def tearDown(self):
+        self.controller._stopped.send()
+
+    def _alive(self, name):
+        self.devices[name].probes += 1
+        return name not in self.dead
+
+    def _session(self, name):
+        return self.controller.get_session(device_name=name)
+
+    def _check(self):
+        self.controller._liveness_check()
+        self.controller._probe_pool.waitall()
+
+    def testIdleSessionsProbed(self):
+        self._session('xr3.syd').time_last_request = time.time()
+        self._check()
+        self.assertEqual([self.devices['xr%d.syd' % i].probes
+                          for i in xrange(4)], [1, 1, 1, 0])
+        # Probed sessions aren't probed again until idle for the period.
+        self._check()
+        self.assertEqual(self.devices['xr0.syd'].probes, 1)
+
+    def testProbesLimited(self):
+        max_probes = controller.MAX_PROBES_PER_CHECK
+        controller.MAX_PROBES_PER_CHECK = 2
+        try:
+            self._check()
+        finally:
+            controller.MAX_PROBES_PER_CHECK = max_probes
+        # Those idle longest first.
+        self.assertEqual([self.devices['xr%d.syd' % i].probes
+                          for i in xrange(4)], [1, 1, 0, 0])
+
+    def testDeadSessionsReaped(self):
+        self.dead.add('xr1.syd')
+        self.dead.add('xr2.syd')
+        self.controller.warm_devices = set(['xr2.syd'])
+        self.controller.credentials = credential.Credentials('')
+        self.controller.credentials.credentials = [
+            credential.Credential(regexp='.*', username='cisco')]
+        self._check()
+        self.controller._warm_pool.waitall()
+        self.assertTrue(self._session('xr0.syd').connected)
+        self.assertFalse(self._session('xr1.syd').connected)
+        # Warm pool sessions are connected again.
+        self.assertTrue(self._session('xr2.syd').connected)
+        self.assertEqual(self.devices['xr2.syd'].connects, 2)
+
+
+class SlowDisconnectDevice(WarmDevice):
+    """A device taking a while to disconnect."""
+
+    MAX_IDLE_TIME = 30.0
+
+    def _disconnect(self):
+        eventlet.sleep(0.1)
+
+
+class TestControllerIdleCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = controller.Controller()
+        self.controller.sessions = {}
+        # Tracked sessions only, rather than all connected sessions.
+        self.controller._idle_checks = 1
+
+    def tearDown(self):
+        self.controller._stopped.send()
+
+    def _session(self, name, idle_time):
+        dev = SlowDisconnectDevice(name=name, addresses='10.0.0.1')
+        sess = session.Session(device=dev)
+        sess.credential = credential.Credential(regexp='.*')
+        sess.connect()
+        sess.time_last_request = time.time() - idle_time
+        key = session.SessionKey(device_name=name, connect_method=None,
+                                 user=None, privilege_level=None)
+        self.controller.sessions[key] = sess
+        self.controller._track_idle(sess)
+        return sess
+
+    def testIdleSessionsDisconnectedInParallel(self):
+        sessions = [self._session('xr%d.syd' % i, 60) for i in xrange(20)]
+        start = time.time()
+        self.controller._session_idle_check()
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertFalse([s for s in sessions if s.connected])
+        self.assertEqual(self.controller._idle_heap, [])
+
+    def testActiveSessionsCheckedAtDeadline(self):
+        sess = self._session('xr1.syd', 10)
+        self.controller._session_idle_check()
+        self.assertTrue(sess.connected)
+        # Not examined again until its idle time would be exceeded.
+        self.assertEqual(len(self.controller._idle_heap), 1)
+        self.assertAlmostEqual(self.controller._idle_heap[0][0],
+                               sess.time_last_request + 30.0)
+        self.controller._track_idle(sess)
+        self.assertEqual(len(self.controller._idle_heap), 1)
+
+    def testUntrackedSessionsFound(self):
+        self.controller._idle_checks = 0
+        sess = self._session('xr1.syd', 60)
+        self.controller._idle_heap = []
+        self.controller._idle_tracked.clear()
+        self.controller._session_idle_check()
+        self.assertFalse(sess.connected)
+
+    def testFailedSessionCheckSkipped(self):
+        bad = self._session('xr0.syd', 60)
+        bad.time_last_request = 'invalid'
+        sessions = [self._session('xr%d.syd' % i, 60) for i in xrange(1, 4)]
+        self.controller._session_idle_check()
+        self.assertFalse([s for s in sessions if s.connected])
+        self.assertTrue(bad.connected)
+        self.assertEqual(self.controller._idle_heap, [])
+
+    def testRequestTracksSession(self):
+        sess = self._session('xr1.syd', 0)
+        self.controller._idle_heap = []
+        self.controller._idle_tracked.clear()
+        self.controller.credentials = credential.Credentials('')
+        self.controller.credentials.credentials = [
+            credential.Credential(regexp='.*', username='cisco')]
+        sess.device._command = lambda command, mode=None: command
+        self.controller.request('command', device_name='xr1.syd',
+                                command='show ver')
+        self.assertEqual([entry[2] for entry in self.controller._idle_heap],
+                         [sess])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -120,5 +120,58 @@ class TestYamlCredentials(unittest.TestCase):
         self.assertRaises(TypeError, creds.get_credential, 5)
 
 
+class TestCredentialIndex(unittest.TestCase):
+
+    REGEXPS = ['^ar1\.syd$', 'AR.*', 'xr1\.mel', '(cr|dr)[0-9]+\..*',
+               'ar2.*', '^ar1.*$', 'br1(\.foo)?', '.*\.bne', r'(a)\1.*',
+               '(?P<name>er).*', 'ar1\.syd', 'x.*', '.*']
+
+    HOSTNAMES = ['ar1.syd', 'AR1.SYD', 'ar1.mel', 'ar2.syd', 'xr1.mel',
+                 'xr1.mel2', 'cr12.syd', 'dr1.x', 'br1', 'br1.foo',
+                 'core1.bne', 'aa1', 'er1', 'zz', 'ar1.syd\n']
+
+    def _linear_first_match(self, credentials, hostname):
+        for cred in credentials:
+            if cred.matches(hostname):
+                return cred
+
+    def _credentials(self, regexps):
+        return [credential.Credential(regexp=regexp, username=str(i))
+                for i, regexp in enumerate(regexps)]
+
+    def testMatchesLinearScan(self):
+        # Every suffix of the list, so each kind of credential wins.
+        for start in xrange(len(self.REGEXPS)):
+            creds = self._credentials(self.REGEXPS[start:])
+            index = credential.CredentialIndex(creds)
+            for hostname in self.HOSTNAMES:
+                self.assert_(index.first_match(hostname) is
+                             self._linear_first_match(creds, hostname),
+                             (self.REGEXPS[start:], hostname))
+
+    def testManyCombinedCredentials(self):
+        regexps = ['(ar|br)%d\.(syd|mel)' % i for i in xrange(500)]
+        creds = self._credentials(regexps)
+        index = credential.CredentialIndex(creds)
+        self.assert_(len(index._combined) > 1)
+        for hostname in ('ar0.syd', 'br250.mel', 'ar499.mel', 'ar500.mel'):
+            self.assert_(index.first_match(hostname) is
+                         self._linear_first_match(creds, hostname))
+
+    def testNoMatch(self):
+        creds = self._credentials(['ar.*', 'xr1'])
+        index = credential.CredentialIndex(creds)
+        self.assertEqual(index.first_match('cr1'), None)
+
+    def testCredentialsChangedAfterLoad(self):
+        creds = credential.load_credentials_file(
+                os.path.join(TESTDATA, 'credentials1.yaml'))
+        self.assertEqual(creds.get_credential('zr1').username, 'foo')
+        creds.credentials = self._credentials(['zr.*'])
+        self.assertEqual(creds.get_credential('zr1').username, '0')
+        self.assertRaises(errors.NoMatchingCredentialError,
+                          creds.get_credential, 'ar1.foo')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the dev_paramiko module."""
+
+import socket
+import unittest
+
+import eventlet
+import paramiko
+
+from notch.agent.devices import dev_paramiko
+
+
+class ChannelDevice(dev_paramiko.ParamikoDevice):
+    """A ParamikoDevice executing commands on unconnected channels."""
+
+    def __init__(self, *args, **kwargs):
+        super(ChannelDevice, self).__init__(*args, **kwargs)
+        self.channels = []
+        self.channel_timeout = 0.5
+
+    def _exec_command(self, command, bufsize=-1, combine_stderr=False,
+                      timeout=None):
+        channel = paramiko.Channel(len(self.channels))
+        channel.settimeout(self.channel_timeout)
+        self.channels.append(channel)
+        return (channel.makefile('wb', bufsize),
+                channel.makefile('rb', bufsize),
+                channel.makefile_stderr('rb', bufsize))
+
+
+class TestParamikoDeviceCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.device = ChannelDevice(name='xr1')
+        self.ticks = []
+
+    def _tick(self):
+        while True:
+            self.ticks.append(True)
+            eventlet.sleep(0.01)
+
+    def _send(self, outputs, delay=0.05):
+        """Feeds the device's channel outputs, then EOF, from a greenthread."""
+        eventlet.sleep(0)
+        channel = self.device.channels[-1]
+        for output in outputs:
+            eventlet.sleep(delay)
+            channel._feed(output)
+        eventlet.sleep(delay)
+        channel._handle_eof(None)
+
+    def testOtherGreenthreadsRunWhilstReading(self):
+        ticker = eventlet.spawn(self._tick)
+        sender = eventlet.spawn(self._send, ['Cisco IOS XR\n', 'uptime\n'])
+        try:
+            self.assertEqual(self.device._command('show version'),
+                             'Cisco IOS XR\nuptime\n')
+        finally:
+            ticker.kill()
+        sender.wait()
+        self.assertTrue(len(self.ticks) >= 5)
+
+    def testStreamedOutput(self):
+        data = []
+        sender = eventlet.spawn(self._send, ['a' * 10, 'b' * 10], delay=0.01)
+        self.assertEqual(self.device._command('show run', callback=data.append),
+                         '')
+        sender.wait()
+        self.assertEqual(''.join(data), 'a' * 10 + 'b' * 10)
+
+    def testTimeout(self):
+        self.device.channel_timeout = 0.05
+        self.assertRaises(socket.timeout, self.device._command, 'show clock')
+
+
+if __name__ == '__main__':
+    unittest.main()
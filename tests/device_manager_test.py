@@ -17,10 +17,18 @@
 """Tests for the device_manager module."""
 
 
+import json
+import marshal
 import unittest
 import os
+import re
+import shutil
 import socket
 import sys
+import tempfile
+import time
+
+import eventlet
 
 from notch.agent import device_manager
 from notch.agent import notch_config
@@ -30,8 +38,29 @@ from notch.agent import notch_config
 TESTDATA = os.path.join(os.path.dirname(__file__), 'testdata')
 
 
+def mock_getaddrinfo(hosts, host):
+    """Returns getaddrinfo() results for host's addresses in hosts."""
+    if host not in hosts:
+        raise socket.gaierror(-2, 'Name or service not known')
+    result = []
+    for address in hosts[host]:
+        if ':' in address:
+            result.append((socket.AF_INET6, socket.SOCK_STREAM, 6, '',
+                           (address, 0, 0, 0)))
+        else:
+            result.append((socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                           (address, 0)))
+    return result
+
+
 class DeviceManagerTest(unittest.TestCase):
 
+    def setUp(self):
+        self.getaddrinfo = device_manager.socket.getaddrinfo
+
+    def tearDown(self):
+        device_manager.socket.getaddrinfo = self.getaddrinfo
+
     def testDeviceManagerReadConfigValid1(self):
         config = notch_config.get_config_from_file(
             os.path.join(TESTDATA, 'notch_config.yaml'))
@@ -46,17 +75,14 @@ class DeviceManagerTest(unittest.TestCase):
             self.device_manager.provider('old_rancid_configs'
                                           ).ignore_down_devices, True)
 
-    def _mock_gethostbyname(self, host):
-        if host == 'xr1.foo':
-            return ['10.0.0.1']
-        elif host == 'xr2.foo':
-            return ['10.0.0.2', '10.0.0.3']
-        elif host == 'lr1.foo':
-            return ['10.0.0.2']
+    def _mock_getaddrinfo(self, host, *unused_args):
+        return mock_getaddrinfo({'xr1.foo': ['10.0.0.1'],
+                                 'xr2.foo': ['10.0.0.2', '10.0.0.3'],
+                                 'lr1.foo': ['10.0.0.2']}, host)
 
     def testAddressLookup(self):
         dp = device_manager.DeviceProvider()
-        device_manager.socket.gethostbyname = self._mock_gethostbyname
+        device_manager.socket.getaddrinfo = self._mock_getaddrinfo
 
         self.assertEqual(dp.address_lookup('xr1.foo'), ['10.0.0.1'])
 
@@ -92,7 +118,7 @@ class DeviceManagerTest(unittest.TestCase):
         self.assertEqual(self.device_manager.serve_ready, True)
 
     def testDeviceInfo(self):
-        device_manager.socket.gethostbyname = self._mock_gethostbyname
+        device_manager.socket.getaddrinfo = self._mock_getaddrinfo
         config = notch_config.get_config_from_file(
             os.path.join(TESTDATA, 'simple_config.yaml'))
         # Fudge the path of the router.db files so that it matches the testdata.
@@ -112,7 +138,7 @@ class DeviceManagerTest(unittest.TestCase):
         self.assertEqual(dm.device_info('lr1.foo').device_type, 'cisco')
 
     def testMatchingDevices(self):
-        device_manager.socket.gethostbyname = self._mock_gethostbyname
+        device_manager.socket.getaddrinfo = self._mock_getaddrinfo
         config = notch_config.get_config_from_file(
             os.path.join(TESTDATA, 'simple_config.yaml'))
         # Fudge the path of the router.db files so that it matches the testdata.
@@ -145,16 +171,19 @@ class DeviceManagerTest(unittest.TestCase):
 
 class TestRancidDeviceProvider(unittest.TestCase):
 
-    def _mock_gethostbyname(self, host):
-        if host == 'xr1.foo':
-            return ['10.0.0.1']
-        elif host == 'xr2.foo':
-            return ['10.0.0.3']
-        elif host == 'lr1.foo':
-            return ['10.0.0.2']
+    def setUp(self):
+        self.getaddrinfo = device_manager.socket.getaddrinfo
+
+    def tearDown(self):
+        device_manager.socket.getaddrinfo = self.getaddrinfo
+
+    def _mock_getaddrinfo(self, host, *unused_args):
+        return mock_getaddrinfo({'xr1.foo': ['10.0.0.1'],
+                                 'xr2.foo': ['10.0.0.3'],
+                                 'lr1.foo': ['10.0.0.2']}, host)
 
     def testRancidDeviceProviderNormal(self):
-        device_manager.socket.gethostbyname = self._mock_gethostbyname
+        device_manager.socket.getaddrinfo = self._mock_getaddrinfo
 
         rancid_provider = device_manager.RancidDeviceProvider(
             root=TESTDATA)
@@ -162,7 +191,7 @@ class TestRancidDeviceProvider(unittest.TestCase):
         self.assertEqual(len(rancid_provider.devices), 2)
 
     def testRancidDeviceProviderAllowDown(self):
-        device_manager.socket.gethostbyname = self._mock_gethostbyname
+        device_manager.socket.getaddrinfo = self._mock_getaddrinfo
 
         rancid_provider = device_manager.RancidDeviceProvider(
             root=TESTDATA, ignore_down_devices=True)
@@ -173,5 +202,460 @@ class TestRancidDeviceProvider(unittest.TestCase):
         self.assert_('10.0.0.3' in rancid_provider.devices['xr2.foo'].addresses)
 
 
+class AddressResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lookups = []
+        self.hosts = {'xr1.foo': ['10.0.0.1', '2001:db8::1', '10.0.0.1'],
+                      'xr2.foo': ['10.0.0.2']}
+        self.getaddrinfo = device_manager.socket.getaddrinfo
+        device_manager.socket.getaddrinfo = self._mock_getaddrinfo
+
+    def tearDown(self):
+        device_manager.socket.getaddrinfo = self.getaddrinfo
+
+    def _mock_getaddrinfo(self, host, *unused_args):
+        self.lookups.append(host)
+        eventlet.sleep(0.01)
+        return mock_getaddrinfo(self.hosts, host)
+
+    def testAllAddressesReturned(self):
+        resolver = device_manager.AddressResolver()
+        self.assertEqual(resolver.resolve('xr1.foo'),
+                         ['10.0.0.1', '2001:db8::1'])
+
+    def testResultsCached(self):
+        resolver = device_manager.AddressResolver()
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(resolver.resolve, ['xr2.foo'] * 5))
+        self.assertEqual(results, [['10.0.0.2']] * 5)
+        resolver.resolve('xr2.foo')
+        self.assertEqual(self.lookups, ['xr2.foo'])
+
+    def testResultsExpire(self):
+        resolver = device_manager.AddressResolver(ttl=0.05)
+        resolver.resolve('xr2.foo')
+        eventlet.sleep(0.2)
+        resolver.resolve('xr2.foo')
+        self.assertEqual(self.lookups, ['xr2.foo', 'xr2.foo'])
+
+    def testFailuresNotCached(self):
+        resolver = device_manager.AddressResolver()
+        self.assertRaises(socket.gaierror, resolver.resolve, 'xr3.foo')
+        self.hosts['xr3.foo'] = ['10.0.0.3']
+        self.assertEqual(resolver.resolve('xr3.foo'), ['10.0.0.3'])
+
+    def testProviderScanConcurrent(self):
+        router_db = ['xr%d.foo:cisco:up\n' % i for i in xrange(50)]
+        for i in xrange(50):
+            self.hosts['xr%d.foo' % i] = ['10.0.1.%d' % i]
+        provider = device_manager.RancidDeviceProvider(
+            root=TESTDATA, resolver_concurrency=10)
+        updates = []
+        update = provider._index.update
+        def counted_update(**kwargs):
+            updates.append(kwargs)
+            update(**kwargs)
+        provider._index.update = counted_update
+        start = time.time()
+        self.assertEqual(provider._read_router_db(router_db), 50)
+        # Fifty lookups of 10ms each, ten at a time.
+        self.assertTrue(time.time() - start < 0.2)
+        self.assertEqual(len(provider.devices), 50)
+        self.assertEqual(provider.devices['xr7.foo'].addresses,
+                         ['10.0.1.7'])
+        # The devices are indexed at once.
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(len(provider.devices_matching('^xr.*\\.foo$')), 50)
+
+
+    def testDevicesServedDuringScan(self):
+        self.hosts['slow.foo'] = ['10.0.0.9']
+        def slow_getaddrinfo(host, *args):
+            if host == 'slow.foo':
+                eventlet.sleep(0.5)
+            return self._mock_getaddrinfo(host, *args)
+        device_manager.socket.getaddrinfo = slow_getaddrinfo
+        provider = device_manager.RancidDeviceProvider(root=TESTDATA)
+        provider.scan = lambda: provider._read_router_db(
+            ['xr1.foo:cisco:up\n', 'slow.foo:cisco:up\n'])
+        dm = device_manager.DeviceManager()
+        dm.providers[(100, 'test')] = provider
+        scan = eventlet.spawn(dm.scan_providers)
+        eventlet.sleep(0.1)
+        self.assertFalse(dm.serve_ready)
+        self.assertEqual(dm.device_info('xr1.foo').addresses,
+                         ['10.0.0.1', '2001:db8::1'])
+        self.assertEqual(provider.devices_matching('^xr.*$'),
+                         set(['xr1.foo']))
+        self.assertFalse(dm.serve_ready)
+        # Unknown devices wait for the scan to complete.
+        self.assertEqual(dm.device_info('slow.foo').addresses, ['10.0.0.9'])
+        self.assertTrue(dm.serve_ready)
+        scan.wait()
+
+
+class InventoryTestCase(unittest.TestCase):
+    """Base class for tests scanning router.db files in a temporary root."""
+
+    def setUp(self):
+        self.lookups = []
+        self.hosts = {'xr1.foo': ['10.0.0.1'], 'xr2.foo': ['10.0.0.2'],
+                      'lr1.foo': ['10.0.0.3']}
+        self.getaddrinfo = device_manager.socket.getaddrinfo
+        device_manager.socket.getaddrinfo = self._mock_getaddrinfo
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'rancid')
+        os.makedirs(os.path.join(self.root, 'group1'))
+        os.makedirs(os.path.join(self.root, 'group2'))
+        self._write_router_db('group1', ['xr1.foo', 'xr2.foo'])
+        self._write_router_db('group2', ['lr1.foo'])
+        self.config = {
+            'device_sources': {'rancid': {'provider': 'router.db',
+                                          'root': self.root}},
+            'options': {'inventory_snapshot': os.path.join(self.tempdir,
+                                                           'inventory')}}
+
+    def tearDown(self):
+        device_manager.socket.getaddrinfo = self.getaddrinfo
+        shutil.rmtree(self.tempdir)
+
+    def _mock_getaddrinfo(self, host, *unused_args):
+        self.lookups.append(host)
+        return mock_getaddrinfo(self.hosts, host)
+
+    def _write_router_db(self, group, devices, mtime=None):
+        path = os.path.join(self.root, group, 'router.db')
+        router_db = open(path, 'w')
+        for device in devices:
+            router_db.write('%s:cisco:up\n' % device)
+        router_db.close()
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def _scanned_manager(self):
+        dm = device_manager.DeviceManager(self.config)
+        self.assertFalse(dm.serve_ready)
+        dm.rescan()
+        self.assertTrue(os.path.exists(dm.snapshot_path))
+        del self.lookups[:]
+        return dm
+
+
+class InventorySnapshotTest(InventoryTestCase):
+
+    def testSnapshotRestored(self):
+        self._scanned_manager()
+        dm = device_manager.DeviceManager(self.config)
+        self.assertTrue(dm.serve_ready)
+        self.assertEqual(dm.device_info('xr2.foo'),
+                         device_manager.DeviceInfo('xr2.foo', ['10.0.0.2'],
+                                                   'cisco'))
+        self.assertEqual(dm.devices_matching('.*'),
+                         set(['xr1.foo', 'xr2.foo', 'lr1.foo']))
+        self.assertEqual(self.lookups, [])
+
+    def testRescanReadsOnlyChangedFiles(self):
+        self._scanned_manager()
+        self._write_router_db('group1', ['xr1.foo', 'xr3.foo'],
+                              mtime=time.time() + 10)
+        self.hosts['xr3.foo'] = ['10.0.0.4']
+        dm = device_manager.DeviceManager(self.config)
+        dm.rescan()
+        self.assertEqual(sorted(self.lookups), ['xr1.foo', 'xr3.foo'])
+        self.assertEqual(dm.devices_matching('.*'),
+                         set(['xr1.foo', 'xr3.foo', 'lr1.foo']))
+        self.assertEqual(dm.device_info('xr2.foo'), None)
+        # The reconciled inventory was saved.
+        del self.lookups[:]
+        dm = device_manager.DeviceManager(self.config)
+        self.assertEqual(dm.device_info('xr3.foo').addresses, ['10.0.0.4'])
+        self.assertEqual(self.lookups, [])
+
+    def testRemovedFile(self):
+        self._scanned_manager()
+        shutil.rmtree(os.path.join(self.root, 'group2'))
+        dm = device_manager.DeviceManager(self.config)
+        dm.rescan()
+        self.assertEqual(dm.devices_matching('.*'),
+                         set(['xr1.foo', 'xr2.foo']))
+
+    def testSnapshotOfOtherConfigurationIgnored(self):
+        self._scanned_manager()
+        self.config['device_sources']['rancid']['root'] = TESTDATA
+        dm = device_manager.DeviceManager(self.config)
+        self.assertFalse(dm.serve_ready)
+
+    def testInvalidSnapshotIgnored(self):
+        snapshot = open(self.config['options']['inventory_snapshot'], 'w')
+        snapshot.write('garbage')
+        snapshot.close()
+        dm = device_manager.DeviceManager(self.config)
+        self.assertFalse(dm.serve_ready)
+        self.assertEqual(dm.device_info('lr1.foo').addresses, ['10.0.0.3'])
+
+
+    def _write_snapshot(self, snapshot):
+        snapshot_file = open(self.config['options']['inventory_snapshot'],
+                             'wb')
+        marshal.dump(snapshot, snapshot_file)
+        snapshot_file.close()
+
+    def testMalformedSnapshotIgnored(self):
+        self._scanned_manager()
+        snapshot_file = open(self.config['options']['inventory_snapshot'],
+                             'rb')
+        snapshot = marshal.load(snapshot_file)
+        snapshot_file.close()
+        for path in snapshot['providers']['rancid']['sources']:
+            snapshot['providers']['rancid']['sources'][path] = (1.0, 'x')
+        for malformed in ({'version': device_manager.SNAPSHOT_VERSION},
+                          {'version': device_manager.SNAPSHOT_VERSION,
+                           'providers': ['rancid']},
+                          snapshot):
+            self._write_snapshot(malformed)
+            dm = device_manager.DeviceManager(self.config)
+            self.assertFalse(dm.serve_ready)
+            self.assertEqual(dm.provider('rancid').sources, {})
+            self.assertEqual(dm.device_info('lr1.foo').addresses,
+                             ['10.0.0.3'])
+
+    def testInvalidRescanPeriod(self):
+        self.config['options']['inventory_rescan_period'] = 'often'
+        dm = device_manager.DeviceManager(self.config)
+        self.assertEqual(dm.rescan_period,
+                         device_manager.DEFAULT_RESCAN_PERIOD_S)
+
+
+class IncrementalRescanTest(InventoryTestCase):
+
+    def setUp(self):
+        super(IncrementalRescanTest, self).setUp()
+        self.dm = self._scanned_manager()
+        self.provider = self.dm.provider('rancid')
+        self.read = []
+        read_router_db = self.provider._read_router_db
+        def counting_read_router_db(router_db, **kwargs):
+            router_db = list(router_db)
+            self.read.append(router_db)
+            return read_router_db(router_db, **kwargs)
+        self.provider._read_router_db = counting_read_router_db
+
+    def testUnchangedFilesNotRead(self):
+        self.dm.rescan()
+        self.assertEqual(self.read, [])
+
+    def testTouchedFilesNotParsed(self):
+        path = os.path.join(self.root, 'group1', 'router.db')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.dm.rescan()
+        self.assertEqual(self.read, [])
+        self.assertEqual(self.provider.sources[path].mtime,
+                         os.stat(path).st_mtime)
+
+    def testChangedFileApplied(self):
+        self.assertEqual(self.dm.devices_matching('xr.*'),
+                         set(['xr1.foo', 'xr2.foo']))
+        self.assertEqual(self.dm.devices_matching('lr.*'), set(['lr1.foo']))
+        self._write_router_db('group1', ['xr1.foo', 'xr3.foo'],
+                              mtime=time.time() + 10)
+        self.hosts['xr3.foo'] = ['10.0.0.4']
+        self.dm.rescan()
+        self.assertEqual(self.read, [['xr1.foo:cisco:up\n',
+                                      'xr3.foo:cisco:up\n']])
+        # Only the affected match results are forgotten.
+        self.assertTrue('^lr.*$' in self.provider._match_cache)
+        self.assertFalse('^xr.*$' in self.provider._match_cache)
+        self.assertEqual(self.dm.devices_matching('xr.*'),
+                         set(['xr1.foo', 'xr3.foo']))
+
+    def testUpdateDevices(self):
+        devices = dict(self.provider.devices)
+        del devices['xr1.foo']
+        devices['cr1.foo'] = device_manager.DeviceInfo('cr1.foo', ['10.0.0.9'],
+                                                       'cisco')
+        self.assertEqual(self.provider.update_devices(devices),
+                         (set(['cr1.foo']), set(['xr1.foo'])))
+        self.assertTrue(self.provider.devices is devices)
+
+    def testConcurrentRescansWait(self):
+        scans = []
+        scan = self.provider.scan
+        def slow_scan():
+            scans.append(True)
+            eventlet.sleep(0.05)
+            scan()
+        self.provider.scan = slow_scan
+        first = eventlet.spawn(self.dm.rescan)
+        eventlet.sleep(0)
+        start = time.time()
+        self.dm.rescan()
+        self.assertTrue(time.time() - start >= 0.04)
+        first.wait()
+        self.assertEqual(scans, [True])
+        self.assertTrue(self.dm._scanning is None)
+
+    def testSourceChangesSettle(self):
+        rescans = []
+        self.dm.rescan = lambda: rescans.append(True)
+        settle_time = device_manager.WATCH_SETTLE_TIME_S
+        device_manager.WATCH_SETTLE_TIME_S = 0.05
+        try:
+            for _ in xrange(3):
+                self.dm._source_changed()
+            eventlet.sleep(0.1)
+            self.assertEqual(rescans, [True])
+            self.dm._source_changed()
+            eventlet.sleep(0.1)
+            self.assertEqual(rescans, [True, True])
+        finally:
+            device_manager.WATCH_SETTLE_TIME_S = settle_time
+
+    def testPeriodicRescans(self):
+        rescans = []
+        self.dm.rescan = lambda: rescans.append(True)
+        self.dm.rescan_period = 0.05
+        self.dm.start_rescans()
+        eventlet.sleep(0.12)
+        self.dm.stop_rescans()
+        self.assertEqual(rescans, [True, True])
+
+
+class DevicesInfoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dm = device_manager.DeviceManager()
+        self.dm.serve_ready = True
+        self.first = device_manager.DeviceProvider()
+        self.first.update_devices({
+            'xr1.foo': device_manager.DeviceInfo('xr1.foo', ['10.0.0.1'],
+                                                 'cisco')})
+        self.second = device_manager.DeviceProvider()
+        self.second.update_devices({
+            'xr1.foo': device_manager.DeviceInfo('xr1.foo', ['10.0.1.1'],
+                                                 'juniper'),
+            'lr1.foo': device_manager.DeviceInfo('lr1.foo', '10.0.1.2',
+                                                 'juniper')})
+        self.dm.providers[(200, 'second')] = self.second
+        self.dm.providers[(100, 'first')] = self.first
+
+    def testDevicesInfoMany(self):
+        self.assertEqual(
+            self.dm.devices_info_many(['xr1.foo', 'lr1.foo', 'zz1.foo']),
+            {'xr1.foo': {'device_type': 'cisco', 'addresses': ['10.0.0.1']},
+             'lr1.foo': {'device_type': 'juniper',
+                         'addresses': ['10.0.1.2']}})
+
+    def testDevicesInfoJson(self):
+        names = ['lr1.foo', 'xr1.foo', 'zz1.foo']
+        self.assertEqual(json.loads(self.dm.devices_info_json(names)),
+                         self.dm.devices_info_many(names))
+        self.assertEqual(json.loads(self.dm.devices_info_json([])), {})
+
+    def testRecordsCached(self):
+        record = self.first.device_record('xr1.foo')
+        self.assertTrue(self.first.device_record('xr1.foo') is record)
+        self.assertEqual(self.first.device_record('zz1.foo'), None)
+        # Records of changed devices are built again.
+        self.first.update_devices({
+            'xr1.foo': device_manager.DeviceInfo('xr1.foo', ['10.0.0.9'],
+                                                 'cisco')})
+        self.assertEqual(self.dm.devices_info_many(['xr1.foo']),
+                         {'xr1.foo': {'device_type': 'cisco',
+                                      'addresses': ['10.0.0.9']}})
+
+    def testProviderAdded(self):
+        self.assertEqual(self.dm.devices_info_many(['cr1.foo']), {})
+        third = device_manager.DeviceProvider()
+        third.update_devices({
+            'cr1.foo': device_manager.DeviceInfo('cr1.foo', ['10.0.2.1'],
+                                                 'cisco')})
+        self.dm.providers[(50, 'third')] = third
+        self.assertEqual(self.dm.devices_info_many(['cr1.foo']).keys(),
+                         ['cr1.foo'])
+
+
+class DeviceNameIndexTest(unittest.TestCase):
+
+    NAMES = ['core1.syd', 'CORE2.SYD', 'core1.mel', 'core10.syd.example',
+             'ar1.syd', 'ar1', 'ar12.mel', 'xr1.bne', 'br1.foo', 'syd-core1',
+             'cr1.sydney']
+
+    REGEXPS = ['^core.*syd.*$', '^ar1$', '^AR1.*$', '^ar1\\..*$',
+               '^.*syd.*$', '^.*$', '^(ar|xr)1.*$', '^core[0-9]+\\.syd$',
+               '^.*\\.mel$', '^cr1\\.sydney$', '^zz.*$', '^.*qqq.*$',
+               '^br1(\\.foo)?$', '^c(?i)ore.*$', '^.*sy$']
+
+    def _linear_match(self, names, reg):
+        regexp = re.compile(reg, re.I)
+        return set(name for name in names if regexp.match(name))
+
+    def testMatchesLinearScan(self):
+        index = device_manager.DeviceNameIndex(self.NAMES)
+        self.assertEqual(len(index), len(self.NAMES))
+        for reg in self.REGEXPS:
+            self.assertEqual(index.match(reg),
+                             self._linear_match(self.NAMES, reg), reg)
+
+    def testUpdate(self):
+        index = device_manager.DeviceNameIndex(self.NAMES)
+        index.update(added=['core3.syd'], removed=['core1.syd', 'ar1'])
+        names = set(self.NAMES) - set(['core1.syd', 'ar1'])
+        names.add('core3.syd')
+        for reg in self.REGEXPS:
+            self.assertEqual(index.match(reg), self._linear_match(names, reg),
+                             reg)
+
+    def testUpdateResorted(self):
+        index = device_manager.DeviceNameIndex(self.NAMES)
+        added = ['core%d.syd' % i for i in xrange(100, 200)]
+        index.update(added=added, removed=['core1.syd'])
+        names = set(self.NAMES + added) - set(['core1.syd'])
+        self.assertEqual(len(index), len(names))
+        for reg in self.REGEXPS:
+            self.assertEqual(index.match(reg), self._linear_match(names, reg),
+                             reg)
+
+    def testTrigramCandidatesChecked(self):
+        # Both names contain the trigrams of 'sydcore', only one the text.
+        names = ['syd-core1', 'sydcore1', 'mel.syd.core']
+        index = device_manager.DeviceNameIndex(names)
+        self.assertEqual(index.match('^.*sydcore.*$'), set(['sydcore1']))
+        self.assertEqual(index.match('^.*ydc.*$'), set(['sydcore1']))
+        self.assertEqual(index.match('^.*zzz.*$'), set())
+
+    def testQueriesDoNotGrowIndex(self):
+        index = device_manager.DeviceNameIndex(self.NAMES)
+        ngrams = dict((k, set(v)) for k, v in index._ngrams.iteritems())
+        for i in xrange(100):
+            index.match('^.*q%dq.*$' % i)
+        self.assertEqual(index._ngrams, ngrams)
+        index.update(removed=self.NAMES)
+        self.assertEqual(index._ngrams, {})
+
+    def testInvalidRegexp(self):
+        index = device_manager.DeviceNameIndex(self.NAMES)
+        self.assertRaises(re.error, index.match, '^core(')
+
+    def testLargeInventory(self):
+        names = ['%s%d.%s' % (role, i, pop)
+                 for role in ('core', 'ar', 'xr', 'dr')
+                 for pop in ('syd', 'mel', 'bne', 'per', 'adl')
+                 for i in xrange(5000)]
+        index = device_manager.DeviceNameIndex(names)
+        start = time.time()
+        for _ in xrange(10):
+            result = index.match('^core.*syd.*$')
+        elapsed = (time.time() - start) / 10
+        self.assertEqual(len(result), 5000)
+        # Only names containing both 'core' and 'syd' are matched.
+        self.assertEqual(result, self._linear_match(names, '^core.*syd.*$'))
+        self.assertTrue(elapsed < 1.0)
+        start = time.time()
+        self.assertEqual(index.match('^core4999\\.syd$'),
+                         set(['core4999.syd']))
+        self.assertTrue(time.time() - start < 0.01)
+
+
 if __name__ == '__main__':
     unittest.main()
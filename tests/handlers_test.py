@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the handlers module."""
+
+
+import collections
+import json
+import unittest
+
+import eventlet
+import mox
+import tornadorpc.json
+
+from notch.agent import controller
+from notch.agent import errors
+from notch.agent import handlers
+
+
+class FakeStream(object):
+
+    def closed(self):
+        return False
+
+    def writing(self):
+        return False
+
+
+class FakeConnection(object):
+    stream = FakeStream()
+
+
+class FakeRequest(object):
+    connection = FakeConnection()
+
+
+class FakeAsyncHandler(handlers.NotchAsyncAPI,
+                       handlers.AsynchronousJSONRPCHandler):
+    """An asynchronous API handler without the HTTP machinery."""
+
+    def __init__(self, controller, request_pool, batch_concurrency=4):
+        self.controller = controller
+        self.request_pool = request_pool
+        self.batch_concurrency = batch_concurrency
+        self.request = FakeRequest()
+        self.responses = []
+        self._dispatch_index = 0
+        self._in_flight = 0
+        self._pending = collections.deque()
+        self._RPC.faults.codes.update(errors.error_dictionary)
+        self._RPC_ = handlers.OrderedJSONRPCParser(
+            tornadorpc.json.JSONRPCLibraryWrapper)
+
+    def add_callback(self, callback):
+        eventlet.spawn_n(callback)
+
+    def on_result(self, response_text):
+        self.responses.append(response_text)
+
+    def call(self, body):
+        """Runs the JSON-RPC request body, returning the decoded response."""
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        self._RPC_.run(self, body)
+        for _ in xrange(200):
+            if self.responses:
+                break
+            eventlet.sleep(0.01)
+        return json.loads(self.responses[0])
+
+
+def rpc(method, rpcid, **params):
+    return {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': rpcid}
+
+
+class NotchAsyncAPITest(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mox.Mox()
+        self.controller = self.mock.CreateMock(controller.Controller)
+        self.request_pool = eventlet.GreenPool()
+        self.handler = FakeAsyncHandler(self.controller, self.request_pool)
+
+    def tearDown(self):
+        self.request_pool.waitall()
+        self.mock.UnsetStubs()
+
+    def testMethodsAreAsync(self):
+        for method in ('command', 'get_config', 'set_config', 'copy_file',
+                       'upload_file', 'download_file', 'delete_file',
+                       'lock', 'unlock'):
+            self.assertTrue(getattr(getattr(self.handler, method), 'async'))
+
+    def testCommand(self):
+        self.controller.request('command', device_name='xr1',
+                                command='show ver').AndReturn('b64result')
+        self.mock.ReplayAll()
+        response = self.handler.call(
+            rpc('command', 1, device_name='xr1', command='show ver'))
+        self.assertEqual(response['result'], 'b64result')
+        self.assertEqual(response['id'], 1)
+        self.mock.VerifyAll()
+
+    def testBinaryEncodingRefused(self):
+        self.mock.ReplayAll()
+        response = self.handler.call(
+            rpc('command', 1, device_name='xr1', command='show ver',
+                encoding='binary'))
+        self.assertEqual(response['error']['code'],
+                         errors.error_dictionary['InvalidRequestError'])
+        self.mock.VerifyAll()
+
+    def testApiErrorIsFault(self):
+        self.controller.request('command', device_name='xr1',
+                                command='show ver').AndRaise(
+            errors.CommandError('Timed out'))
+        self.mock.ReplayAll()
+        response = self.handler.call(
+            rpc('command', 1, device_name='xr1', command='show ver'))
+        self.assertEqual(response['error']['code'],
+                         errors.error_dictionary['CommandError'])
+        self.assertEqual(response['error']['message'], 'Timed out')
+        self.mock.VerifyAll()
+
+    def testUnexpectedErrorIsInternalError(self):
+        self.controller.request('get_config', device_name='xr1').AndRaise(
+            ValueError('boom'))
+        self.mock.ReplayAll()
+        response = self.handler.call(rpc('get_config', 1, device_name='xr1'))
+        self.assertEqual(response['error']['code'], -32603)
+        self.mock.VerifyAll()
+
+    def testCommandMatching(self):
+        self.controller.request_matching(
+            'command', regexp='xr.*', command='show ver').AndReturn(iter([
+                ('xr2', 'b64result', None),
+                ('xr1', None, errors.CommandError('Timed out'))]))
+        self.mock.ReplayAll()
+        response = self.handler.call(
+            rpc('command_matching', 1, regexp='xr.*', command='show ver'))
+        self.assertEqual(response['result']['xr2'],
+                         {'result': 'b64result', 'error': None})
+        self.assertEqual(response['result']['xr1']['error'],
+                         {'code': errors.error_dictionary['CommandError'],
+                          'name': 'CommandError', 'message': 'Timed out'})
+        self.mock.VerifyAll()
+
+    def testCommandMatchingWithoutRegexp(self):
+        response = self.handler.call(
+            rpc('command_matching', 1, command='show ver'))
+        self.assertEqual(response['error']['code'],
+                         errors.error_dictionary['InvalidRequestError'])
+
+    def testParseError(self):
+        response = self.handler.call('{not json')
+        self.assertEqual(response['error']['code'], -32700)
+
+    def testEmptyBatch(self):
+        response = self.handler.call('[]')
+        self.assertEqual(response['error']['code'], -32600)
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.running = 0
+        self.max_running = 0
+        self.request_pool = eventlet.GreenPool()
+
+    def tearDown(self):
+        self.request_pool.waitall()
+
+    def request(self, method, device_name=None, delay=0):
+        self.running += 1
+        self.max_running = max(self.running, self.max_running)
+        eventlet.sleep(delay)
+        self.running -= 1
+        if device_name == 'bad':
+            raise errors.NoSuchDeviceError('Unknown device %r' % device_name)
+        return device_name
+
+    def _handler(self, batch_concurrency):
+        handler_controller = mox.MockAnything()
+        handler_controller.request = self.request
+        return FakeAsyncHandler(handler_controller, self.request_pool,
+                                batch_concurrency=batch_concurrency)
+
+    def testBatchResultsInRequestOrder(self):
+        handler = self._handler(batch_concurrency=8)
+        batch = [rpc('command', i, device_name='xr%d' % i, delay=0.05 * (5-i))
+                 for i in xrange(5)]
+        response = handler.call(batch)
+        self.assertEqual([r['id'] for r in response], range(5))
+        self.assertEqual([r['result'] for r in response],
+                         ['xr%d' % i for i in xrange(5)])
+        self.assertEqual(self.max_running, 5)
+
+    def testSlowRequestsDoNotStarveOthers(self):
+        handlers_ = [self._handler(batch_concurrency=1) for _ in xrange(16)]
+        for i, handler in enumerate(handlers_):
+            handler._RPC_.run(handler, json.dumps(
+                rpc('command', i, device_name='xr%d' % i, delay=0.2)))
+        eventlet.sleep(0.05)
+        self.assertEqual(self.running, 16)
+        self.request_pool.waitall()
+
+    def testBatchConcurrencyLimited(self):
+        handler = self._handler(batch_concurrency=2)
+        batch = [rpc('command', i, device_name='xr%d' % i, delay=0.02)
+                 for i in xrange(6)]
+        response = handler.call(batch)
+        self.assertEqual(len(response), 6)
+        self.assertEqual(self.max_running, 2)
+
+    def testBatchWithErrorsAndUnknownMethods(self):
+        handler = self._handler(batch_concurrency=4)
+        batch = [rpc('command', 1, device_name='xr1'),
+                 rpc('command', 2, device_name='bad'),
+                 rpc('no_such_method', 3),
+                 rpc('command', 4, device_name='xr4')]
+        response = handler.call(batch)
+        self.assertEqual(response[0]['result'], 'xr1')
+        self.assertEqual(response[1]['error']['code'],
+                         errors.error_dictionary['NoSuchDeviceError'])
+        self.assertEqual(response[2]['error']['code'], -32601)
+        self.assertEqual(response[3]['result'], 'xr4')
+
+
+class FanoutArgumentsTest(unittest.TestCase):
+
+    def testArgumentsConverted(self):
+        self.assertEqual(handlers.fanout_arguments(
+            {'regexp': 'xr.*', 'max_concurrency': '4', 'timeout': 10}),
+                         {'regexp': 'xr.*', 'max_concurrency': 4,
+                          'timeout': 10.0})
+
+    def testInvalidArguments(self):
+        self.assertRaises(errors.InvalidRequestError,
+                          handlers.fanout_arguments, {})
+        self.assertRaises(errors.InvalidRequestError,
+                          handlers.fanout_arguments,
+                          {'regexp': '.*', 'timeout': 'soon'})
+
+
+class FakeStreamHandler(handlers.NotchStreamHandler):
+    """A stream handler recording its output, without the HTTP machinery."""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.request = FakeRequest()
+        self.output = []
+        self.finished = eventlet.event.Event()
+        self._window = eventlet.semaphore.Semaphore(
+            handlers.STREAM_WINDOW_FRAMES)
+
+    def add_callback(self, callback):
+        callback()
+
+    def write(self, chunk):
+        self.output.append(chunk)
+
+    def flush(self):
+        self.output.append(None)
+
+    def finish(self):
+        self.finished.send()
+
+    def frames(self):
+        """Returns a list of (header, payload) tuples written."""
+        data = ''.join(chunk for chunk in self.output if chunk)
+        frames = []
+        while data:
+            line, data = data.split('\n', 1)
+            header = json.loads(line)
+            frames.append((header, data[:header['length']]))
+            data = data[header['length']:]
+        return frames
+
+
+class NotchStreamHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mox.Mox()
+        self.controller = self.mock.CreateMock(controller.Controller)
+        self.handler = FakeStreamHandler(self.controller)
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+
+    def testStreamFanout(self):
+        self.controller.request_matching(
+            'lock', regexp='xr.*', timeout=5.0,
+            encoding='binary').AndReturn(iter([
+                ('xr2', True, None),
+                ('xr1', None, errors.ConnectError('Refused'))]))
+        self.mock.ReplayAll()
+        self.handler._execute('lock', {'regexp': 'xr.*', 'timeout': 5})
+        self.assertTrue(self.handler.finished.ready())
+        frames = self.handler.frames()
+        self.assertEqual(len(frames), 2)
+        self.assertEqual(frames[0][0]['device_name'], 'xr2')
+        self.assertEqual(frames[0][0]['encoding'], 'json')
+        self.assertEqual(frames[0][1], 'true')
+        self.assertTrue(frames[0][0]['last'])
+        self.assertEqual(frames[1][0]['error']['name'], 'ConnectError')
+        self.assertEqual(frames[1][1], '')
+        # Each frame is flushed as soon as it is written.
+        self.assertEqual(self.handler.output.count(None), 2)
+        self.mock.VerifyAll()
+
+    def testStreamFanoutOutput(self):
+        def request_matching(method, regexp=None, stream_callback=None,
+                             encoding=None):
+            stream_callback('xr1', 'line 1\n')
+            stream_callback('xr2', 'other\n')
+            stream_callback('xr1', 'line 2\n')
+            yield ('xr1', '', None)
+            yield ('xr2', None, errors.CommandError('EOF'))
+        self.handler.controller = mox.MockAnything()
+        self.handler.controller.request_matching = request_matching
+        self.handler._execute('command', {'regexp': 'xr.*'})
+        frames = self.handler.frames()
+        self.assertEqual([(h['device_name'], h['last'], p)
+                          for h, p in frames],
+                         [('xr1', False, 'line 1\n'),
+                          ('xr2', False, 'other\n'),
+                          ('xr1', False, 'line 2\n'),
+                          ('xr1', True, ''),
+                          ('xr2', True, '')])
+        self.assertEqual(set(h['encoding'] for h, _ in frames),
+                         set(['binary']))
+        self.assertEqual(frames[-1][0]['error']['name'], 'CommandError')
+        self.assertEqual(self.handler._window.balance,
+                         handlers.STREAM_WINDOW_FRAMES)
+
+    def testStreamSingleDeviceOutput(self):
+        def request(method, device_name=None, command=None, callback=None,
+                    encoding=None):
+            for i in xrange(3):
+                callback('chunk %d\n' % i)
+            return ''
+        self.handler.controller = mox.MockAnything()
+        self.handler.controller.request = request
+        self.handler._execute('command', {'device_name': 'xr1',
+                                          'command': 'show run'})
+        frames = self.handler.frames()
+        self.assertEqual(''.join(p for _, p in frames),
+                         'chunk 0\nchunk 1\nchunk 2\n')
+        self.assertEqual([h['last'] for h, _ in frames],
+                         [False, False, False, True])
+
+    def testStreamSingleDevice(self):
+        self.controller.request('lock', device_name='xr1',
+                                encoding='binary').AndReturn(True)
+        self.mock.ReplayAll()
+        self.handler._execute('lock', {'device_name': 'xr1'})
+        frames = self.handler.frames()
+        self.assertEqual(frames, [({'device_name': 'xr1', 'length': 4,
+                                    'encoding': 'json', 'error': None,
+                                    'last': True}, 'true')])
+        self.mock.VerifyAll()
+
+    def testStreamBinaryResult(self):
+        self.controller.request('download_file', device_name='xr1',
+                                source='flash:/image',
+                                encoding='binary').AndReturn('\x00\xff')
+        self.controller.request('download_file', device_name='xr1',
+                                source='flash:/image',
+                                encoding='base64').AndReturn('AP8=')
+        self.mock.ReplayAll()
+        self.handler._execute('download_file', {'device_name': 'xr1',
+                                                'source': 'flash:/image'})
+        base64_handler = FakeStreamHandler(self.controller)
+        base64_handler._execute('download_file', {'device_name': 'xr1',
+                                                  'source': 'flash:/image',
+                                                  'encoding': 'base64'})
+        frames = self.handler.frames() + base64_handler.frames()
+        self.assertEqual([(h['encoding'], p) for h, p in frames],
+                         [('binary', '\x00\xff'), ('base64', 'AP8=')])
+        self.mock.VerifyAll()
+
+
+if __name__ == '__main__':
+    unittest.main()
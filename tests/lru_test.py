@@ -247,6 +247,274 @@ class LruTest(unittest.TestCase):
         self.assertEqual(test_lru['10'], '101010')
         self.assertEqual(len(test_lru), 3)
 
+    def testLruGetItemRefreshesRecency(self):
+        expired = []
+        def callback(input):
+            return input*2
+
+        def expire(key, value):
+            expired.append(key)
+
+        test_lru = lru.LruDict(callback, expire_callback=expire,
+                               maximum_size=2)
+        test_lru[10]
+        test_lru[20]
+        # Touch the oldest item, so 20 becomes least recently used.
+        test_lru[10]
+        test_lru[30]
+        self.assertEqual(expired, [20])
+        self.assert_(10 in test_lru)
+        self.assert_(30 in test_lru)
+
+    def testLruTouch(self):
+        def callback(input):
+            return input*2
+
+        test_lru = lru.LruDict(callback, maximum_size=4)
+        test_lru[10]
+        test_lru[20]
+        test_lru[30]
+        self.assertTrue(test_lru.touch(10))
+        self.assertFalse(test_lru.touch('not here'))
+        self.assertEqual(test_lru.keys_by_recency(), [20, 30, 10])
+        self.assertEqual(test_lru.get(20), 40)
+        self.assertEqual(test_lru.keys_by_recency(), [30, 10, 20])
+
+    def testLruMaximumSizeRespected(self):
+        def callback(input):
+            return input*2
+
+        test_lru = lru.LruDict(callback, maximum_size=3)
+        for i in xrange(100):
+            test_lru[i]
+            self.assert_(len(test_lru) <= 3)
+        self.assertEqual(test_lru.keys_by_recency(), [97, 98, 99])
+
+    def testLruSetExistingKeyDoesNotEvict(self):
+        expired = []
+        def callback(input):
+            return input*2
+
+        def expire(key, value):
+            expired.append(key)
+
+        test_lru = lru.LruDict(callback, expire_callback=expire,
+                               maximum_size=2)
+        test_lru[10]
+        test_lru[20]
+        test_lru[10] = 'new value'
+        self.assertEqual(expired, [])
+        self.assertEqual(test_lru[10], 'new value')
+        self.assertEqual(test_lru.keys_by_recency(), [20, 10])
+
+    def testLruDeleteItem(self):
+        def callback(input):
+            return input*2
+
+        test_lru = lru.LruDict(callback, maximum_size=2)
+        test_lru[10]
+        test_lru[20]
+        del test_lru[10]
+        self.assertEqual(test_lru.pop(20), 40)
+        self.assertEqual(len(test_lru), 0)
+        self.assertRaises(IndexError, test_lru.expire_item)
+
+    def testLruDontExpireSignalSkipsToNextItem(self):
+        expired = []
+        def callback(input):
+            return input*3
+
+        def expire(key, value):
+            if key == 5:
+                raise lru.DontExpireError
+            expired.append(key)
+
+        test_lru = lru.LruDict(callback, expire_callback=expire,
+                               maximum_size=2)
+        test_lru[5]
+        test_lru[10]
+        test_lru[15]
+        self.assertEqual(expired, [10])
+        self.assertEqual(len(test_lru), 2)
+        self.assertEqual(test_lru.keys_by_recency(), [5, 15])
+
+    def testLruConcurrentMissesPopulateOnce(self):
+        calls = []
+        def callback(input):
+            calls.append(input)
+            eventlet.sleep(0.01)
+            return object()
+
+        test_lru = lru.LruDict(callback, maximum_size=4)
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(test_lru.__getitem__, [10] * 5))
+        self.assertEqual(calls, [10])
+        for result in results:
+            self.assert_(result is results[0])
+        self.assertEqual(len(test_lru), 1)
+
+    def testLruConcurrentMissesShareError(self):
+        calls = []
+        def callback(input):
+            calls.append(input)
+            eventlet.sleep(0.01)
+            raise ValueError('population failed')
+
+        test_lru = lru.LruDict(callback, maximum_size=4)
+        errors = []
+        def get(key):
+            try:
+                test_lru[key]
+            except ValueError, e:
+                errors.append(str(e))
+
+        pool = eventlet.GreenPool()
+        for _ in xrange(3):
+            pool.spawn(get, 10)
+        pool.waitall()
+        self.assertEqual(calls, [10])
+        self.assertEqual(errors, ['population failed'] * 3)
+        self.assertEqual(len(test_lru), 0)
+
+    def testLruPopulatingCallerTimesOut(self):
+        def callback(input):
+            eventlet.sleep(0.05)
+            return input * 2
+
+        test_lru = lru.LruDict(callback, maximum_size=4)
+        def get_with_timeout():
+            timeout = eventlet.Timeout(0.01)
+            try:
+                return test_lru[10]
+            finally:
+                timeout.cancel()
+
+        first = eventlet.spawn(get_with_timeout)
+        eventlet.sleep(0)
+        second = eventlet.spawn(test_lru.__getitem__, 10)
+        self.assertRaises(eventlet.Timeout, first.wait)
+        self.assertEqual(second.wait(), 20)
+        self.assertEqual(test_lru.data, {10: 20})
+
+    def testLruConcurrentMissesDontPopulate(self):
+        def callback(input):
+            eventlet.sleep(0.01)
+            raise lru.DontPopulateItemError
+
+        test_lru = lru.LruDict(callback, maximum_size=4)
+        pool = eventlet.GreenPool()
+        self.assertEqual(list(pool.imap(test_lru.__getitem__, [10] * 3)),
+                         [None] * 3)
+        self.assert_(10 not in test_lru)
+
+
+class LruAgeTest(unittest.TestCase):
+
+    def testResetKeyRestartsLifetime(self):
+        def callback(input):
+            return input*2
+
+        test_lru = lru.LruDict(callback, maximum_age=0.2)
+        test_lru[100]
+        time.sleep(0.1)
+        test_lru[100] = 'again'
+        time.sleep(0.15)
+        # The first deadline has passed, but must not expire the new value.
+        self.assertEqual(test_lru.get(100), 'again')
+        time.sleep(0.1)
+        self.assert_(100 not in test_lru)
+
+    def testAgedDontExpireSignal(self):
+        def callback(input):
+            return input*2
+
+        def expire(key, value):
+            raise lru.DontExpireError
+
+        test_lru = lru.LruDict(callback, expire_callback=expire,
+                               maximum_age=0.05)
+        test_lru[100]
+        time.sleep(0.1)
+        self.assertEqual(test_lru.get(100), 200)
+
+    def testSweeperHeapStaysBounded(self):
+        def callback(input):
+            return input*2
+
+        test_lru = lru.LruDict(callback, maximum_age=60)
+        before = len(lru.SWEEPER)
+        for i in xrange(5000):
+            test_lru[i % 10] = i
+        self.assert_(len(lru.SWEEPER) - before <=
+                     2 * (10 + lru.AgeSweeper.COMPACT_MINIMUM))
+        test_lru.clear()
+        self.assertEqual(len(test_lru), 0)
+
+    def testSweeperServesManyCaches(self):
+        def callback(input):
+            return input*2
+
+        lrus = [lru.LruDict(callback, maximum_age=0.05) for _ in xrange(10)]
+        for test_lru in lrus:
+            test_lru[1]
+        time.sleep(0.1)
+        for test_lru in lrus:
+            self.assertEqual(len(test_lru), 0)
+
+
+class CoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.coalescer = lru.Coalescer()
+        self.calls = []
+
+    def work(self, value, delay=0.02):
+        self.calls.append(value)
+        eventlet.sleep(delay)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def testConcurrentCallsShared(self):
+        pool = eventlet.GreenPool()
+        results = [pool.spawn(self.coalescer.call, 'key', self.work, i)
+                   for i in xrange(4)]
+        self.assertEqual([r.wait() for r in results], [0] * 4)
+        self.assertEqual(self.calls, [0])
+        self.assertEqual(len(self.coalescer), 0)
+        self.assertEqual(self.coalescer.call('key', self.work, 5, 0), 5)
+
+    def testExceptionRaisedInEachCaller(self):
+        exc = ValueError('failed')
+        pool = eventlet.GreenPool()
+        results = [pool.spawn(self.coalescer.call, 'key', self.work, exc)
+                   for _ in xrange(3)]
+        for result in results:
+            self.assertRaises(ValueError, result.wait)
+        self.assertEqual(len(self.calls), 1)
+
+    def testCallsAfterCompletionRunAgain(self):
+        self.assertEqual(self.coalescer.call('key', self.work, 1, 0), 1)
+        self.assertEqual(self.coalescer.call('key', self.work, 2, 0), 2)
+        self.assertEqual(self.calls, [1, 2])
+        self.assertEqual(len(self.coalescer), 0)
+
+    def testDifferentKeysDoNotShare(self):
+        pool = eventlet.GreenPool()
+        a = pool.spawn(self.coalescer.call, 'a', self.work, 1)
+        b = pool.spawn(self.coalescer.call, 'b', self.work, 2)
+        self.assertEqual((a.wait(), b.wait()), (1, 2))
+
+    def testInterruptedCallerDoesNotCancelCall(self):
+        first = eventlet.spawn(self.coalescer.call, 'key', self.work, 1, 0.05)
+        eventlet.sleep(0)
+        second = eventlet.spawn(self.coalescer.call, 'key', self.work, 2)
+        eventlet.sleep(0.01)
+        first.kill(eventlet.Timeout())
+        self.assertTrue('key' in self.coalescer)
+        self.assertEqual(second.wait(), 1)
+        self.assertEqual(self.calls, [1])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the paramiko_expect module."""
+
+import re
+import select
+import socket
+import threading
+import unittest
+
+import pexpect
+
+from notch.agent.devices import paramiko_expect
+from notch.agent.devices import trans
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+
+class FakeChannel(object):
+    """A paramiko.Channel look-alike over one end of a socket pair."""
+
+    def __init__(self, sock, in_window_size=0):
+        self.sock = sock
+        self.in_window_size = in_window_size
+        self.transport = FakeTransport()
+        self.recv_sizes = []
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def get_transport(self):
+        return self.transport
+
+    def recv_ready(self):
+        r, _, _ = select.select([self.sock], [], [], 0)
+        return bool(r)
+
+    def recv(self, size):
+        self.recv_sizes.append(size)
+        return self.sock.recv(size)
+
+    def send(self, s):
+        return self.sock.send(s)
+
+
+class TestParamikoSpawn(unittest.TestCase):
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.channel = FakeChannel(self.ours)
+        self.spawn = paramiko_expect.ParamikoSpawn(None)
+        self.spawn.channel = self.channel
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def _send(self, data):
+        sender = threading.Thread(target=self.theirs.sendall, args=(data,))
+        sender.daemon = True
+        sender.start()
+        return sender
+
+    def testReadDrainsReadyData(self):
+        self.theirs.sendall('a' * 100)
+        self.theirs.sendall('b' * 100)
+        self.assertEqual(self.spawn.read_nonblocking(1000, timeout=1),
+                         'a' * 100 + 'b' * 100)
+        self.assertRaises(pexpect.TIMEOUT, self.spawn.read_nonblocking,
+                          1000, timeout=0.01)
+
+    def testReadEof(self):
+        self.theirs.close()
+        self.assertRaises(pexpect.EOF, self.spawn.read_nonblocking, 1000,
+                          timeout=1)
+
+    def testExpectReturnsStrings(self):
+        self.theirs.sendall('show ver\r\nVersion 1\r\ncore1.syd#')
+        index = self.spawn.expect([re.compile(r'\S+#'), pexpect.EOF],
+                                  timeout=1)
+        self.assertEqual(index, 0)
+        self.assertEqual(self.spawn.before, 'show ver\r\nVersion 1\r\n')
+        self.assertEqual(self.spawn.after, 'core1.syd#')
+        self.assertEqual(type(self.spawn.match.group(0)), str)
+        self.assertEqual(self.spawn.match.group(0), 'core1.syd#')
+
+    def testExpectLeavesRemainderBuffered(self):
+        self.theirs.sendall('a\r\nrouter#b\r\nrouter#')
+        self.assertEqual(self.spawn.expect_exact(['router#'], timeout=1), 0)
+        self.assertEqual(self.spawn.before, 'a\r\n')
+        self.assertEqual(self.spawn.buffer, 'b\r\nrouter#')
+        self.assertEqual(type(self.spawn.buffer), str)
+        self.assertEqual(self.spawn.expect_exact(['router#'], timeout=1), 0)
+        self.assertEqual(self.spawn.before, 'b\r\n')
+
+    def testExpectTimeout(self):
+        self.theirs.sendall('partial')
+        index = self.spawn.expect(['router#', pexpect.TIMEOUT], timeout=0.05)
+        self.assertEqual(index, 1)
+        self.assertEqual(self.spawn.before, 'partial')
+        self.assertEqual(self.spawn.buffer, 'partial')
+
+    def testLargeOutputGrowsReads(self):
+        self.channel.in_window_size = 64 * 1024
+        output = 'interface Ethernet0\r\n no shutdown\r\n' * 50000
+        sender = self._send(output + 'router#')
+        searcher = trans.PromptSearcher(['router#', pexpect.EOF])
+        self.assertEqual(self.spawn.expect_loop(searcher, timeout=10), 0)
+        sender.join()
+        self.assertEqual(self.spawn.before, output)
+        self.assertTrue(max(self.channel.recv_sizes) > 4 * 4096)
+        self.assertTrue(max(self.channel.recv_sizes) <= 64 * 1024)
+        self.assertTrue(len(self.channel.recv_sizes) < len(output) // 4096)
+
+    def testReadSizeShrinks(self):
+        self.spawn.recv_size = paramiko_expect.MAX_RECV_SIZE
+        self.theirs.sendall('router#')
+        self.spawn.expect_exact(['router#'], timeout=1)
+        self.assertEqual(self.spawn.recv_size,
+                         paramiko_expect.MAX_RECV_SIZE // 2)
+        self.spawn.channel = self.channel
+        self.assertEqual(self.spawn.recv_size, paramiko_expect.MIN_RECV_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
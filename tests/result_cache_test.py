@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the result_cache module."""
+
+import time
+import unittest
+
+import eventlet
+
+from notch.agent import result_cache
+
+
+class Device(object):
+    """Counts executions of requests, returning their output."""
+
+    def __init__(self, output='Version 1\n', delay=0):
+        self.output = output
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        eventlet.sleep(self.delay)
+        return self.output
+
+
+def show_ver(device_name='xr1', **kwargs):
+    kwargs.update(device_name=device_name, command='show ver')
+    return kwargs
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = result_cache.ResultCache()
+        self.device = Device()
+
+    def testCachedWithinMaxAge(self):
+        for _ in xrange(3):
+            self.assertEqual(self.cache.call('command', show_ver(), 60,
+                                             self.device), 'Version 1\n')
+        self.assertEqual(self.device.calls, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+        self.assertEqual(self.cache.bytes, len('Version 1\n'))
+
+    def testOlderThanMaxAge(self):
+        self.cache.call('command', show_ver(), 60, self.device)
+        key = self.cache.key('command', show_ver())
+        cached = self.cache._results[key]
+        self.cache._results[key] = cached._replace(time=time.time() - 10)
+        self.cache.call('command', show_ver(), 60, self.device)
+        self.assertEqual(self.device.calls, 1)
+        self.cache.call('command', show_ver(), 5, self.device)
+        self.assertEqual(self.device.calls, 2)
+        self.assertEqual(self.cache.bytes, len('Version 1\n'))
+
+    def testKeyedByRequest(self):
+        self.cache.call('command', show_ver(), 60, self.device)
+        self.cache.call('command', show_ver('xr2'), 60, self.device)
+        self.cache.call('command', show_ver(mode='shell'), 60, self.device)
+        self.cache.call('command', show_ver(encoding='text'), 60, self.device)
+        for source in ('running-config', 'startup-config', 'running-config'):
+            self.cache.call('get_config', {'device_name': 'xr1',
+                                           'source': source}, 60, self.device)
+        self.assertEqual(self.device.calls, 6)
+        self.assertEqual(len(self.cache), 6)
+
+    def testNotCacheable(self):
+        for method, kwargs, max_age in (
+            ('command', show_ver(), 0),
+            ('command', show_ver(), -1),
+            ('lock', {'device_name': 'xr1'}, 60),
+            ('command', show_ver(callback=lambda data: None), 60)):
+            self.cache.call(method, kwargs, max_age, self.device)
+        self.assertEqual(self.device.calls, 4)
+        self.assertEqual(len(self.cache), 0)
+
+    def testInvalidate(self):
+        self.cache.call('command', show_ver(), 60, self.device)
+        self.cache.call('command', show_ver('xr2'), 60, self.device)
+        self.cache.invalidate('xr1')
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.bytes, len('Version 1\n'))
+        self.cache.call('command', show_ver(), 60, self.device)
+        self.cache.call('command', show_ver('xr2'), 60, self.device)
+        self.assertEqual(self.device.calls, 3)
+
+    def testSizeBounds(self):
+        cache = result_cache.ResultCache(maximum_size=2, maximum_bytes=25)
+        for name in ('xr1', 'xr2', 'xr3'):
+            cache.call('command', show_ver(name), 60, self.device)
+        self.assertEqual(len(cache), 2)
+        cache.call('command', show_ver('xr4'), 60, Device('x' * 20))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.bytes, 20)
+        cache.call('command', show_ver('xr5'), 60, Device('x' * 30))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache._device_keys.keys(), ['xr4'])
+
+    def testConcurrentRequestsShared(self):
+        self.device.delay = 0.05
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(
+            lambda _: self.cache.call('command', show_ver(), 60, self.device),
+            xrange(5)))
+        self.assertEqual(results, ['Version 1\n'] * 5)
+        self.assertEqual(self.device.calls, 1)
+
+    def testWriteDuringRequestNotCached(self):
+        self.device.delay = 0.05
+        request = eventlet.spawn(self.cache.call, 'command', show_ver(), 60,
+                                 self.device)
+        eventlet.sleep(0.01)
+        self.assertEqual(self.device.calls, 1)
+        self.cache.invalidate('xr1')
+        self.assertEqual(request.wait(), 'Version 1\n')
+        self.assertEqual(len(self.cache), 0)
+
+    def testResultSize(self):
+        self.assertEqual(result_cache.result_size('abc'), 3)
+        self.assertEqual(result_cache.result_size(
+            {'encoding': 'text', 'data': 'abcd'}), 8)
+        self.assertEqual(result_cache.result_size(None), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
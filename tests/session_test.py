@@ -20,6 +20,7 @@
 import base64
 import unittest
 
+import eventlet
 import mox
 
 from notch.agent import credential
@@ -141,6 +142,280 @@ class TestSessionMockDevice(unittest.TestCase):
         self.mock.VerifyAll()
 
 
+class TestSessionResultEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mox.Mox()
+        self.dev = self.mock.CreateMock(device.Device)
+        self.dev.connect(credential=mox.IgnoreArg(),
+                         connect_method=None).AndReturn(None)
+        self.session = session.Session(device=self.dev)
+        self.session.credential = credential.Credential(regexp='.*')
+
+    def _request(self, result, **kwargs):
+        self.dev.command('show ver').AndReturn(result)
+        self.mock.ReplayAll()
+        response = self.session.request('command', 'show ver', **kwargs)
+        self.mock.VerifyAll()
+        return response
+
+    def testBase64ByDefault(self):
+        self.assertEqual(self._request('Version 1\n'),
+                         base64.b64encode('Version 1\n'))
+
+    def testText(self):
+        self.assertEqual(self._request('Versi\xc3\xb3n\n', encoding='text'),
+                         {'encoding': 'text', 'data': 'Versi\xc3\xb3n\n'})
+
+    def testTextFallsBackToBase64(self):
+        self.assertEqual(self._request('\x00\xff', encoding='text'),
+                         {'encoding': 'base64', 'data': 'AP8='})
+
+    def testBinary(self):
+        result = '\x00\xff' * 1000
+        self.assertTrue(self._request(result, encoding='binary') is result)
+
+    def testInvalidEncoding(self):
+        self.mock.ReplayAll()
+        self.assertRaises(errors.InvalidRequestError, self.session.request,
+                          'command', 'show ver', encoding='rot13')
+
+    def testNonStringResult(self):
+        self.assertEqual(session.encode_result(True, 'text'), True)
+        self.assertEqual(session.encode_result(None), None)
+
+
+class ConcurrentDevice(device.Device):
+    """A device whose commands block until released, counting concurrency."""
+
+    MAX_CONCURRENT_REQUESTS = 3
+
+    def __init__(self, *args, **kwargs):
+        super(ConcurrentDevice, self).__init__(*args, **kwargs)
+        self.release = eventlet.event.Event()
+        self.running = 0
+        self.max_running = 0
+        self.connects = 0
+        self.disconnects = 0
+
+    def _connect(self, **kwargs):
+        # Yield, so concurrent requests would connect again if not
+        # serialised.
+        eventlet.sleep(0.01)
+        self.connects += 1
+
+    def _disconnect(self):
+        self.disconnects += 1
+
+    def _command(self, command, mode=None):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            if command == 'bad':
+                raise errors.CommandError('Channel open failed')
+            self.release.wait()
+            return command
+        finally:
+            self.running -= 1
+
+
+class TestSessionConcurrentRequests(unittest.TestCase):
+
+    def _session(self, dev):
+        s = session.Session(device=dev)
+        s.credential = credential.Credential(regexp='.*')
+        return s
+
+    def _run_requests(self, dev, count):
+        s = self._session(dev)
+        pool = eventlet.GreenPool()
+        threads = [pool.spawn(s.request, 'command', 'cmd%d' % i)
+                   for i in xrange(count)]
+        eventlet.sleep(0.05)
+        self.assertFalse(s.idle)
+        self.assertEqual(s.active_requests, dev.running)
+        dev.release.send()
+        results = [thread.wait() for thread in threads]
+        self.assertTrue(s.idle)
+        self.assertEqual(sorted(base64.b64decode(r) for r in results),
+                         sorted('cmd%d' % i for i in xrange(count)))
+        return s
+
+    def testRequestsMultiplexed(self):
+        dev = ConcurrentDevice(name='xr1', addresses='10.0.0.1')
+        s = self._run_requests(dev, 6)
+        self.assertEqual(s.max_concurrent_requests, 3)
+        self.assertEqual(dev.max_running, 3)
+        self.assertEqual(dev.connects, 1)
+
+    def testRequestsSerialisedByDefault(self):
+        dev = ConcurrentDevice(name='xr1', addresses='10.0.0.1')
+        dev.MAX_CONCURRENT_REQUESTS = 1
+        self._run_requests(dev, 3)
+        self.assertEqual(dev.max_running, 1)
+        self.assertEqual(dev.connects, 1)
+
+    def testErrorDoesNotDisconnectOtherRequests(self):
+        dev = ConcurrentDevice(name='xr1', addresses='10.0.0.1')
+        s = self._session(dev)
+        pool = eventlet.GreenPool()
+        good = pool.spawn(s.request, 'command', 'show ver')
+        eventlet.sleep(0.05)
+        self.assertRaises(errors.CommandError, s.request, 'command', 'bad')
+        self.assertTrue(s.connected)
+        self.assertEqual(dev.disconnects, 0)
+        dev.release.send()
+        self.assertEqual(base64.b64decode(good.wait()), 'show ver')
+        # Once alone on the connection, errors disconnect as before.
+        self.assertRaises(errors.CommandError, s.request, 'command', 'bad')
+        self.assertFalse(s.connected)
+
+
+class TestSessionRequestTimeout(unittest.TestCase):
+
+    def testTimedOutRequestDisconnects(self):
+        dev = ConcurrentDevice(name='xr1', addresses='10.0.0.1')
+        dev.MAX_CONCURRENT_REQUESTS = 1
+        s = session.Session(device=dev)
+        s.credential = credential.Credential(regexp='.*')
+        timer = eventlet.Timeout(0.05, errors.RequestTimeoutError())
+        try:
+            self.assertRaises(errors.RequestTimeoutError, s.request,
+                              'command', 'show run')
+        finally:
+            timer.cancel()
+        # The rest of the command's output must not reach the next request.
+        self.assertFalse(s.connected)
+        self.assertEqual(dev.disconnects, 1)
+        self.assertTrue(s.idle)
+
+
+class StreamingDevice(device.Device):
+    """A device streaming output, then failing with a retryable error."""
+
+    def __init__(self, *args, **kwargs):
+        super(StreamingDevice, self).__init__(*args, **kwargs)
+        self.commands = 0
+
+    def _connect(self, **kwargs):
+        pass
+
+    def _disconnect(self):
+        pass
+
+    def _command(self, command, mode=None, callback=None):
+        self.commands += 1
+        if callback is not None:
+            callback('partial output\n')
+        exc = errors.CommandError('EOF received during command')
+        exc.retry = True
+        raise exc
+
+
+class TestSessionStreamedRequests(unittest.TestCase):
+
+    def testStreamedRequestNotRetried(self):
+        dev = StreamingDevice(name='xr1', addresses='10.0.0.1')
+        s = session.Session(device=dev)
+        s.credential = credential.Credential(regexp='.*')
+        chunks = []
+        self.assertRaises(errors.CommandError, s.request, 'command',
+                          'show run', callback=chunks.append)
+        self.assertEqual(dev.commands, 1)
+        self.assertEqual(chunks, ['partial output\n'])
+
+    def testRequestRetried(self):
+        dev = StreamingDevice(name='xr1', addresses='10.0.0.1')
+        s = session.Session(device=dev)
+        s.credential = credential.Credential(regexp='.*')
+        self.assertRaises(errors.CommandError, s.request, 'command',
+                          'show run')
+        self.assertEqual(dev.commands, 2)
+
+
+class ProbedDevice(device.Device):
+    """A device answering liveness probes, slowly if asked."""
+
+    def __init__(self, *args, **kwargs):
+        super(ProbedDevice, self).__init__(*args, **kwargs)
+        self.responding = True
+        self.probe_time = 0
+        self.events = []
+
+    def _connect(self, **kwargs):
+        self.events.append('connect')
+
+    def _disconnect(self):
+        self.events.append('disconnect')
+
+    def _alive(self):
+        self.events.append('probe')
+        eventlet.sleep(self.probe_time)
+        self.events.append('probed')
+        return self.responding
+
+    def _command(self, command, mode=None):
+        self.events.append(command)
+        return command
+
+
+class TestSessionProbe(unittest.TestCase):
+
+    def setUp(self):
+        self.dev = ProbedDevice(name='xr1', addresses='10.0.0.1')
+        self.session = session.Session(device=self.dev)
+        self.session.credential = credential.Credential(regexp='.*')
+
+    def testProbeNotConnected(self):
+        self.assertEqual(self.session.probe(), None)
+        self.assertEqual(self.dev.events, [])
+
+    def testProbeAlive(self):
+        self.session.connect()
+        self.assertEqual(self.session.probe(), True)
+        self.assertTrue(self.session.connected)
+        self.assertTrue(self.session.time_last_probe is not None)
+        self.assertEqual(self.session.time_last_active,
+                         self.session.time_last_probe)
+
+    def testDeadSessionDisconnected(self):
+        self.session.connect()
+        self.dev.responding = False
+        self.assertEqual(self.session.probe(), False)
+        self.assertFalse(self.session.connected)
+        self.assertEqual(self.dev.events,
+                         ['connect', 'probe', 'probed', 'disconnect'])
+
+    def testRequestWaitsForProbe(self):
+        self.session.connect()
+        self.dev.probe_time = 0.05
+        probe = eventlet.spawn(self.session.probe)
+        eventlet.sleep(0)
+        self.assertTrue(self.session.probing)
+        self.assertEqual(self.session.probe(), None)
+        result = self.session.request('command', 'show ver')
+        self.assertEqual(base64.b64decode(result), 'show ver')
+        self.assertEqual(probe.wait(), True)
+        self.assertEqual(self.dev.events,
+                         ['connect', 'probe', 'probed', 'show ver'])
+
+    def testProbeNotStartedBeforeRequestCounted(self):
+        dev = ConcurrentDevice(name='xr1', addresses='10.0.0.1')
+        s = session.Session(device=dev)
+        s.credential = credential.Credential(regexp='.*')
+        # A warm pool style connect, then a probe, whilst a request waits
+        # to use the connection.
+        def connect_and_probe():
+            s.connect()
+            return s.probe()
+        connecting = eventlet.spawn(connect_and_probe)
+        eventlet.sleep(0)
+        request = eventlet.spawn(s.request, 'command', 'show ver')
+        self.assertEqual(connecting.wait(), None)
+        self.assertTrue(s.connected)
+        dev.release.send()
+        self.assertEqual(base64.b64decode(request.wait()), 'show ver')
+
 
 if __name__ == '__main__':
     unittest.main()
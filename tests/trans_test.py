@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Andrew Fort. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for the abstract device transport."""
+
+import re
+import socket
+import threading
+import unittest
+
+import fdpexpect
+import pexpect
+
+from notch.agent.devices import device
+from notch.agent.devices import trans
+
+
+PROMPT = 'router#'
+
+
+class SocketTransport(trans.DeviceTransport):
+    """A transport talking to a fake device over a socket pair."""
+
+    def __init__(self, sock, **kwargs):
+        super(SocketTransport, self).__init__(**kwargs)
+        self._c = sock
+        self._expect = fdpexpect.fdspawn(sock.fileno())
+
+    @property
+    def before(self):
+        return self._expect.before
+
+    @property
+    def after(self):
+        return self._expect.after
+
+    def write(self, s):
+        self._expect.send(s)
+
+    def expect(self, re_list, timeout=None):
+        return self._expect.expect(re_list, timeout=timeout)
+
+    def expect_searcher(self, searcher, timeout=None):
+        return self._expect.expect_loop(searcher, timeout=timeout)
+
+
+class FakeDevice(threading.Thread):
+    """Answers a prompt and then one command with the given output."""
+
+    def __init__(self, sock, output):
+        super(FakeDevice, self).__init__()
+        self.daemon = True
+        self.sock = sock
+        self.output = output
+
+    def _read_line(self):
+        line = ''
+        while not line.endswith('\n'):
+            line += self.sock.recv(1)
+        return line
+
+    def run(self):
+        self._read_line()
+        self.sock.sendall(PROMPT)
+        command = self._read_line()
+        self.sock.sendall(command.strip() + '\r\n' + self.output + PROMPT)
+
+
+class TestDeviceTransportCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.timeouts = device.Timeouts(connect=5, resp_short=5, resp_long=5,
+                                        disconnect=5)
+
+    def _command(self, output, callback=None, strip_chars=None, **kwargs):
+        ours, theirs = socket.socketpair()
+        fake = FakeDevice(theirs, output)
+        fake.start()
+        try:
+            transport = SocketTransport(ours, timeouts=self.timeouts, **kwargs)
+            return transport.command('show run', PROMPT, callback=callback,
+                                     strip_chars=strip_chars)
+        finally:
+            fake.join()
+            ours.close()
+            theirs.close()
+
+    def testCommand(self):
+        self.assertEqual(self._command('line 1\r\nline 2\r\n'),
+                         'line 1\r\nline 2\r\n')
+
+    def testCommandStreamed(self):
+        output = ''.join('interface Ethernet%d\r\n no shutdown\r\n' % i
+                         for i in xrange(5000))
+        chunks = []
+        self.assertEqual(self._command(output, callback=chunks.append), '')
+        self.assertEqual(''.join(chunks), output)
+        self.assertTrue(len(chunks) > 1)
+        # Chunks hold whole lines, so never part of the prompt.
+        for chunk in chunks[:-1]:
+            self.assertTrue(chunk.endswith('\n'))
+            self.assertTrue(len(chunk) >= trans.STREAM_CHUNK_SIZE)
+
+    def testLargeCommand(self):
+        output = ''.join('interface Ethernet%d\r\n description router%d\r\n'
+                         % (i, i) for i in xrange(20000))
+        self.assertEqual(self._command(output), output)
+
+    def testShortCommandStreamed(self):
+        chunks = []
+        self._command('line 1\r\n', callback=chunks.append)
+        self.assertEqual(chunks, ['line 1\r\n'])
+
+    def testCommandCleanedUp(self):
+        output = '\x1b[1mline\b  1\x1b[0m\r\r\nline 2\r\n'
+        self.assertEqual(self._command(output, strip_chars=['\b '],
+                                       strip_ansi=True, dos2unix=True),
+                         'line 1\nline 2\n')
+
+    def testCommandStreamedCleanedUp(self):
+        output = '\x1b[7m--\x1b[0m\r\n' * 5000
+        chunks = []
+        self._command(output, callback=chunks.append, strip_ansi=True,
+                      dos2unix=True)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(''.join(chunks), '--\n' * 5000)
+
+
+class TestOutputCleaner(unittest.TestCase):
+
+    def testNothingToClean(self):
+        cleaner = trans.OutputCleaner()
+        self.assertEqual(cleaner.clean('a\x1b[0m\r\n'), 'a\x1b[0m\r\n')
+        self.assertEqual(cleaner.clean(None), None)
+
+    def testStripAnsi(self):
+        cleaner = trans.OutputCleaner(strip_ansi=True)
+        self.assertEqual(cleaner.clean('\x1b[2J\x1b[?25ha|b\x03\x1a\r\n'),
+                         'a|b\r\n')
+
+    def testDos2Unix(self):
+        cleaner = trans.OutputCleaner(dos2unix=True)
+        self.assertEqual(cleaner.clean('a\r\nb\r\r\nc\rd\n'),
+                         'a\nb\nc\rd\n')
+
+    def testStripCharsInOrder(self):
+        cleaner = trans.OutputCleaner(strip_chars=['\b ', '\b', '.*'])
+        self.assertEqual(cleaner.clean('ab\b \bc.*d.e'), 'abcd.e')
+
+    def testTransportCachesCleaners(self):
+        transport = trans.DeviceTransport()
+        self.assertTrue(transport._cleaner(['x']) is transport._cleaner(['x']))
+        transport.strip_ansi = True
+        self.assertEqual(transport._cleaner(['x']).clean('x\x1b[0m'), '')
+
+
+class TestStreamCleaner(unittest.TestCase):
+
+    def _stream(self, cleaner, pieces):
+        chunks = []
+        stream = trans.StreamCleaner(cleaner, chunks.append)
+        for piece in pieces:
+            stream.write(piece)
+        stream.close()
+        return ''.join(chunks)
+
+    def testSplitInsideSequence(self):
+        cleaner = trans.OutputCleaner(strip_chars=['\b ', '\b'])
+        self.assertEqual(self._stream(cleaner, ['--More--\b', ' \bline 1\n']),
+                         '--More--line 1\n')
+
+    def testEverySplitMatchesWholeClean(self):
+        cleaner = trans.OutputCleaner(strip_ansi=True, dos2unix=True,
+                                      strip_chars=['\b ', '\b'])
+        output = 'a\b \b\x1b[12;1Hb\r\r\nc\x03\r\nd\b'
+        for i in xrange(len(output) + 1):
+            for j in xrange(i, len(output) + 1):
+                self.assertEqual(
+                    self._stream(cleaner, [output[:i], output[i:j],
+                                           output[j:]]),
+                    cleaner.clean(output), (i, j))
+
+    def testPartialHeldBackOnly(self):
+        chunks = []
+        stream = trans.StreamCleaner(trans.OutputCleaner(dos2unix=True),
+                                     chunks.append)
+        stream.write('line 1\r\nline 2\r')
+        self.assertEqual(chunks, ['line 1\nline 2'])
+        stream.write('\n')
+        self.assertEqual(chunks, ['line 1\nline 2', '\n'])
+
+
+class TestPromptSearcher(unittest.TestCase):
+
+    PROMPT_RE = re.compile(r'\S+\s?[>#]')
+
+    def testLiteralAcrossReads(self):
+        searcher = trans.PromptSearcher([PROMPT, pexpect.EOF,
+                                         pexpect.TIMEOUT])
+        self.assertEqual(searcher.eof_index, 1)
+        self.assertEqual(searcher.timeout_index, 2)
+        buf = 'line 1\r\nrou'
+        self.assertEqual(searcher.search(buf, len(buf)), -1)
+        buf += 'ter#'
+        self.assertEqual(searcher.search(buf, 4), 0)
+        self.assertEqual(buf[searcher.start:searcher.end], PROMPT)
+
+    def testOnlyFreshDataSearched(self):
+        searcher = trans.PromptSearcher([PROMPT])
+        # A match wholly in old data was seen by an earlier search.
+        buf = 'router#' + 'x' * 100
+        self.assertEqual(searcher.search(buf, 10), -1)
+
+    def testRegexpMatchesWholeLine(self):
+        searcher = trans.PromptSearcher([self.PROMPT_RE])
+        buf = 'output\r\n' * 1000 + 'core1.syd'
+        self.assertEqual(searcher.search(buf, len(buf)), -1)
+        buf += '#'
+        self.assertEqual(searcher.search(buf, 1), 0)
+        self.assertEqual(buf[searcher.start:searcher.end], 'core1.syd#')
+
+    def testEarliestMatchWins(self):
+        pager = re.compile(r'--More--')
+        searcher = trans.PromptSearcher([pager, PROMPT])
+        buf = 'a\nrouter# --More--'
+        self.assertEqual(searcher.search(buf, len(buf)), 1)
+        buf = 'a\n--More-- router#'
+        self.assertEqual(searcher.search(buf, len(buf)), 0)
+
+    def testAnchoredRegexp(self):
+        searcher = trans.PromptSearcher([PROMPT, trans.STREAM_CHUNK])
+        buf = 'x' * (trans.STREAM_CHUNK_SIZE + 10) + '\nmore'
+        self.assertEqual(searcher.search(buf, 5), 1)
+        self.assertEqual(searcher.start, 0)
+        self.assertEqual(searcher.end, trans.STREAM_CHUNK_SIZE + 11)
+
+
+class TestDeviceTransportProbe(unittest.TestCase):
+
+    def setUp(self):
+        timeouts = device.Timeouts(connect=1, resp_short=1, resp_long=1,
+                                   disconnect=1)
+        self.ours, self.theirs = socket.socketpair()
+        self.transport = SocketTransport(self.ours, timeouts=timeouts)
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def testProbeSeesPrompt(self):
+        fake = FakeDevice(self.theirs, '')
+        fake.run = lambda: (fake._read_line(), fake.sock.sendall(PROMPT))
+        fake.start()
+        self.assertTrue(self.transport.probe(PROMPT))
+        fake.join()
+
+    def testProbeOfClosedConnection(self):
+        self.theirs.close()
+        self.assertFalse(self.transport.probe(PROMPT))
+
+    def testProbeWithoutPrompt(self):
+        self.assertFalse(self.transport.probe(PROMPT, timeout=0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()